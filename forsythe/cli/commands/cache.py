@@ -0,0 +1,93 @@
+import os
+
+from forsythe.cli.commands.common import Command
+from forsythe.collections import load_collection, load_default_collection
+from forsythe.config import get_config_var, parse_size
+from forsythe.images.cleanup import get_cache_stats, collect_garbage
+
+
+def format_size(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            return '%0.1f %s' % (num_bytes, unit)
+        num_bytes /= 1024.0
+    return '%0.1f TB' % num_bytes
+
+
+def get_cache_root(relpath):
+    if relpath:
+        return load_collection(os.path.abspath(relpath))
+    fma_root = os.environ.get('FMA_ROOT')
+    if fma_root:
+        return load_collection(fma_root)
+    return load_default_collection()
+
+
+class CacheStatsCommand(Command):
+
+    @classmethod
+    def init_parser(cls, parser):
+        parser.add_argument('--root', '-r', default='')
+
+    @classmethod
+    def run(cls, args):
+        rootdir = get_cache_root(args.root)
+        print('Cache root: %s' % rootdir)
+        print('')
+
+        total_size = 0
+        total_orphan_size = 0
+        total_hits = 0
+        total_misses = 0
+        for stats in get_cache_stats(rootdir):
+            path = os.path.relpath(stats['cache_dir'] or stats['images_dir'], rootdir)
+            lookups = stats['hits'] + stats['misses']
+            hit_rate_str = ('%5.1f%%' % (stats['hits'] * 100.0 / lookups)) if lookups else '    -'
+            print(' %s | %5d | %10s | %3d orphans (%s) | %s hits' % (path.ljust(40), stats['num_entries'], format_size(stats['size']), stats['num_orphans'], format_size(stats['orphan_size']), hit_rate_str))
+            total_size += stats['size']
+            total_orphan_size += stats['orphan_size']
+            total_hits += stats['hits']
+            total_misses += stats['misses']
+
+        print('')
+        print('Total cached: %s' % format_size(total_size))
+        print('Total orphaned: %s' % format_size(total_orphan_size))
+        print('Hits: %d | Misses: %d' % (total_hits, total_misses))
+
+        budget = get_config_var('cache_budget')
+        if budget:
+            print('Budget: %s' % format_size(parse_size(budget)))
+
+
+class CacheGcCommand(Command):
+
+    @classmethod
+    def init_parser(cls, parser):
+        parser.add_argument('--root', '-r', default='')
+        parser.add_argument('--budget', '-b', type=parse_size)
+        parser.add_argument('--dry-run', '-n', action='store_true')
+        # .params files hold user edits, so they're only removed for missing images when asked for
+        parser.add_argument('--params', action='store_true')
+
+    @classmethod
+    def run(cls, args):
+        rootdir = get_cache_root(args.root)
+        budget = args.budget
+        if budget is None and get_config_var('cache_budget'):
+            budget = parse_size(get_config_var('cache_budget'))
+
+        print('Cache root: %s' % rootdir)
+        print('Budget: %s' % (format_size(budget) if budget is not None else '<none>'))
+        if args.dry_run:
+            print('Dry run: nothing will be deleted.')
+        print('')
+
+        result = collect_garbage(rootdir, budget, args.dry_run, args.params)
+        print('Removed %d orphaned entries (%s).' % (result['num_orphans'], format_size(result['orphan_size'])))
+        if args.params:
+            print('Removed %d .params files for missing images (%s)%s' % (len(result['params_paths']), format_size(result['params_size']), ':' if result['params_paths'] else '.'))
+            for path in result['params_paths']:
+                print('    %s' % os.path.relpath(path, rootdir))
+        print('Pruned %d manifest entries for missing raws.' % result['num_pruned'])
+        print('Evicted %d least-recently-used entries (%s).' % (result['num_evicted'], format_size(result['evicted_size'])))
+        print('Remaining: %s' % format_size(result['remaining_size']))
@@ -2,16 +2,21 @@ import os
 import re
 
 import cv2
+import numpy as np
 
 from forsythe.cli.commands.common import CollectionCommand
 from forsythe.files import collect_dirs_and_files, sort_files_by_ext, FileSequence
 from forsythe.images.params import write_param, read_param, write_params, read_params
-from forsythe.images.cache import get_cached_image_filepath, regenerate_cached_image
+from forsythe.images.preview import read_preview_image
 
 from forsythe.cropper.types import Corner
-from forsythe.cropper.mask import get_background_mask
-from forsythe.cropper.rect import find_rectilinear_corners
-from forsythe.cropper.shrink import shrink_inside_mask
+from forsythe.cropper import read_crop_settings
+from forsythe.cropper.detectors import get_detector_names
+from forsythe.cropper.graph import CropGraph, CropGraphWorker
+from forsythe.cropper.sheet import CropSheet
+
+# In sheet mode, the sheet is drawn to the right of the controls, rather than underneath them
+__sheet_margin__ = 420
 
 
 def draw_text(img, pos, text):
@@ -68,16 +73,10 @@ class ConfigureCropCommand(CollectionCommand):
         cr2_filepath = seq.pattern % (args.image or seq.ranges[0][0])
         if not os.path.isfile(cr2_filepath):
             raise RuntimeError('No such file: %s' % cr2_filepath)
-        cached_filepath = get_cached_image_filepath(cr2_filepath)
-        if not os.path.isfile(cached_filepath):
-            print('Generating cached image...')
-            regenerate_cached_image(cr2_filepath)
-
-        img = cv2.imread(cached_filepath)
-        img = cv2.resize(img, (img.shape[1] // 4, img.shape[0] // 4))
+        img = read_preview_image(cr2_filepath, 0.25)
 
-        modes = ['original', 'color key', 'corners']
-        mode_index = len(modes) - 1
+        modes = ['original', 'color key', 'corners', 'sheet']
+        mode_index = modes.index('corners')
 
         corner_size_factor = read_param(cr2_filepath, 'crop_corner_size_factor', 0.05)
         key_range_h = read_param(cr2_filepath, 'crop_key_range_h', 4.0)
@@ -97,157 +96,215 @@ class ConfigureCropCommand(CollectionCommand):
         inset_white_threshold = read_param(cr2_filepath, 'crop_inset_white_threshold', 0.0025)
         extra_inset = read_param(cr2_filepath, 'crop_extra_inset', 8.0)
 
+        detectors = ['auto'] + get_detector_names()
+        detector = read_param(cr2_filepath, 'crop_detector', 'auto')
+
         save_prompted = False
 
-        while True:
-            mode = modes[mode_index]
-
-            if mode_index >= modes.index('color key'):
-                mask = get_background_mask(img, corner_size_factor, [key_range_h, key_range_s, key_range_v], erosion_size, dilation_size)
-
-            if mode_index >= modes.index('corners'):
-                rect_corners = find_rectilinear_corners(mask, min_line_length_factor, max_line_gap_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor)
-                corners = shrink_inside_mask(mask, rect_corners, inset_interval, inset_white_threshold, extra_inset * 0.25) if rect_corners else None
-
-            base = None
-            if mode == 'original':
-                base = img.copy()
-            elif mode == 'color key':
-                base = cv2.cvtColor(mask, cv2.COLOR_GRAY2RGB)
-            elif mode == 'corners':
-                base = img.copy()
-                if corners:
-                    top_left = int(corners[Corner.top_left][0]), int(corners[Corner.top_left][1])
-                    top_right = int(corners[Corner.top_right][0]), int(corners[Corner.top_right][1])
-                    bottom_left = int(corners[Corner.bottom_left][0]), int(corners[Corner.bottom_left][1])
-                    bottom_right = int(corners[Corner.bottom_right][0]), int(corners[Corner.bottom_right][1])
-                    cv2.line(base, top_left, top_right, (255, 192, 192), 2)
-                    cv2.line(base, top_right, bottom_right, (255, 192, 192), 2)
-                    cv2.line(base, bottom_right, bottom_left, (255, 192, 192), 2)
-                    cv2.line(base, bottom_left, top_left, (255, 192, 192), 2)
-            else:
-                raise RuntimeError('Unsupported mode: %s' % mode)
-
-
-            height, width = base.shape[0], base.shape[1]
-            long_side = height if height > width else width
-            short_side = width if height > width else height
-            size = min(short_side // 2, max(1, int(long_side * corner_size_factor)))
-            cv2.rectangle(base, (0, 0), (size, size), (255, 192, 128), 1)
-            cv2.rectangle(base, (base.shape[1] - size, 0), (base.shape[1], size), (255, 192, 128), 1)
-            cv2.rectangle(base, (0, base.shape[0] - size), (size, base.shape[0]), (255, 192, 128), 1)
-            cv2.rectangle(base, (base.shape[1] - size, base.shape[0] - size), (base.shape[1], base.shape[0]), (255, 192, 128), 1)
-
-            mode_labels = [('[%s]' % m) if m == mode else m for m in modes]
-            controls_label(0, 'MODE (,|.): %s' % ' | '.join(mode_labels), base)
-
-            controls_label(2, 'COLOR KEY:', base)
-            float_control(3, corner_size_factor, 'corner_size', base, 'C')
-            float_control(4, key_range_h, 'key_range_h', base, 'H')
-            float_control(5, key_range_s, 'key_range_s', base, 'S')
-            float_control(6, key_range_v, 'key_range_v', base, 'V')
-            int_control(7, erosion_size, 'erosion_size', base, 'E')
-            int_control(8, dilation_size, 'dilation_size', base, 'D')
-
-            controls_label(10, 'CORNERS:', base)
-            float_control(11, min_line_length_factor, 'min_line_length_factor', base, 'L')
-            float_control(12, max_line_gap_factor, 'max_line_gap_factor', base, 'G')
-            float_control(13, max_inclination_deg, 'max_inclination_deg', base, 'I')
-            float_control(14, line_exclusion_size_factor, 'line_exclusion_size_factor', base, 'X')
-            int_control(15, num_clusters, 'num_clusters', base, 'N')
-            float_control(16, cluster_merge_threshold_size_factor, 'cluster_merge_threshold', base, 'M')
-            float_control(17, inset_interval, 'inset_interval', base, 'T')
-            float_control(18, inset_white_threshold, 'inset_white_threshold', base, 'W')
-            float_control(19, extra_inset, 'extra_inset', base, 'Z')
-
-            if save_prompted:
-                draw_text(base, (400, 400), 'Press ENTER to save settings for all images in collection.')
-                draw_text(base, (500, 420), '(Press any other key to cancel.)')
-
-            cv2.imshow('image', base)
-            key = cv2.waitKeyEx(0)
-
-            if key in (27, ord('q'), ord('Q')):
-                break
-
-            if key == 13:
+        # Detection runs in the background, and only reruns the stages downstream of whichever setting was changed: in
+        # the meantime, the window keeps showing the last result to finish, so that a key can be held down without the
+        # window locking up
+        worker = CropGraphWorker(CropGraph(img))
+        # The same params, run on every frame in the sequence: only started once sheet mode is first entered
+        sheet = CropSheet([seq.pattern % num for num in seq.numbers], 0.25)
+        try:
+            while True:
+                mode = modes[mode_index]
+                settings = read_crop_settings({
+                    'crop_corner_size_factor': corner_size_factor,
+                    'crop_key_range_h': key_range_h,
+                    'crop_key_range_s': key_range_s,
+                    'crop_key_range_v': key_range_v,
+                    'crop_erosion_size': erosion_size,
+                    'crop_dilation_size': dilation_size,
+                    'crop_min_line_length_factor': min_line_length_factor,
+                    'crop_max_line_gap_factor': max_line_gap_factor,
+                    'crop_max_inclination_deg': max_inclination_deg,
+                    'crop_line_exclusion_size_factor': line_exclusion_size_factor,
+                    'crop_num_clusters': num_clusters,
+                    'crop_cluster_merge_threshold_size_factor': cluster_merge_threshold_size_factor,
+                    'crop_inset_interval': inset_interval,
+                    'crop_inset_white_threshold': inset_white_threshold,
+                    'crop_extra_inset': extra_inset,
+                    'crop_detector': detector,
+                }, 0.25)
+
+                with_corners = mode == 'corners'
+                if mode in ('color key', 'corners'):
+                    worker.submit(settings, with_corners)
+                elif mode == 'sheet':
+                    sheet.start(settings)
+                    sheet.poll()
+
+                # Until the latest request finishes, the last result to finish stands in for it
+                mask, inset, error = None, None, None
+                current = mode in ('original', 'sheet')
+                if worker.result and not current:
+                    result_settings, result_with_corners, mask, inset, error = worker.result
+                    current = result_settings == settings and (result_with_corners or not with_corners)
+                corners, detected_by, confidence = inset if inset else (None, None, 0.0)
+
+                base = None
+                if mode == 'original':
+                    base = img.copy()
+                elif mode == 'color key':
+                    base = cv2.cvtColor(mask, cv2.COLOR_GRAY2RGB) if mask is not None else img.copy()
+                elif mode == 'corners':
+                    base = img.copy()
+                    if corners:
+                        top_left = int(corners[Corner.top_left][0]), int(corners[Corner.top_left][1])
+                        top_right = int(corners[Corner.top_right][0]), int(corners[Corner.top_right][1])
+                        bottom_left = int(corners[Corner.bottom_left][0]), int(corners[Corner.bottom_left][1])
+                        bottom_right = int(corners[Corner.bottom_right][0]), int(corners[Corner.bottom_right][1])
+                        cv2.line(base, top_left, top_right, (255, 192, 192), 2)
+                        cv2.line(base, top_right, bottom_right, (255, 192, 192), 2)
+                        cv2.line(base, bottom_right, bottom_left, (255, 192, 192), 2)
+                        cv2.line(base, bottom_left, top_left, (255, 192, 192), 2)
+                elif mode == 'sheet':
+                    base = np.zeros_like(img)
+                    base[:, __sheet_margin__:] = sheet.render(base.shape[1] - __sheet_margin__, base.shape[0], img.shape[1] / float(img.shape[0]), ['%d' % num for num in seq.numbers])
+                else:
+                    raise RuntimeError('Unsupported mode: %s' % mode)
+
+
+                if mode != 'sheet':
+                    height, width = base.shape[0], base.shape[1]
+                    long_side = height if height > width else width
+                    short_side = width if height > width else height
+                    size = min(short_side // 2, max(1, int(long_side * corner_size_factor)))
+                    cv2.rectangle(base, (0, 0), (size, size), (255, 192, 128), 1)
+                    cv2.rectangle(base, (base.shape[1] - size, 0), (base.shape[1], size), (255, 192, 128), 1)
+                    cv2.rectangle(base, (0, base.shape[0] - size), (size, base.shape[0]), (255, 192, 128), 1)
+                    cv2.rectangle(base, (base.shape[1] - size, base.shape[0] - size), (base.shape[1], base.shape[0]), (255, 192, 128), 1)
+
+                mode_labels = [('[%s]' % m) if m == mode else m for m in modes]
+                controls_label(0, 'MODE (,|.): %s' % ' | '.join(mode_labels), base)
+
+                controls_label(2, 'COLOR KEY:', base)
+                float_control(3, corner_size_factor, 'corner_size', base, 'C')
+                float_control(4, key_range_h, 'key_range_h', base, 'H')
+                float_control(5, key_range_s, 'key_range_s', base, 'S')
+                float_control(6, key_range_v, 'key_range_v', base, 'V')
+                int_control(7, erosion_size, 'erosion_size', base, 'E')
+                int_control(8, dilation_size, 'dilation_size', base, 'D')
+
+                controls_label(10, 'CORNERS:', base)
+                float_control(11, min_line_length_factor, 'min_line_length_factor', base, 'L')
+                float_control(12, max_line_gap_factor, 'max_line_gap_factor', base, 'G')
+                float_control(13, max_inclination_deg, 'max_inclination_deg', base, 'I')
+                float_control(14, line_exclusion_size_factor, 'line_exclusion_size_factor', base, 'X')
+                int_control(15, num_clusters, 'num_clusters', base, 'N')
+                float_control(16, cluster_merge_threshold_size_factor, 'cluster_merge_threshold', base, 'M')
+                float_control(17, inset_interval, 'inset_interval', base, 'T')
+                float_control(18, inset_white_threshold, 'inset_white_threshold', base, 'W')
+                float_control(19, extra_inset, 'extra_inset', base, 'Z')
+                control(20, detector, 'detector', base, 'P')
+                if mode == 'corners' and inset:
+                    controls_label(21, 'DETECTED: %s (%0.3f)' % (detected_by, confidence) if detected_by else 'DETECTED: <none>', base)
+                if mode == 'sheet':
+                    controls_label(21, 'SHEET: %d/%d done, %d failed' % (len(sheet.results), len(sheet.raw_filepaths), sheet.num_failed), base)
+                if error:
+                    controls_label(23, 'ERROR: %s' % error, base)
+                elif not current:
+                    controls_label(23, 'COMPUTING...', base)
+
                 if save_prompted:
-                    num_saved = 0
-                    for num in seq.numbers:
-                        filepath = seq.pattern % num
-                        params = read_params(filepath)
-                        params['crop_corner_size_factor'] = corner_size_factor
-                        params['crop_key_range_h'] = key_range_h
-                        params['crop_key_range_s'] = key_range_s
-                        params['crop_key_range_v'] = key_range_v
-                        params['crop_erosion_size'] = erosion_size
-                        params['crop_dilation_size'] = dilation_size
-                        params['crop_min_line_length_factor'] = min_line_length_factor
-                        params['crop_max_line_gap_factor'] = max_line_gap_factor
-                        params['crop_max_inclination_deg'] = max_inclination_deg
-                        params['crop_line_exclusion_size_factor'] = line_exclusion_size_factor
-                        params['crop_num_clusters'] = num_clusters
-                        params['crop_cluster_merge_threshold_size_factor'] = cluster_merge_threshold_size_factor
-                        params['crop_inset_interval'] = inset_interval
-                        params['crop_inset_white_threshold'] = inset_white_threshold
-                        params['crop_extra_inset'] = extra_inset
-                        write_params(filepath, params)
-                        num_saved += 1
-                    print('Wrote crop params for %d images.' % num_saved)
-                    save_prompted = False
+                    draw_text(base, (400, 400), 'Press ENTER to save settings for all images in collection.')
+                    draw_text(base, (500, 420), '(Press any other key to cancel.)')
+
+                cv2.imshow('image', base)
+                # While a result is outstanding, poll for it rather than waiting on the next key
+                key = cv2.waitKeyEx(30 if worker.busy or not current or (mode == 'sheet' and sheet.busy) else 0)
+                if key == -1:
+                    continue
+
+                if key in (27, ord('q'), ord('Q')):
+                    break
+
+                if key == 13:
+                    if save_prompted:
+                        num_saved = 0
+                        for num in seq.numbers:
+                            filepath = seq.pattern % num
+                            params = read_params(filepath)
+                            params['crop_corner_size_factor'] = corner_size_factor
+                            params['crop_key_range_h'] = key_range_h
+                            params['crop_key_range_s'] = key_range_s
+                            params['crop_key_range_v'] = key_range_v
+                            params['crop_erosion_size'] = erosion_size
+                            params['crop_dilation_size'] = dilation_size
+                            params['crop_min_line_length_factor'] = min_line_length_factor
+                            params['crop_max_line_gap_factor'] = max_line_gap_factor
+                            params['crop_max_inclination_deg'] = max_inclination_deg
+                            params['crop_line_exclusion_size_factor'] = line_exclusion_size_factor
+                            params['crop_num_clusters'] = num_clusters
+                            params['crop_cluster_merge_threshold_size_factor'] = cluster_merge_threshold_size_factor
+                            params['crop_inset_interval'] = inset_interval
+                            params['crop_inset_white_threshold'] = inset_white_threshold
+                            params['crop_extra_inset'] = extra_inset
+                            params['crop_detector'] = detector
+                            write_params(filepath, params)
+                            num_saved += 1
+                        print('Wrote crop params for %d images.' % num_saved)
+                        save_prompted = False
+                    else:
+                        save_prompted = True
                 else:
-                    save_prompted = True
-            else:
-                save_prompted = False
-
-            if key == ord(','):
-                mode_index = (mode_index - 1) if mode_index > 0 else len(modes) - 1
-            elif key == ord('.'):
-                mode_index = (mode_index + 1) % len(modes)
-            elif is_key(key, 'C'):
-                incr = 0.01 if key == ord('c') else -0.01
-                corner_size_factor += incr
-            elif is_key(key, 'H'):
-                incr = 0.1 if key == ord('h') else -0.1
-                key_range_h += incr
-            elif is_key(key, 'S'):
-                incr = 0.1 if key == ord('s') else -0.1
-                key_range_s += incr
-            elif is_key(key, 'V'):
-                incr = 0.1 if key == ord('v') else -0.1
-                key_range_v += incr
-            elif is_key(key, 'E'):
-                incr = 1 if key == ord('e') else -1
-                erosion_size += incr
-            elif is_key(key, 'D'):
-                incr = 1 if key == ord('d') else -1
-                dilation_size += incr
-            elif is_key(key, 'L'):
-                incr = (1.0 if key == ord('l') else -1.0) * 0.001
-                min_line_length_factor += incr
-            elif is_key(key, 'G'):
-                incr = (1.0 if key == ord('g') else -1.0) * 0.0001
-                max_line_gap_factor += incr
-            elif is_key(key, 'I'):
-                incr = (1.0 if key == ord('i') else -1.0) * 1.0
-                max_inclination_deg += incr
-            elif is_key(key, 'X'):
-                incr = (1.0 if key == ord('x') else -1.0) * 0.1
-                line_exclusion_size_factor += incr
-            elif is_key(key, 'N'):
-                incr = (1 if key == ord('n') else -1)
-                num_clusters += incr
-            elif is_key(key, 'M'):
-                incr = (1.0 if key == ord('m') else -1.0) * 0.025
-                cluster_merge_threshold_size_factor += incr
-            elif is_key(key, 'T'):
-                incr = (1.0 if key == ord('t') else -1.0) * 0.1
-                inset_interval += incr
-            elif is_key(key, 'W'):
-                incr = (1.0 if key == ord('w') else -1.0) * 0.001
-                inset_white_threshold += incr
-            elif is_key(key, 'Z'):
-                incr = (1.0 if key == ord('z') else -1.0)
-                extra_inset += incr
-
-        cv2.destroyAllWindows()
+                    save_prompted = False
+
+                if key == ord(','):
+                    mode_index = (mode_index - 1) if mode_index > 0 else len(modes) - 1
+                elif key == ord('.'):
+                    mode_index = (mode_index + 1) % len(modes)
+                elif is_key(key, 'C'):
+                    incr = 0.01 if key == ord('c') else -0.01
+                    corner_size_factor += incr
+                elif is_key(key, 'H'):
+                    incr = 0.1 if key == ord('h') else -0.1
+                    key_range_h += incr
+                elif is_key(key, 'S'):
+                    incr = 0.1 if key == ord('s') else -0.1
+                    key_range_s += incr
+                elif is_key(key, 'V'):
+                    incr = 0.1 if key == ord('v') else -0.1
+                    key_range_v += incr
+                elif is_key(key, 'E'):
+                    incr = 1 if key == ord('e') else -1
+                    erosion_size += incr
+                elif is_key(key, 'D'):
+                    incr = 1 if key == ord('d') else -1
+                    dilation_size += incr
+                elif is_key(key, 'L'):
+                    incr = (1.0 if key == ord('l') else -1.0) * 0.001
+                    min_line_length_factor += incr
+                elif is_key(key, 'G'):
+                    incr = (1.0 if key == ord('g') else -1.0) * 0.0001
+                    max_line_gap_factor += incr
+                elif is_key(key, 'I'):
+                    incr = (1.0 if key == ord('i') else -1.0) * 1.0
+                    max_inclination_deg += incr
+                elif is_key(key, 'X'):
+                    incr = (1.0 if key == ord('x') else -1.0) * 0.1
+                    line_exclusion_size_factor += incr
+                elif is_key(key, 'N'):
+                    incr = (1 if key == ord('n') else -1)
+                    num_clusters += incr
+                elif is_key(key, 'M'):
+                    incr = (1.0 if key == ord('m') else -1.0) * 0.025
+                    cluster_merge_threshold_size_factor += incr
+                elif is_key(key, 'T'):
+                    incr = (1.0 if key == ord('t') else -1.0) * 0.1
+                    inset_interval += incr
+                elif is_key(key, 'W'):
+                    incr = (1.0 if key == ord('w') else -1.0) * 0.001
+                    inset_white_threshold += incr
+                elif is_key(key, 'Z'):
+                    incr = (1.0 if key == ord('z') else -1.0)
+                    extra_inset += incr
+                elif is_key(key, 'P'):
+                    incr = (1 if key == ord('p') else -1)
+                    detector = detectors[(detectors.index(detector) + incr) % len(detectors)]
+        finally:
+            worker.close()
+            sheet.close()
+            cv2.destroyAllWindows()
@@ -3,12 +3,153 @@ import re
 
 from forsythe.cli.commands.common import CollectionCommand
 from forsythe.files import collect_dirs_and_files, sort_files_by_ext, FileSequence
-from forsythe.images.cache import generate_cache, image_iterator
-from forsythe.images.params import read_params
+from forsythe.images.files import list_image_filenames, is_raw
+from forsythe.images.cache import get_profile_scale, get_cache_dir, get_cached_crop_dirpath, get_entry_source, is_cached_image_current
+from forsythe.images.manifest import read_manifest
+from forsythe.images.sharedmem import shared_decode_iterator
+from forsythe.images.mirror import mirrored_images_dir
+from forsythe.images.params import read_params, write_param
+from forsythe.images.background import update_stats_background_model, get_background_key_color, describe_background_model
 from forsythe.darktable.process import regenerate_xmps, run_darktable
 from forsythe.darktable.iop import dt_iop_clipping_params_t, dt_iop_exposure_params_t
-from forsythe.darktable.xmp import edit_xmp
-from forsythe.cropper import compute_crop_params
+from forsythe.darktable.xmp import edit_xmp, create_duplicate_xmp
+from forsythe.darktable.files import list_xmp_filenames, split_duplicate_xmp_filepaths
+from forsythe.cropper import compute_crop_params, compute_print_crop_params, can_compute_crop_params, read_crop_settings, CORNER_SIZE_FACTOR, MAX_PRINTS
+from forsythe.cropper.artifacts import CropArtifacts
+from forsythe.cropper.detectors import read_prior_corners
+
+
+def read_image_params(image_filepath, args, background_model=None):
+    image_params = read_params(image_filepath)
+    if args.coarse_level is not None:
+        image_params['crop_coarse_level'] = args.coarse_level
+    if 'crop_key_color_hsv' not in image_params:
+        corner_size_factor = image_params.get('crop_corner_size_factor', CORNER_SIZE_FACTOR)
+        key_color_hsv = get_background_key_color(background_model, os.path.basename(image_filepath), corner_size_factor)
+        if key_color_hsv:
+            image_params['crop_key_color_hsv'] = key_color_hsv
+    return image_params
+
+
+def get_crop_artifacts(image_filepath, entry):
+    if not entry or not is_raw(image_filepath):
+        return None
+    return CropArtifacts(get_cached_crop_dirpath(image_filepath, 'detect'), get_entry_source(entry))
+
+
+def get_prior_corners(previous_artifacts, previous_image_params, scale):
+    # On a copystand, consecutive frames put their prints in nearly the same place: the corners found for the previous
+    # frame (from its current decode, with its current settings) narrow the search for this one's
+    if not previous_artifacts:
+        return None
+    return read_prior_corners(previous_artifacts, read_crop_settings(previous_image_params, scale))
+
+
+def print_xmp_files(xmp_files):
+    # The sidecars of darktable duplicates are counted separately, since their numbering doesn't follow the images'
+    sidecars, duplicates = split_duplicate_xmp_filepaths(xmp_files)
+    seq = FileSequence.load(sidecars) if sidecars else None
+    if seq:
+        range_str = ', '.join(['(%d-%d)' % (lo, hi) for lo, hi in seq.ranges])
+        print('%d sidecar files found: %s' % (len(sidecars), range_str))
+    else:
+        print('%d sidecar files found.' % len(sidecars))
+    num_duplicates = sum([len(versions) for versions in duplicates.values()])
+    if num_duplicates:
+        print('%d duplicate sidecar files found, for %d image(s).' % (num_duplicates, len(duplicates)))
+
+
+def remove_duplicate_xmps(duplicate_xmps, num_versions):
+    # Duplicates left over from a run that found more prints in the frame than this one did
+    for version, xmp_filepath in sorted(duplicate_xmps.items()):
+        if version >= num_versions and os.path.isfile(xmp_filepath):
+            print('DELETE %s' % os.path.basename(xmp_filepath))
+            os.remove(xmp_filepath)
+
+
+def make_clipping_iop(crop_params):
+    iop_clipping = dt_iop_clipping_params_t()
+    iop_clipping.crop_auto = 0
+    iop_clipping.angle = crop_params['angle']
+    iop_clipping.cx = crop_params['cx']
+    iop_clipping.cy = crop_params['cy']
+    iop_clipping.cw = crop_params['cw']
+    iop_clipping.ch = crop_params['ch']
+    return iop_clipping
+
+
+def make_exposure_iops(image_params):
+    ev_delta = image_params.get('ev_delta')
+    if not ev_delta:
+        return []
+    iop_exposure = dt_iop_exposure_params_t()
+    iop_exposure.exposure = ev_delta
+    return [iop_exposure]
+
+
+def apply_print_params(image_filepath, image_params, img, scale, artifacts, duplicate_xmps):
+    # One darktable duplicate per print found in the frame, each with its own crop: the image's own sidecar gets the
+    # first print, and the clipping instance in each is named for its print so they can be told apart in darktable. Each
+    # print always gets the same version, so a print that couldn't be cropped still gets its own (uncropped) duplicate.
+    try:
+        prints = compute_print_crop_params(img, image_params, scale, artifacts)
+    except Exception as exc:
+        print('WARNING: Failed to crop %s: %s' % (os.path.basename(image_filepath), exc))
+        prints = []
+    print('%s -> %d print(s)' % (os.path.basename(image_filepath), len(prints)))
+    for index, crop_params in enumerate(prints):
+        if not crop_params:
+            print('WARNING: Failed to crop print %d of %s' % (index + 1, os.path.basename(image_filepath)))
+    write_param(image_filepath, 'crop_detection', [{'print': p['print'], 'detector': p['detector'], 'confidence': p['confidence']} for p in prints if p])
+
+    # Each print's orientation is kept in the params, where it can be corrected: prints seen for the first time start
+    # out with the frame's own top edge
+    top_edges = list(image_params.get('print_top_edges') or [])
+    num_prints = len(prints)
+    if len(top_edges) < num_prints:
+        top_edges.extend([image_params.get('top_edge') or 'top'] * (num_prints - len(top_edges)))
+        write_param(image_filepath, 'print_top_edges', top_edges)
+
+    if not prints:
+        prints = [None]
+    remove_duplicate_xmps(duplicate_xmps, len(prints))
+    xmp_filepaths = [create_duplicate_xmp(image_filepath, version) for version in range(len(prints))]
+    for xmp_filepath, crop_params in zip(xmp_filepaths, prints):
+        iops = make_exposure_iops(image_params)
+        if crop_params:
+            iop_clipping = make_clipping_iop(crop_params)
+            iop_clipping.multi_name = 'print %d' % crop_params['print']
+            iops.insert(0, iop_clipping)
+        if iops:
+            edit_xmp(xmp_filepath, iops)
+            print('%s: %s' % (os.path.basename(xmp_filepath), ', '.join([iop.operation for iop in iops])))
+        else:
+            print('%s: <skipped>' % (os.path.basename(xmp_filepath)))
+
+
+def apply_image_params(image_filepath, image_params, img, scale, artifacts, prior_corners=None, duplicate_xmps=None):
+    if image_params.get('crop_max_prints', MAX_PRINTS) > 1:
+        apply_print_params(image_filepath, image_params, img, scale, artifacts, duplicate_xmps or {})
+        return
+    remove_duplicate_xmps(duplicate_xmps or {}, 1)
+
+    iops = []
+    try:
+        crop_params = compute_crop_params(img, image_params, scale, artifacts, prior_corners)
+        print ('%s -> %r' % (os.path.basename(image_filepath), crop_params))
+        iops.append(make_clipping_iop(crop_params))
+        write_param(image_filepath, 'crop_detection', {'detector': crop_params['detector'], 'confidence': crop_params['confidence']})
+    except Exception as exc:
+        print('WARNING: Failed to crop %s: %s' % (os.path.basename(image_filepath), exc))
+
+    iops.extend(make_exposure_iops(image_params))
+
+    xmp_filepath = image_filepath + '.xmp'
+    if iops:
+        edit_xmp(xmp_filepath, iops)
+        print('%s: %s' % (os.path.basename(xmp_filepath), ', '.join([iop.operation for iop in iops])))
+    else:
+        print('%s: <skipped>' % (os.path.basename(xmp_filepath)))
 
 
 class DtClearCommand(CollectionCommand):
@@ -29,12 +170,7 @@ class DtClearCommand(CollectionCommand):
         _, filepaths = collect_dirs_and_files(images_dir)
         xmp_files = sort_files_by_ext(filepaths).get('.cr2.xmp', [])
         if xmp_files:
-            seq = FileSequence.load(xmp_files)
-            if seq:
-                range_str = ', '.join(['(%d-%d)' % (lo, hi) for lo, hi in seq.ranges])
-                print('%d sidecar files found: %s' % (len(xmp_files), range_str))
-            else:
-                print('%d sidecar files found.' % len(xmp_files))
+            print_xmp_files(xmp_files)
 
             if not args.force:
                 print('')
@@ -57,6 +193,8 @@ class DtClearCommand(CollectionCommand):
         print('')
         print('Deleted %d files.' % num_deleted)
 
+        # darktable adds whatever directory it's opened on to its library as a film roll, so sidecars are always
+        # regenerated in the original directory rather than in a local mirror of it
         print('Regenerating .xmp sidecar files...')
         regenerate_xmps(images_dir)
 
@@ -69,6 +207,9 @@ class DtApplyCommand(CollectionCommand):
         super().init_parser(parser)
         parser.add_argument('subdir', nargs='?', default='.')
         parser.add_argument('--force', '-f', action='store_true')
+        parser.add_argument('--no-cache', action='store_true')
+        parser.add_argument('--coarse-level', type=int)
+        parser.add_argument('--no-background-model', action='store_true')
 
     @classmethod
     def run(cls, args):
@@ -92,12 +233,7 @@ class DtApplyCommand(CollectionCommand):
 
         xmp_files = filepaths_by_ext.get('.cr2.xmp', [])
         if xmp_files:
-            seq = FileSequence.load(xmp_files)
-            if seq:
-                range_str = ', '.join(['(%d-%d)' % (lo, hi) for lo, hi in seq.ranges])
-                print('%d sidecar files found: %s' % (len(xmp_files), range_str))
-            else:
-                print('%d sidecar files found.' % len(xmp_files))
+            print_xmp_files(xmp_files)
 
             if not args.force:
                 print('')
@@ -106,46 +242,60 @@ class DtApplyCommand(CollectionCommand):
                 print('If you\'re sure you want to do that, re-run with -f.')
                 return
 
+        # As in dt-clear, darktable only ever sees the original directory: the mirror is pulled once it's done, and so
+        # starts out with the regenerated sidecars
         print('')
-        print('Generating image cache...')
-        generate_cache(images_dir)
-
         print('Regenerating .xmp sidecar files...')
         regenerate_xmps(images_dir)
 
-        for image_filepath, cached_filepath in image_iterator(images_dir):
-            iops = []
-
-            image_params = read_params(image_filepath)
-            try:
-                crop_params = compute_crop_params(cached_filepath, image_params)
-                print ('%s -> %r' % (os.path.basename(image_filepath), crop_params))
-
-                iop_clipping = dt_iop_clipping_params_t()
-                iop_clipping.crop_auto = 0
-                iop_clipping.angle = crop_params['angle']
-                iop_clipping.cx = crop_params['cx']
-                iop_clipping.cy = crop_params['cy']
-                iop_clipping.cw = crop_params['cw']
-                iop_clipping.ch = crop_params['ch']
-                iops.append(iop_clipping)
-            except Exception as exc:
-                print('WARNING: Failed to crop %s: %s' % (os.path.basename(image_filepath), exc))
-
-            ev_delta = image_params.get('ev_delta')
-            if ev_delta:
-                iop_exposure = dt_iop_exposure_params_t()
-                iop_exposure.exposure = ev_delta
-                iops.append(iop_exposure)
-
-            xmp_filepath = image_filepath + '.xmp'
-            if iops:
-                edit_xmp(xmp_filepath, iops)
-                print('%s: %s' % (os.path.basename(xmp_filepath), ', '.join([iop.operation for iop in iops])))
-            else:
-                print('%s: <skipped>' % (os.path.basename(xmp_filepath)))
+        with mirrored_images_dir(images_dir) as work_dir:
+            # darktable rewrites the sidecars of any duplicates it already has in its library, e.g. from a previous run
+            _, duplicate_xmps = split_duplicate_xmp_filepaths([os.path.join(work_dir, filename) for filename in list_xmp_filenames(work_dir)])
+
+            # Each frame shares a key color with the rest of its run of frames, rather than estimating its own. Frames
+            # that aren't cached yet are decoded for the model before any cropping starts, so that the crops don't depend
+            # on how much of the collection happened to be cached already.
+            background_model = None
+            if not args.no_background_model:
+                background_model = update_stats_background_model(work_dir, 'detect', CORNER_SIZE_FACTOR, pyramid=True, persist=not args.no_cache)
+                print(describe_background_model(background_model))
+
+            # Any image whose crop can be finished from the stages persisted last time (e.g. if only the inset has
+            # changed) is done without ever being decoded or read back from the cache
+            scale = get_profile_scale('detect')
+            manifest = read_manifest(get_cache_dir(work_dir, 'detect'))
+            to_decode = []
+            # Sorted, since the prior for each frame comes from the one shot before it
+            filenames = sorted(list_image_filenames(work_dir))
+            previous_filenames = dict(zip(filenames[1:], filenames[:-1]))
+            image_params_by_name = {}
+            artifacts_by_name = {}
+
+            def get_frame_prior_corners(filename):
+                previous_filename = previous_filenames.get(filename)
+                if not previous_filename:
+                    return None
+                return get_prior_corners(artifacts_by_name.get(previous_filename), image_params_by_name[previous_filename], scale)
+
+            for filename in filenames:
+                image_filepath = os.path.join(work_dir, filename)
+                image_params = image_params_by_name[filename] = read_image_params(image_filepath, args, background_model)
+                entry = manifest.get(filename) if is_raw(image_filepath) and is_cached_image_current(manifest, image_filepath, 'detect') else None
+                artifacts = artifacts_by_name[filename] = None if args.no_cache else get_crop_artifacts(image_filepath, entry)
+                prior_corners = get_frame_prior_corners(filename)
+                if artifacts and can_compute_crop_params(image_params, scale, artifacts, prior_corners):
+                    apply_image_params(image_filepath, image_params, None, scale, artifacts, prior_corners, duplicate_xmps.get(image_filepath))
+                else:
+                    to_decode.append(filename)
+
+            # Uncached raws are decoded straight into shared memory for cropping; the cache is filled in the background
+            for image_filepath, img, entry in shared_decode_iterator(work_dir, profile='detect', pyramid=True, persist=not args.no_cache, filenames=to_decode, with_entries=True):
+                filename = os.path.basename(image_filepath)
+                artifacts = artifacts_by_name[filename] = None if args.no_cache else get_crop_artifacts(image_filepath, entry)
+                apply_image_params(image_filepath, image_params_by_name[filename], img, scale, artifacts, get_frame_prior_corners(filename), duplicate_xmps.get(image_filepath))
 
         print('Launching darktable. Reimport all changed .xmp files when prompted.')
+        print('(Duplicates made for frames with several prints are only picked up when the folder is re-imported.)')
         run_darktable([images_dir])
 
 
@@ -7,6 +7,7 @@ from forsythe.cli.commands.common import CollectionCommand
 from forsythe.files import collect_dirs_and_files, sort_files_by_ext, FileSequence
 
 from forsythe.images.params import write_param
+from forsythe.images.cleanup import delete_image_caches
 
 from forsythe.eos.device import wait_for_device
 from forsythe.eos.window import activate_liveview, close_eos_windows, capture_liveview_photo
@@ -106,6 +107,8 @@ class ShootCommand(CollectionCommand):
                     if os.path.isfile(xmp_filepath):
                         os.remove(xmp_filepath)
                         print('Deleted %s' % xmp_filepath)
+                    for deleted_filepath in delete_image_caches(raw_filepath):
+                        print('Deleted %s' % deleted_filepath)
                     image_num -= 1
                     close_eos_windows()
                     update_eos_config(output_dir, prefix, image_num)
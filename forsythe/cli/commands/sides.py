@@ -7,7 +7,9 @@ import numpy as np
 from forsythe.cli.commands.common import CollectionCommand
 from forsythe.files import collect_dirs_and_files, sort_files_by_ext, temporary_directory, FileSequence
 from forsythe.images.params import read_params, write_param
-from forsythe.images.cache import generate_cache, image_iterator
+from forsythe.images.preview import generate_previews, prefetch_preview_iterator
+from forsythe.images.background import update_preview_background_model, get_background_key_color, describe_background_model
+from forsythe.images.mirror import mirrored_images_dir
 from forsythe.cropper.mask import get_background_mask
 from forsythe.cropper import CORNER_SIZE_FACTOR, KEY_RANGE_HSV, EROSION_SIZE, DILATION_SIZE
 
@@ -32,66 +34,68 @@ class TagSidesCommand(CollectionCommand):
         if not seq:
             raise RuntimeError('No .cr2 image sequence found')
 
-        print('Generating image cache...')
-        generate_cache(images_dir)
-
-        tmp_dirpath = os.path.join(images_dir, '.temp-sides')
-        with temporary_directory(tmp_dirpath):
-
-            os.startfile(tmp_dirpath)
-
-            backs_dirpath = os.path.join(tmp_dirpath, 'backs')
-            os.makedirs(backs_dirpath)
-
-            cr2_filepath_lookup = {}
-            for image_filepath, cached_filepath in image_iterator(images_dir):
-                short_filename = os.path.basename(cached_filepath)
-                cr2_filepath_lookup[short_filename] = image_filepath
-
-                img = cv2.imread(cached_filepath)
-                img = cv2.resize(img, (img.shape[1] // 4, img.shape[0] // 4))
-
-                is_back = None
-                image_params = read_params(image_filepath)
-                if image_params.get('side') in ('front', 'back'):
-                    is_back = image_params.get('side') == 'back'
-                    print('%s -- loaded -- %s' % (short_filename, 'back' if is_back else 'FRONT'))
-
-                if is_back is None:
-                    corner_size_factor = image_params.get('crop_corner_size_factor', CORNER_SIZE_FACTOR)
-                    key_range_h = image_params.get('crop_key_range_h', KEY_RANGE_HSV[0])
-                    key_range_s = image_params.get('crop_key_range_S', KEY_RANGE_HSV[1])
-                    key_range_v = image_params.get('crop_key_range_v', KEY_RANGE_HSV[2])
-                    erosion_size = image_params.get('crop_erosion_size', EROSION_SIZE)
-                    dilation_size = image_params.get('crop_dilation_size', DILATION_SIZE)
-                    mask = get_background_mask(img, corner_size_factor, [key_range_h, key_range_s, key_range_v], erosion_size, dilation_size)
-                    alpha = cv2.erode(~mask, np.ones((5, 5), np.uint8), iterations=5)
-
-                    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                    res = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 7, 5.0)
-                    res = cv2.bitwise_and(res, res, mask=alpha)
-                    percentage = np.count_nonzero(res) / np.count_nonzero(alpha)
-
-                    is_back = percentage < args.threshold
-                    print('%s -- % 5.1f%% -- %s' % (short_filename, percentage * 100.0, 'back' if is_back else 'FRONT'))
-
-                dst_dirpath = backs_dirpath if is_back else tmp_dirpath
-                dst_filepath = os.path.join(dst_dirpath, short_filename)
-                cv2.imwrite(dst_filepath, img)
-
-            print('')
-            print('Please check the .temp-sides directory and move any back images to backs folder.')
-            print('Then check the backs folder and make sure it doesn\'t contain any front images.')
-            input('Once all images are sorted, press enter to proceed.')
-
-            for filename in os.listdir(tmp_dirpath):
-                cr2_filepath = cr2_filepath_lookup.get(filename)
-                if cr2_filepath:
-                    print('%s - front' % filename)
-                    write_param(cr2_filepath, 'side', 'front')
-
-            for filename in os.listdir(backs_dirpath):
-                cr2_filepath = cr2_filepath_lookup.get(filename)
-                if cr2_filepath:
-                    print('%s - back' % filename)
-                    write_param(cr2_filepath, 'side', 'back')
+        with mirrored_images_dir(images_dir) as work_dir:
+            tmp_dirpath = os.path.join(work_dir, '.temp-sides')
+            with temporary_directory(tmp_dirpath):
+
+                os.startfile(tmp_dirpath)
+
+                backs_dirpath = os.path.join(tmp_dirpath, 'backs')
+                os.makedirs(backs_dirpath)
+
+                # Every frame keys against its run of frames' shared backdrop color, rather than its own corners: that
+                # needs every preview up front, rather than as each one comes up
+                generate_previews(work_dir)
+                background_model = update_preview_background_model(work_dir, CORNER_SIZE_FACTOR)
+                print(describe_background_model(background_model))
+
+                cr2_filepath_lookup = {}
+                for image_filepath, img in prefetch_preview_iterator(work_dir, 0.25):
+                    short_filename = os.path.splitext(os.path.basename(image_filepath))[0] + '.jpg'
+                    cr2_filepath_lookup[short_filename] = image_filepath
+
+                    is_back = None
+                    image_params = read_params(image_filepath)
+                    if image_params.get('side') in ('front', 'back'):
+                        is_back = image_params.get('side') == 'back'
+                        print('%s -- loaded -- %s' % (short_filename, 'back' if is_back else 'FRONT'))
+
+                    if is_back is None:
+                        corner_size_factor = image_params.get('crop_corner_size_factor', CORNER_SIZE_FACTOR)
+                        key_range_h = image_params.get('crop_key_range_h', KEY_RANGE_HSV[0])
+                        key_range_s = image_params.get('crop_key_range_S', KEY_RANGE_HSV[1])
+                        key_range_v = image_params.get('crop_key_range_v', KEY_RANGE_HSV[2])
+                        erosion_size = image_params.get('crop_erosion_size', EROSION_SIZE)
+                        dilation_size = image_params.get('crop_dilation_size', DILATION_SIZE)
+                        key_color_hsv = image_params.get('crop_key_color_hsv') or get_background_key_color(background_model, os.path.basename(image_filepath), corner_size_factor)
+                        mask = get_background_mask(img, corner_size_factor, [key_range_h, key_range_s, key_range_v], erosion_size, dilation_size, key_color_hsv)
+                        alpha = cv2.erode(~mask, np.ones((5, 5), np.uint8), iterations=5)
+
+                        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                        res = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 7, 5.0)
+                        res = cv2.bitwise_and(res, res, mask=alpha)
+                        percentage = np.count_nonzero(res) / np.count_nonzero(alpha)
+
+                        is_back = percentage < args.threshold
+                        print('%s -- % 5.1f%% -- %s' % (short_filename, percentage * 100.0, 'back' if is_back else 'FRONT'))
+
+                    dst_dirpath = backs_dirpath if is_back else tmp_dirpath
+                    dst_filepath = os.path.join(dst_dirpath, short_filename)
+                    cv2.imwrite(dst_filepath, img)
+
+                print('')
+                print('Please check the .temp-sides directory and move any back images to backs folder.')
+                print('Then check the backs folder and make sure it doesn\'t contain any front images.')
+                input('Once all images are sorted, press enter to proceed.')
+
+                for filename in os.listdir(tmp_dirpath):
+                    cr2_filepath = cr2_filepath_lookup.get(filename)
+                    if cr2_filepath:
+                        print('%s - front' % filename)
+                        write_param(cr2_filepath, 'side', 'front')
+
+                for filename in os.listdir(backs_dirpath):
+                    cr2_filepath = cr2_filepath_lookup.get(filename)
+                    if cr2_filepath:
+                        print('%s - back' % filename)
+                        write_param(cr2_filepath, 'side', 'back')
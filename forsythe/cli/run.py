@@ -51,6 +51,14 @@ __commands__ = [
     {
         'name': 'dt-open', 'module': 'dt',
         'help': 'Opens a set of images in darktable'
+    },
+    {
+        'name': 'cache-stats', 'module': 'cache',
+        'help': 'Reports image cache sizes and hit rates under FMA_ROOT'
+    },
+    {
+        'name': 'cache-gc', 'module': 'cache',
+        'help': 'Deletes orphaned cache entries and evicts down to a size budget'
     }
 ]
 
@@ -1,9 +1,13 @@
 import os
+import re
 import json
 
 
 __fma_json_path__ = os.path.join(os.path.expanduser('~'), '.fma.json')
 
+__size_regex__ = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', re.IGNORECASE)
+__size_units__ = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
 
 def get_config_filepath():
     return __fma_json_path__
@@ -30,3 +34,10 @@ def set_config_var(name, value):
     data = load_config()
     data[name] = value
     write_config(data)
+
+
+def parse_size(s):
+    match = __size_regex__.match(str(s))
+    if not match:
+        raise ValueError('Invalid size: %s (expected e.g. 500M, 20G)' % s)
+    return int(float(match.group(1)) * __size_units__[match.group(2).lower()])
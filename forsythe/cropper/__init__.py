@@ -1,9 +1,9 @@
 import cv2
 
-from forsythe.cropper.mask import get_background_mask
-from forsythe.cropper.rect import find_rectilinear_corners
 from forsythe.cropper.shrink import shrink_inside_mask
+from forsythe.cropper.detectors import DetectionInput, detect_corners, can_detect_without_image
 from forsythe.cropper.output import get_crop_params, rotate_crop_params
+from forsythe.cropper.multi import find_print_crops
 from forsythe.cropper.types import Corner, Edge
 
 CORNER_SIZE_FACTOR = 0.05
@@ -18,39 +18,153 @@ LINE_EXCLUSION_SIZE_FACTOR = 0.1
 NUM_CLUSTERS = 8
 CLUSTER_MERGE_THRESHOLD_SIZE_FACTOR = 0.025
 
+# Lines are only looked for in a band along each side of the image (outside the central exclusion band), rather than
+# over the whole mask: given the previous frame's corners, each band is narrowed to this margin around its edge
+LINE_ROI = True
+LINE_PRIOR_MARGIN_SIZE_FACTOR = 0.03
+
 INSET_INTERVAL = 1.0
 INSET_WHITE_THRESHOLD = 0.0025
 EXTRA_INSET = 8.0
 
+# Coarse-to-fine detection: corners are found at 1/2^level scale (0 disables it), then refined at full resolution
+COARSE_LEVEL = 0
+REFINE_BAND_COARSE_PIXELS = 4.0
+REFINE_MASK_BAND_SIZE_FACTOR = 0.01
+REFINE_NUM_SAMPLES = 64
+REFINE_MIN_SAMPLE_FRACTION = 0.25
+
+# Which detector finds the corners: 'contour' (bounding rectangle of the subject), 'hough' (line segments), 'projection'
+# (skew search over row/column profiles, for prints that are within MAX_INCLINATION_DEG of square with the frame), or
+# 'auto' to try each of AUTO_DETECTORS in turn until one is at least MIN_CONFIDENCE in its result
+DETECTOR = 'auto'
+AUTO_DETECTORS = ['contour', 'hough']
+MIN_CONFIDENCE = 0.9
+MIN_AREA_RATIO = 0.1
+MAX_AREA_RATIO = 0.98
+SCORE_LONG_SIDE = 512
+SCORE_EDGE_OFFSET = 3.0
+SCORE_EDGE_SAMPLES = 64
+
+# Frames with more than one print in them: each separate blob of subject at least MIN_PRINT_AREA_RATIO of the frame is a
+# print, up to MAX_PRINTS of them (1 takes the frame as a single print, as usual)
+MAX_PRINTS = 1
+MIN_PRINT_AREA_RATIO = 0.02
+
+PROJECTION_COARSE_STEP_DEG = 0.5
+PROJECTION_FINE_STEP_DEG = 0.05
+PROJECTION_SEARCH_LONG_SIDE = 512
+PROJECTION_EDGE_THRESHOLD = 0.5
+PROJECTION_MIN_SIZE_FACTOR = 0.25
+
+
+def read_crop_settings(image_params, scale=1.0):
+    return {
+        'top_edge': image_params.get('top_edge') or 'top',
+
+        'corner_size_factor': image_params.get('crop_corner_size_factor', CORNER_SIZE_FACTOR),
+        # Normally estimated from each image's own corners, unless it's known from the session's background model
+        'key_color_hsv': image_params.get('crop_key_color_hsv'),
+        'key_range_hsv': [
+            image_params.get('crop_key_range_h', KEY_RANGE_HSV[0]),
+            image_params.get('crop_key_range_s', KEY_RANGE_HSV[1]),
+            image_params.get('crop_key_range_v', KEY_RANGE_HSV[2]),
+        ],
+        'erosion_size': image_params.get('crop_erosion_size', EROSION_SIZE),
+        'dilation_size': image_params.get('crop_dilation_size', DILATION_SIZE),
+
+        'min_line_length_factor': image_params.get('crop_min_line_length_factor', MIN_LINE_LENGTH_FACTOR),
+        'max_line_gap_factor': image_params.get('crop_max_line_gap_factor', MAX_LINE_GAP_FACTOR),
+        'max_inclination_deg': image_params.get('crop_max_inclination_deg', MAX_INCLINATION_DEG),
+        'line_exclusion_size_factor': image_params.get('crop_line_exclusion_size_factor', LINE_EXCLUSION_SIZE_FACTOR),
+        'num_clusters': image_params.get('crop_num_clusters', NUM_CLUSTERS),
+        'cluster_merge_threshold_size_factor': image_params.get('crop_cluster_merge_threshold_size_factor', CLUSTER_MERGE_THRESHOLD_SIZE_FACTOR),
+        'line_roi': image_params.get('crop_line_roi', LINE_ROI),
+        'line_prior_margin_size_factor': image_params.get('crop_line_prior_margin_size_factor', LINE_PRIOR_MARGIN_SIZE_FACTOR),
+
+        'inset_interval': image_params.get('crop_inset_interval', INSET_INTERVAL),
+        'inset_white_threshold': image_params.get('crop_inset_white_threshold', INSET_WHITE_THRESHOLD),
+        'extra_inset': image_params.get('crop_extra_inset', EXTRA_INSET) * scale,
+
+        'coarse_level': image_params.get('crop_coarse_level', COARSE_LEVEL),
+        'refine_band_coarse_pixels': REFINE_BAND_COARSE_PIXELS,
+        'refine_mask_band_size_factor': REFINE_MASK_BAND_SIZE_FACTOR,
+        'refine_num_samples': REFINE_NUM_SAMPLES,
+        'refine_min_sample_fraction': REFINE_MIN_SAMPLE_FRACTION,
+
+        'detector': image_params.get('crop_detector', DETECTOR),
+        'auto_detectors': AUTO_DETECTORS,
+        'min_confidence': image_params.get('crop_min_confidence', MIN_CONFIDENCE),
+        'min_area_ratio': MIN_AREA_RATIO,
+        'max_area_ratio': MAX_AREA_RATIO,
+        'score_long_side': SCORE_LONG_SIDE,
+        'score_edge_offset': SCORE_EDGE_OFFSET,
+        'score_edge_samples': SCORE_EDGE_SAMPLES,
+
+        'projection_coarse_step_deg': PROJECTION_COARSE_STEP_DEG,
+        'projection_fine_step_deg': PROJECTION_FINE_STEP_DEG,
+        'projection_search_long_side': PROJECTION_SEARCH_LONG_SIDE,
+        'projection_edge_threshold': image_params.get('crop_projection_edge_threshold', PROJECTION_EDGE_THRESHOLD),
+        'projection_min_size_factor': PROJECTION_MIN_SIZE_FACTOR,
+
+        'max_prints': image_params.get('crop_max_prints', MAX_PRINTS),
+        'min_print_area_ratio': image_params.get('crop_min_print_area_ratio', MIN_PRINT_AREA_RATIO),
+        'print_top_edges': image_params.get('print_top_edges') or [],
+    }
+
+
+def compute_crop_params(image, image_params, scale=1.0, artifacts=None, prior_corners=None):
+    # Along with the crop itself, the returned params record which detector found it and how confident it was. Given
+    # a CropArtifacts, each stage's output is persisted, and reused on later runs until its settings change; image may
+    # then be None if can_compute_crop_params says that nothing needs recomputing from it. prior_corners, if given, are
+    # where the print was found in the previous frame, and narrow the search for its edges: a crop found that way isn't
+    # persisted, since its key doesn't cover the prior (the corners it came from are, along with the prior).
+    settings = read_crop_settings(image_params, scale)
+    if artifacts:
+        found, params = artifacts.read('crop', settings)
+        if found:
+            return params
+
+    img = cv2.imread(image) if isinstance(image, str) else image
+    rect_corners, mask, detector, confidence, narrowed = detect_corners(img, settings, artifacts, prior_corners)
+    params = None
+    if rect_corners:
+        corners = shrink_inside_mask(mask, rect_corners, settings['inset_interval'], settings['inset_white_threshold'], settings['extra_inset'])
+        params = rotate_crop_params(get_crop_params(mask, corners), Edge[settings['top_edge']])
+        params = {key: float(value) for key, value in params.items()}
+        params['detector'] = detector
+        params['confidence'] = confidence
+
+    if artifacts and not narrowed:
+        artifacts.write('crop', settings, params)
+    return params
+
+
+def can_compute_crop_params(image_params, scale, artifacts, prior_corners=None):
+    settings = read_crop_settings(image_params, scale)
+    if settings['max_prints'] > 1:
+        found, _ = artifacts.read('prints', settings)
+        return found or artifacts.read_mask('mask', settings) is not None
+    found, _ = artifacts.read('crop', settings)
+    return found or can_detect_without_image(settings, artifacts, prior_corners)
+
+
+def compute_print_crop_params(image, image_params, scale=1.0, artifacts=None):
+    # As compute_crop_params, for a frame with several prints in it: returns a list of crop params, one per print found
+    # (None for any that couldn't be cropped), each also recording which print it is (in reading order) and which edge
+    # was taken as its top
+    settings = read_crop_settings(image_params, scale)
+    if artifacts:
+        found, prints = artifacts.read('prints', settings)
+        if found:
+            return prints
+
+    mask = artifacts.read_mask('mask', settings) if artifacts else None
+    if mask is None:
+        img = cv2.imread(image) if isinstance(image, str) else image
+        mask = DetectionInput(img, settings, artifacts=artifacts).mask
+    prints = find_print_crops(mask, settings)
 
-def compute_crop_params(image_filepath, image_params):
-    top_edge_name = image_params.get('top_edge', 'top')
-    top_edge = Edge[top_edge_name] if top_edge_name else Edge.top
-
-    corner_size_factor = image_params.get('crop_corner_size_factor', CORNER_SIZE_FACTOR)
-    key_range_h = image_params.get('crop_key_range_h', KEY_RANGE_HSV[0])
-    key_range_s = image_params.get('crop_key_range_s', KEY_RANGE_HSV[1])
-    key_range_v = image_params.get('crop_key_range_v', KEY_RANGE_HSV[2])
-    erosion_size = image_params.get('crop_erosion_size', EROSION_SIZE)
-    dilation_size = image_params.get('crop_dilation_size', DILATION_SIZE)
-
-    min_line_length_factor = image_params.get('crop_min_line_length_factor', MIN_LINE_LENGTH_FACTOR)
-    max_line_gap_factor = image_params.get('crop_max_line_gap_factor', MAX_LINE_GAP_FACTOR)
-    max_inclination_deg = image_params.get('crop_max_inclination_deg', MAX_INCLINATION_DEG)
-    line_exclusion_size_factor = image_params.get('crop_line_exclusion_size_factor', LINE_EXCLUSION_SIZE_FACTOR)
-    num_clusters = image_params.get('crop_num_clusters', NUM_CLUSTERS)
-    cluster_merge_threshold_size_factor = image_params.get('crop_cluster_merge_threshold_size_factor', CLUSTER_MERGE_THRESHOLD_SIZE_FACTOR)
-
-    inset_interval = image_params.get('crop_inset_interval', INSET_INTERVAL)
-    inset_white_threshold = image_params.get('crop_inset_white_threshold', INSET_WHITE_THRESHOLD)
-    extra_inset = image_params.get('crop_extra_inset', EXTRA_INSET)
-
-    img = cv2.imread(image_filepath)
-    mask = get_background_mask(img, corner_size_factor, [key_range_h, key_range_s, key_range_v], erosion_size, dilation_size)
-    rect_corners = find_rectilinear_corners(mask, min_line_length_factor, max_line_gap_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor)
-    if not rect_corners:
-        return None
-
-    corners = shrink_inside_mask(mask, rect_corners, inset_interval, inset_white_threshold, extra_inset)
-    params = get_crop_params(img, corners)
-    return rotate_crop_params(params, top_edge)
+    if artifacts:
+        artifacts.write('prints', settings, prints)
+    return prints
@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+
+import cv2
+
+from forsythe.images.locks import get_temp_filepath
+
+# Each stage's output is keyed by the key of the stage before it plus only the settings that it consumes, so that
+# changing e.g. the inset invalidates the final crop but leaves the mask, lines and corners that fed it alone
+__artifact_stages__ = ['mask', 'lines', 'corners', 'crop', 'prints']
+__stage_settings__ = {
+    'mask': ['corner_size_factor', 'key_color_hsv', 'key_range_hsv', 'erosion_size', 'dilation_size'],
+    'lines': ['min_line_length_factor', 'max_line_gap_factor', 'line_roi', 'max_inclination_deg', 'line_exclusion_size_factor', 'line_prior_margin_size_factor'],
+    'corners': [
+        'detector', 'auto_detectors', 'min_confidence', 'min_area_ratio', 'max_area_ratio', 'score_long_side', 'score_edge_offset', 'score_edge_samples',
+        'max_inclination_deg', 'line_exclusion_size_factor', 'num_clusters', 'cluster_merge_threshold_size_factor',
+        'coarse_level', 'refine_band_coarse_pixels', 'refine_mask_band_size_factor', 'refine_num_samples', 'refine_min_sample_fraction',
+        'projection_coarse_step_deg', 'projection_fine_step_deg', 'projection_search_long_side', 'projection_edge_threshold', 'projection_min_size_factor',
+    ],
+    'crop': ['inset_interval', 'inset_white_threshold', 'extra_inset', 'top_edge'],
+    # Every print in a frame with several of them, for when max_prints is more than 1
+    'prints': ['max_prints', 'min_print_area_ratio', 'print_top_edges'],
+}
+
+
+def get_stage_key(stage, settings, source):
+    key = source
+    for s in __artifact_stages__[:__artifact_stages__.index(stage) + 1]:
+        stage_settings = {name: settings[name] for name in __stage_settings__[s]}
+        key = hashlib.sha1(json.dumps([key, stage_settings], sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return key
+
+
+class CropArtifacts(object):
+    # The latest output of each stage of the crop pipeline for a single image, as found from a single source image (i.e.
+    # one decode of one raw). Only one output is kept per stage: a rerun with the same settings as last time finds it,
+    # and a rerun with any other settings replaces it.
+
+    def __init__(self, dirpath, source):
+        self.dirpath = dirpath
+        self.source = source
+
+    def get_filepath(self, stage, ext):
+        return os.path.join(self.dirpath, stage + ext)
+
+    def read_record(self, stage, settings):
+        filepath = self.get_filepath(stage, '.json')
+        if not os.path.isfile(filepath):
+            return None
+        try:
+            with open(filepath) as fp:
+                record = json.load(fp)
+        except ValueError:
+            return None
+        return record if record.get('key') == get_stage_key(stage, settings, self.source) else None
+
+    def read(self, stage, settings):
+        # Returns (found, value), since None is itself a valid result for some stages (e.g. no corners found)
+        record = self.read_record(stage, settings)
+        if record is None:
+            return False, None
+        return True, record['value']
+
+    def read_latest(self, stage):
+        # The stage's output as last found, whatever settings it was found with
+        filepath = self.get_filepath(stage, '.json')
+        if not os.path.isfile(filepath):
+            return None
+        try:
+            with open(filepath) as fp:
+                return json.load(fp).get('value')
+        except ValueError:
+            return None
+
+    def read_mask(self, stage, settings):
+        record = self.read_record(stage, settings)
+        if record is None or not record.get('mask'):
+            return None
+        return cv2.imread(self.get_filepath(stage, '.png'), cv2.IMREAD_GRAYSCALE)
+
+    def write(self, stage, settings, value, mask=None):
+        # The mask goes first, and the record last: a record is never visible without the mask it refers to
+        os.makedirs(self.dirpath, exist_ok=True)
+        if mask is not None:
+            png_filepath = self.get_filepath(stage, '.png')
+            tmp_png_filepath = get_temp_filepath(png_filepath)
+            cv2.imwrite(tmp_png_filepath, mask, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            os.replace(tmp_png_filepath, png_filepath)
+
+        filepath = self.get_filepath(stage, '.json')
+        tmp_filepath = get_temp_filepath(filepath)
+        with open(tmp_filepath, 'w') as fp:
+            json.dump({'key': get_stage_key(stage, settings, self.source), 'value': value, 'mask': mask is not None}, fp)
+        os.replace(tmp_filepath, filepath)
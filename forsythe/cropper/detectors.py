@@ -0,0 +1,289 @@
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from forsythe.cropper.types import Corner
+from forsythe.cropper.mask import get_key_color_from_corners, get_color_mask, denoise, get_background_mask
+from forsythe.cropper.rect import detect_lines, detect_border_lines, sort_edge_lines, find_corners_from_edge_lines, make_rectilinear
+from forsythe.cropper.refine import find_coarse_to_fine_corners
+from forsythe.cropper.projection import find_projection_corners
+
+__detectors__ = OrderedDict()
+
+
+def register_detector(name):
+    def decorator(func):
+        __detectors__[name] = func
+        return func
+    return decorator
+
+
+def get_detector_names():
+    return list(__detectors__.keys())
+
+
+def find_lines(mask, settings, prior_corners=None):
+    s = settings
+    if not s['line_roi']:
+        return detect_lines(mask, s['min_line_length_factor'], s['max_line_gap_factor'])
+    return detect_border_lines(mask, s['min_line_length_factor'], s['max_line_gap_factor'], s['max_inclination_deg'], s['line_exclusion_size_factor'], prior_corners, s['line_prior_margin_size_factor'])
+
+
+def find_edge_lines_in(lines, mask, settings):
+    s = settings
+    return sort_edge_lines(lines, mask.shape[1], mask.shape[0], s['max_inclination_deg'], s['line_exclusion_size_factor'], s['num_clusters'], s['cluster_merge_threshold_size_factor'])
+
+
+class DetectionInput(object):
+
+    def __init__(self, img, settings, mask=None, artifacts=None, prior_corners=None):
+        self.img = img
+        self.settings = settings
+        self.artifacts = artifacts
+        self.prior_corners = prior_corners
+        # Whether the lines were found in bands narrowed by prior_corners, rather than across the full bands
+        self.narrowed = False
+        self._mask = mask
+        self._lines = None
+        self._score_mask = None
+
+    @property
+    def mask(self):
+        # Full-resolution background mask: computed on first use (unless it's been persisted from an earlier run), then
+        # shared by every detector that's tried
+        if self._mask is None and self.artifacts:
+            self._mask = self.artifacts.read_mask('mask', self.settings)
+        if self._mask is None:
+            s = self.settings
+            self._mask = get_background_mask(self.img, s['corner_size_factor'], s['key_range_hsv'], s['erosion_size'], s['dilation_size'], s['key_color_hsv'])
+            if self.artifacts:
+                self.artifacts.write('mask', self.settings, None, self._mask)
+        return self._mask
+
+    @property
+    def lines(self):
+        if self._lines is None and self.artifacts:
+            found, value = self.artifacts.read('lines', self.settings)
+            if found:
+                self._lines = [((x0, y0), (x1, y1)) for x0, y0, x1, y1 in value]
+        if self._lines is None:
+            self._lines = find_lines(self.mask, self.settings, self.prior_corners)
+            self.narrowed = bool(self.prior_corners)
+            if self.narrowed and not find_edge_lines_in(self._lines, self.mask, self.settings):
+                # The print has moved too far since the previous frame to be found near where it was
+                self._lines = find_lines(self.mask, self.settings)
+                self.narrowed = False
+            # Lines found in bands narrowed by the prior depend on the prior as well as the settings, and the key only
+            # covers the settings: only lines from the full bands are persisted
+            if self.artifacts and not self.narrowed:
+                self.artifacts.write('lines', self.settings, [[int(x0), int(y0), int(x1), int(y1)] for (x0, y0), (x1, y1) in self._lines])
+        return self._lines
+
+    @property
+    def edge_lines(self):
+        return find_edge_lines_in(self.lines, self.mask, self.settings)
+
+    @property
+    def score_mask(self):
+        # Detections are scored against a small mask of their own, so that a detector that never needed the full mask
+        # (i.e. coarse-to-fine) doesn't have to pay for one just to be scored
+        if self._score_mask is None:
+            s = self.settings
+            full = self._mask if self._mask is not None else self.img
+            height, width = full.shape[0], full.shape[1]
+            scale = min(1.0, float(s['score_long_side']) / max(height, width))
+            size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+            if self._mask is not None:
+                # Downscaling the full mask, if there is one, is cheaper than keying the image again
+                mask = cv2.threshold(cv2.resize(self._mask, size, interpolation=cv2.INTER_AREA), 127, 255, cv2.THRESH_BINARY)[1]
+            else:
+                key_color_hsv = s['key_color_hsv'] or get_key_color_from_corners(self.img, s['corner_size_factor'])
+                mask = get_color_mask(cv2.resize(self.img, size, interpolation=cv2.INTER_AREA), key_color_hsv, s['key_range_hsv'])
+                mask = denoise(mask, int(round(s['erosion_size'] * scale)), int(round(s['dilation_size'] * scale)))
+            self._score_mask = mask, scale
+        return self._score_mask
+
+
+def order_box_points(points):
+    # Works for any rotation short of 45 degrees, which is well beyond the inclinations we ever see
+    sums = [x + y for x, y in points]
+    diffs = [x - y for x, y in points]
+    to_tuple = lambda p: (float(p[0]), float(p[1]))
+    return {
+        Corner.top_left: to_tuple(points[int(np.argmin(sums))]),
+        Corner.top_right: to_tuple(points[int(np.argmax(diffs))]),
+        Corner.bottom_left: to_tuple(points[int(np.argmin(diffs))]),
+        Corner.bottom_right: to_tuple(points[int(np.argmax(sums))]),
+    }
+
+
+@register_detector('contour')
+def detect_contour(inp):
+    # The minimum-area rectangle around the largest blob of subject: near-instant, and exact for a clean print on a
+    # clean backdrop, but thrown off by anything else that touches the print, so it relies on scoring to catch that
+    subject = cv2.bitwise_not(inp.mask)
+    contours = cv2.findContours(subject, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if not contours:
+        return None, inp.mask
+    contour = max(contours, key=cv2.contourArea)
+    return order_box_points(cv2.boxPoints(cv2.minAreaRect(contour))), inp.mask
+
+
+@register_detector('hough')
+def detect_hough(inp):
+    s = inp.settings
+    if s['coarse_level'] > 0:
+        return find_coarse_to_fine_corners(inp.img, s['coarse_level'], s['corner_size_factor'], s['key_range_hsv'], s['erosion_size'], s['dilation_size'], s['min_line_length_factor'], s['max_line_gap_factor'], s['max_inclination_deg'], s['line_exclusion_size_factor'], s['num_clusters'], s['cluster_merge_threshold_size_factor'], s['refine_band_coarse_pixels'], s['refine_mask_band_size_factor'], s['refine_num_samples'], s['refine_min_sample_fraction'], s['key_color_hsv'])
+    corners = find_corners_from_edge_lines(inp.edge_lines)
+    return (make_rectilinear(corners) if corners else None), inp.mask
+
+
+@register_detector('projection')
+def detect_projection(inp):
+    s = inp.settings
+    return find_projection_corners(inp.mask, s['max_inclination_deg'], s['projection_coarse_step_deg'], s['projection_fine_step_deg'], s['projection_search_long_side'], s['projection_edge_threshold'], s['projection_min_size_factor']), inp.mask
+
+
+def score_edges(score_mask, quad, offset, num_samples):
+    # For each edge, how consistently there's subject just inside it and background just outside it: the worst edge is
+    # what counts, since e.g. a tab sticking out past one side only ever throws off that one
+    height, width = score_mask.shape[0], score_mask.shape[1]
+    center = quad.mean(axis=0)
+    ts = np.linspace(0.1, 0.9, num_samples)[:, None]
+    scores = []
+    for i in range(4):
+        p0, p1 = quad[i], quad[(i + 1) % 4]
+        points = p0 + (p1 - p0) * ts
+        normal = np.array([p0[1] - p1[1], p1[0] - p0[0]])
+        normal /= max(1e-6, np.hypot(normal[0], normal[1]))
+        if np.dot(center - p0, normal) < 0.0:
+            normal = -normal
+
+        sample = lambda pts: score_mask[np.clip(np.round(pts[:, 1]).astype(int), 0, height - 1), np.clip(np.round(pts[:, 0]).astype(int), 0, width - 1)]
+        inside = np.mean(sample(points + normal * offset) == 0)
+        outside = np.mean(sample(points - normal * offset) != 0)
+        scores.append(inside * outside)
+    return min(scores)
+
+
+def score_corners(score_mask, scale, corners, min_area_ratio, max_area_ratio, edge_offset, num_edge_samples):
+    # Between 0 and 1, taking the worst of: the fraction of the crop rectangle that's filled by subject (i.e. how
+    # rectangular the subject is); the fraction of all the subject in the mask that falls inside the rectangle; and how
+    # well each edge of the rectangle agrees with the mask. 0 if the rectangle is implausibly small or large for a print.
+    quad = np.array([corners[c] for c in (Corner.top_left, Corner.top_right, Corner.bottom_right, Corner.bottom_left)], dtype=np.float64) * scale
+    inside = np.zeros(score_mask.shape, dtype=np.uint8)
+    cv2.fillConvexPoly(inside, np.round(quad * 16.0).astype(np.int32), 255, cv2.LINE_8, 4)
+    inside = inside > 0
+    subject = score_mask == 0
+
+    quad_area = np.count_nonzero(inside)
+    area_ratio = quad_area / float(score_mask.size)
+    if quad_area == 0 or area_ratio < min_area_ratio or area_ratio > max_area_ratio:
+        return 0.0
+
+    subject_inside = np.count_nonzero(inside & subject)
+    fill = subject_inside / float(quad_area)
+    coverage = subject_inside / float(max(1, np.count_nonzero(subject)))
+    return float(min(fill, coverage, score_edges(score_mask, quad, edge_offset, num_edge_samples)))
+
+
+def get_detector_chain(detector, auto_detectors):
+    if detector == 'auto':
+        return auto_detectors
+    if detector not in __detectors__:
+        raise ValueError('Unsupported crop detector: %s' % detector)
+    return [detector]
+
+
+def run_detector_chain(inp):
+    # Returns (corners, mask, detector_name, confidence), trying each detector in the chain in turn until one is
+    # confident enough in its result: if none of them are, the most confident result of any of them is used
+    settings = inp.settings
+    best = (None, None, None, 0.0)
+    for name in get_detector_chain(settings['detector'], settings['auto_detectors']):
+        corners, mask = __detectors__[name](inp)
+        if not corners:
+            continue
+        score_mask, scale = inp.score_mask
+        confidence = score_corners(score_mask, scale, corners, settings['min_area_ratio'], settings['max_area_ratio'], settings['score_edge_offset'], settings['score_edge_samples'])
+        if best[0] is None or confidence > best[3]:
+            best = (corners, mask, name, confidence)
+        if confidence >= settings['min_confidence']:
+            break
+    return best
+
+
+def run_detectors(img, settings, mask=None):
+    return run_detector_chain(DetectionInput(img, settings, mask))
+
+
+def dump_corners(corners):
+    return {corner.name: [float(p[0]), float(p[1])] for corner, p in corners.items()} if corners else None
+
+
+def load_corners(value):
+    return {Corner[name]: tuple(p) for name, p in value.items()}
+
+
+def read_corners_record(artifacts, settings, prior_corners):
+    # As artifacts.read('corners', settings), except that corners found from lines narrowed by a prior are only current
+    # for that same prior: the stage key only covers the settings, so the prior they were found with is kept alongside
+    found, value = artifacts.read('corners', settings)
+    if found and value and value.get('prior') and value['prior'] != dump_corners(prior_corners):
+        return False, None
+    return found, value
+
+
+def detect_corners(img, settings, artifacts=None, prior_corners=None):
+    # As run_detectors, but going through the persisted output of an earlier run wherever it's still current: img is
+    # only touched if some stage actually has to be recomputed. Returns (corners, mask, detector_name, confidence,
+    # narrowed), the last being whether the corners depend on prior_corners as well as on the settings.
+    inp = DetectionInput(img, settings, artifacts=artifacts, prior_corners=prior_corners)
+    if artifacts:
+        found, value = read_corners_record(artifacts, settings, prior_corners)
+        if found:
+            if not value:
+                return None, None, None, 0.0, False
+            mask = artifacts.read_mask('corners', settings) if value['own_mask'] else inp.mask
+            return load_corners(value['corners']), mask, value['detector'], value['confidence'], bool(value.get('prior'))
+
+    corners, mask, name, confidence = run_detector_chain(inp)
+    if artifacts:
+        if not corners:
+            # Failing to find the print near where the prior put it says nothing about the settings alone
+            if not inp.narrowed:
+                artifacts.write('corners', settings, None)
+        else:
+            # Coarse-to-fine detection makes its own (banded) mask, which has to be kept alongside its corners
+            own_mask = mask is not inp._mask
+            value = {
+                'corners': dump_corners(corners),
+                'detector': name,
+                'confidence': confidence,
+                'own_mask': own_mask,
+                'prior': dump_corners(prior_corners) if inp.narrowed else None,
+            }
+            artifacts.write('corners', settings, value, mask if own_mask else None)
+    return corners, mask, name, confidence, inp.narrowed
+
+
+def read_prior_corners(artifacts, settings):
+    # The corners found for an image with its current settings, if any (whatever prior they were found with): for use as
+    # the prior for the next frame in the sequence
+    found, value = artifacts.read('corners', settings)
+    if not found or not value:
+        return None
+    return load_corners(value['corners'])
+
+
+def can_detect_without_image(settings, artifacts, prior_corners=None):
+    found, value = read_corners_record(artifacts, settings, prior_corners)
+    if not found:
+        return False
+    if not value:
+        return True
+    stage = 'corners' if value['own_mask'] else 'mask'
+    record = artifacts.read_record(stage, settings)
+    return record is not None and record.get('mask') and os.path.isfile(artifacts.get_filepath(stage, '.png'))
@@ -0,0 +1,176 @@
+import json
+import time
+import threading
+
+import cv2
+
+from forsythe.cropper.mask import get_key_color_from_corners, get_hsv_color_mask, denoise
+from forsythe.cropper.shrink import shrink_inside_mask
+from forsythe.cropper.artifacts import __stage_settings__
+from forsythe.cropper.detectors import DetectionInput, run_detector_chain, find_lines, find_edge_lines_in
+
+# The settings that each node consumes directly: a node's value is recomputed only when these, or those of a node
+# upstream of it, change
+__node_settings__ = [
+    ('key_color', ['corner_size_factor', 'key_color_hsv']),
+    ('color_mask', ['key_range_hsv']),
+    ('mask', ['erosion_size', 'dilation_size']),
+    ('lines', __stage_settings__['lines']),
+    ('edge_lines', ['max_inclination_deg', 'line_exclusion_size_factor', 'num_clusters', 'cluster_merge_threshold_size_factor']),
+    ('corners', __stage_settings__['corners']),
+    ('inset', ['inset_interval', 'inset_white_threshold', 'extra_inset']),
+]
+
+
+class Cancelled(Exception):
+    pass
+
+
+class GraphDetectionInput(DetectionInput):
+    # Hands detectors the graph's memoized mask, lines and clusters, rather than computing its own
+
+    def __init__(self, graph, settings):
+        super().__init__(graph.img, settings)
+        self.graph = graph
+
+    @property
+    def mask(self):
+        self._mask = self.graph.mask(self.settings)
+        return self._mask
+
+    @property
+    def lines(self):
+        return self.graph.lines(self.settings)
+
+    @property
+    def edge_lines(self):
+        return self.graph.edge_lines(self.settings)
+
+
+class CropGraph(object):
+    # The crop pipeline for a single image as a chain of memoized nodes, for interactive tuning: each node keeps its
+    # last value along with the settings it was computed from, so changing a late-stage setting (e.g. the inset) only
+    # reruns the nodes from that one on
+
+    def __init__(self, img):
+        self.img = img
+        self.hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        self.memo = {}
+        self.should_cancel = None
+
+    def get_node_key(self, node, settings):
+        names = []
+        for name, node_settings in __node_settings__:
+            names.extend(node_settings)
+            if name == node:
+                break
+        return json.dumps({name: settings[name] for name in names}, sort_keys=True)
+
+    def evaluate(self, node, settings, func):
+        key = self.get_node_key(node, settings)
+        memo = self.memo.get(node)
+        if memo is None or memo[0] != key:
+            # Checked between nodes, since a node that's already running can't be interrupted
+            if self.should_cancel and self.should_cancel():
+                raise Cancelled()
+            memo = self.memo[node] = (key, func())
+        return memo[1]
+
+    def key_color(self, settings):
+        return self.evaluate('key_color', settings, lambda: settings['key_color_hsv'] or get_key_color_from_corners(self.img, settings['corner_size_factor']))
+
+    def color_mask(self, settings):
+        return self.evaluate('color_mask', settings, lambda: get_hsv_color_mask(self.hsv, self.key_color(settings), settings['key_range_hsv']))
+
+    def mask(self, settings):
+        return self.evaluate('mask', settings, lambda: denoise(self.color_mask(settings), settings['erosion_size'], settings['dilation_size']))
+
+    def lines(self, settings):
+        return self.evaluate('lines', settings, lambda: find_lines(self.mask(settings), settings))
+
+    def edge_lines(self, settings):
+        return self.evaluate('edge_lines', settings, lambda: find_edge_lines_in(self.lines(settings), self.mask(settings), settings))
+
+    def corners(self, settings):
+        # (corners, mask, detector_name, confidence), as from run_detectors
+        return self.evaluate('corners', settings, lambda: run_detector_chain(GraphDetectionInput(self, settings)))
+
+    def inset(self, settings):
+        # (corners, detector_name, confidence), with corners shrunk inside the mask, or None if none were found
+        def func():
+            rect_corners, mask, detector, confidence = self.corners(settings)
+            if not rect_corners:
+                return None, detector, confidence
+            # shrink_inside_mask works in place: give it a copy, so that the memoized corners stay as they were found
+            corners = shrink_inside_mask(mask, dict(rect_corners), settings['inset_interval'], settings['inset_white_threshold'], settings['extra_inset'])
+            return corners, detector, confidence
+        return self.evaluate('inset', settings, func)
+
+
+class CropGraphWorker(object):
+    # Evaluates a CropGraph on a background thread, so that an interactive caller never blocks on it: each request
+    # supersedes any earlier one that hasn't finished (which is abandoned at the next node boundary), and isn't started
+    # until no newer request has arrived for debounce seconds, so that e.g. a held-down key only runs the last of them
+
+    def __init__(self, graph, debounce=0.05):
+        self.graph = graph
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        self.request = None
+        self.requested_at = 0.0
+        self.serial = 0
+        self.done_serial = 0
+        # (settings, with_corners, mask, inset, error) for the latest request to finish, or None until one has
+        self.result = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, settings, with_corners):
+        with self.condition:
+            if self.request and self.request[1] == settings and self.request[2] == with_corners:
+                return
+            self.serial += 1
+            self.request = (self.serial, settings, with_corners)
+            self.requested_at = time.time()
+            self.condition.notify()
+
+    @property
+    def busy(self):
+        return self.done_serial != self.serial
+
+    def wait_for_request(self):
+        with self.condition:
+            while not self.closed and self.done_serial == self.serial:
+                self.condition.wait()
+            while not self.closed and time.time() - self.requested_at < self.debounce:
+                self.condition.wait(self.debounce - (time.time() - self.requested_at))
+            return None if self.closed else self.request
+
+    def run(self):
+        while True:
+            request = self.wait_for_request()
+            if request is None:
+                return
+            serial, settings, with_corners = request
+
+            self.graph.should_cancel = lambda: serial != self.serial
+            try:
+                mask = self.graph.mask(settings)
+                inset = self.graph.inset(settings) if with_corners else None
+                result = (settings, with_corners, mask, inset, None)
+            except Cancelled:
+                continue
+            except Exception as exc:
+                result = (settings, with_corners, None, None, exc)
+
+            with self.condition:
+                self.result = result
+                self.done_serial = serial
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
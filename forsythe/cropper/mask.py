@@ -3,6 +3,10 @@ import numpy as np
 
 from forsythe.cropper.types import Corner
 
+# Keying converts and thresholds the image a strip of about this many pixels at a time, so that each strip's HSV copy is
+# still in cache when it's thresholded, rather than making a full-size HSV copy and then reading it all back
+__key_strip_pixels__ = 96 * 1024
+
 
 def crop_corners(img, size_factor):
     height, width = img.shape[0], img.shape[1]
@@ -32,10 +36,22 @@ def get_key_color_from_corners(img_bgr, size_factor):
     return [int(x) for x in np.mean(corner_colors_hsv, axis=0)]
 
 
+def get_hsv_range(key_color_hsv, range_hsv):
+    return np.clip(np.subtract(key_color_hsv, range_hsv), 0, 255), np.clip(np.add(key_color_hsv, range_hsv), 0, 255)
+
+
 def get_color_mask(img_bgr, key_color_hsv, range_hsv):
-    img_hsv = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2HSV)
-    range_lo_hsv = np.clip(np.subtract(key_color_hsv, range_hsv), 0, 255)
-    range_hi_hsv = np.clip(np.add(key_color_hsv, range_hsv), 0, 255)
+    range_lo_hsv, range_hi_hsv = get_hsv_range(key_color_hsv, range_hsv)
+    height, width = img_bgr.shape[0], img_bgr.shape[1]
+    mask = np.empty((height, width), dtype=np.uint8)
+    rows = max(1, __key_strip_pixels__ // max(1, width))
+    for y in range(0, height, rows):
+        cv2.inRange(cv2.cvtColor(img_bgr[y:y + rows], cv2.COLOR_BGR2HSV), range_lo_hsv, range_hi_hsv, dst=mask[y:y + rows])
+    return mask
+
+
+def get_hsv_color_mask(img_hsv, key_color_hsv, range_hsv):
+    range_lo_hsv, range_hi_hsv = get_hsv_range(key_color_hsv, range_hsv)
     return cv2.inRange(img_hsv, range_lo_hsv, range_hi_hsv)
 
 
@@ -52,7 +68,9 @@ def denoise(img_mask, erosion_size, dilation_size):
     return dilated
 
 
-def get_background_mask(img_bgr, corner_size_factor, key_range_hsv, erosion_size, dilation_size):
-    key_color_hsv = get_key_color_from_corners(img_bgr, corner_size_factor)
+def get_background_mask(img_bgr, corner_size_factor, key_range_hsv, erosion_size, dilation_size, key_color_hsv=None):
+    # key_color_hsv, if given, is the backdrop color as already known (e.g. from a background model), in place of an
+    # estimate from this image's own corners
+    key_color_hsv = key_color_hsv or get_key_color_from_corners(img_bgr, corner_size_factor)
     mask = get_color_mask(img_bgr, key_color_hsv, key_range_hsv)
     return denoise(mask, erosion_size, dilation_size)
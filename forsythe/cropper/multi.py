@@ -0,0 +1,78 @@
+import cv2
+
+from forsythe.cropper.types import Edge
+from forsythe.cropper.shrink import shrink_inside_mask
+from forsythe.cropper.output import get_crop_params, rotate_crop_params
+from forsythe.cropper.detectors import DetectionInput, run_detector_chain
+
+# Each print is fitted on its own crop of the mask, padded by this fraction of its long side (so that it doesn't fill
+# the crop, which scoring would take as implausibly large) but never by fewer than this many pixels
+__print_padding_size_factor__ = 0.05
+__min_print_padding__ = 8
+
+
+def find_print_components(mask, min_area_ratio, max_prints):
+    # Returns (labels, [(label, (x, y, width, height))]): the largest separate blobs of subject in the mask, up to
+    # max_prints of them, in reading order (top to bottom by row, then left to right)
+    subject = cv2.bitwise_not(mask)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(subject, connectivity=8)
+    min_area = mask.shape[0] * mask.shape[1] * min_area_ratio
+    found = [i for i in range(1, num_labels) if stats[i, cv2.CC_STAT_AREA] >= min_area]
+    found = sorted(found, key=lambda i: -stats[i, cv2.CC_STAT_AREA])[:max_prints]
+
+    # Prints whose centers fall within the top-to-bottom extent of a row's first print are in the same row
+    rows = []
+    for i in sorted(found, key=lambda i: centroids[i][1]):
+        if rows and centroids[i][1] <= stats[rows[-1][0], cv2.CC_STAT_TOP] + stats[rows[-1][0], cv2.CC_STAT_HEIGHT]:
+            rows[-1].append(i)
+        else:
+            rows.append([i])
+    ordered = [i for row in rows for i in sorted(row, key=lambda i: centroids[i][0])]
+
+    components = []
+    for i in ordered:
+        x, y, width, height = [int(v) for v in stats[i, :4]]
+        components.append((i, (x, y, width, height)))
+    return labels, components
+
+
+def get_print_mask(mask, labels, label, bbox):
+    # The mask cropped (with padding) around one print, with any other print that strays into the crop keyed out
+    x, y, width, height = bbox
+    pad = max(__min_print_padding__, int(max(width, height) * __print_padding_size_factor__))
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1, y1 = min(mask.shape[1], x + width + pad), min(mask.shape[0], y + height + pad)
+    print_mask = mask[y0:y1, x0:x1].copy()
+    crop_labels = labels[y0:y1, x0:x1]
+    print_mask[(crop_labels != label) & (crop_labels != 0)] = 255
+    return print_mask, (x0, y0)
+
+
+def find_print_crops(mask, settings):
+    # Returns a list of crop params (with detector and confidence) for each print found in the mask, in reading order: a
+    # print whose corners can't be found is None, rather than being left out, so that the prints after it keep their
+    # numbers (and their top edges). Each print gets its own run of the detector chain against its own crop of the mask: coarse-to-fine detection, which keys the image
+    # itself, is skipped, since its mask would take in any neighbouring prints.
+    print_settings = dict(settings, coarse_level=0)
+    top_edges = settings['print_top_edges']
+    labels, components = find_print_components(mask, settings['min_print_area_ratio'], settings['max_prints'])
+
+    results = []
+    for index, (label, bbox) in enumerate(components):
+        print_mask, (x0, y0) = get_print_mask(mask, labels, label, bbox)
+        rect_corners, _, detector, confidence = run_detector_chain(DetectionInput(None, print_settings, mask=print_mask))
+        if not rect_corners:
+            results.append(None)
+            continue
+
+        corners = shrink_inside_mask(print_mask, rect_corners, settings['inset_interval'], settings['inset_white_threshold'], settings['extra_inset'])
+        corners = {corner: (float(p[0]) + x0, float(p[1]) + y0) for corner, p in corners.items()}
+        top_edge = top_edges[index] if index < len(top_edges) else settings['top_edge']
+        params = rotate_crop_params(get_crop_params(mask, corners), Edge[top_edge])
+        params = {key: float(value) for key, value in params.items()}
+        params['detector'] = detector
+        params['confidence'] = confidence
+        params['print'] = index + 1
+        params['top_edge'] = top_edge
+        results.append(params)
+    return results
@@ -0,0 +1,187 @@
+import cv2
+import numpy as np
+
+from forsythe.cropper.types import Corner
+
+# Sobel gives a step from background to subject a gradient of 4: the skew search only looks at pixels with at least this
+__min_edge_gradient__ = 0.5
+
+# Each edge is refined at full resolution within a band this many search-scale pixels either side of where the
+# downscaled profiles put it
+__band_search_pixels__ = 3.0
+
+# The ends of each edge are left out of its band, so that a dog-eared or rounded corner doesn't drag the edge with it
+__band_end_margin__ = 0.05
+
+
+def get_rotation(shape, angle_deg):
+    # The same transform that rotating the image about its center by angle_deg would apply to its pixels
+    height, width = shape[0], shape[1]
+    return cv2.getRotationMatrix2D((width * 0.5, height * 0.5), angle_deg, 1.0)
+
+
+def transform_points(m, xs, ys):
+    return m[0, 0] * xs + m[0, 1] * ys + m[0, 2], m[1, 0] * xs + m[1, 1] * ys + m[1, 2]
+
+
+def get_search_subject(mask, search_long_side):
+    # (subject, scale): a downscaled copy of the mask as floats, 1.0 wherever it isn't background. It's shrunk by a whole
+    # factor, after trimming any remainder off the right and bottom, since OpenCV has a much faster path for that.
+    height, width = mask.shape[0], mask.shape[1]
+    factor = max(1, int(np.ceil(float(max(height, width)) / search_long_side)))
+    if factor > 1:
+        mask = mask[:height - height % factor, :width - width % factor]
+        mask = cv2.resize(mask, (mask.shape[1] // factor, mask.shape[0] // factor), interpolation=cv2.INTER_AREA)
+    return 1.0 - mask.astype(np.float32) / 255.0, 1.0 / factor
+
+
+def get_subject_gradients(subject):
+    # (xs, ys, gx, gy) for every pixel with a strong enough gradient to be on an edge of the subject, rather than on
+    # specks of it that the downscale has averaged away
+    gx = cv2.Sobel(subject, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(subject, cv2.CV_32F, 0, 1, ksize=3)
+    ys, xs = np.nonzero((np.abs(gx) + np.abs(gy)) > __min_edge_gradient__)
+    return xs.astype(np.float64), ys.astype(np.float64), gx[ys, xs].astype(np.float64), gy[ys, xs].astype(np.float64)
+
+
+def get_profile_differences(coords, weights):
+    bins = np.floor(coords - coords.min()).astype(np.intp)
+    return np.bincount(bins, weights)
+
+
+def score_projections(gradients, angle_deg):
+    # The row and column profiles are at their sharpest when the print's edges line up with the rows and columns: any
+    # skew smears each edge's step across several bins, which lowers the sum of squared differences. Each profile's
+    # differences are the subject's gradient along that axis, projected into the profile's bins: the gradient is only
+    # nonzero around the edges, so only those few pixels need projecting, rather than the whole image rotating.
+    xs, ys, gx, gy = gradients
+    a = np.deg2rad(angle_deg)
+    c, s = np.cos(a), np.sin(a)
+    cols = get_profile_differences(c * xs + s * ys, c * gx + s * gy)
+    rows = get_profile_differences(c * ys - s * xs, c * gy - s * gx)
+    return float(np.sum(cols ** 2) + np.sum(rows ** 2))
+
+
+def find_best_angle(gradients, angles_deg):
+    scores = [score_projections(gradients, angle) for angle in angles_deg]
+    return angles_deg[int(np.argmax(scores))]
+
+
+def find_skew_angle(mask, max_inclination_deg, coarse_step_deg, fine_step_deg, search_long_side, subject=None):
+    # Searched on a downscaled copy: a coarse pass over the full range of inclinations, then a fine pass around the best
+    if subject is None:
+        subject, _ = get_search_subject(mask, search_long_side)
+    gradients = get_subject_gradients(subject)
+    if len(gradients[0]) == 0:
+        return 0.0
+
+    coarse_angles = np.arange(-max_inclination_deg, max_inclination_deg + coarse_step_deg * 0.5, coarse_step_deg)
+    angle = find_best_angle(gradients, coarse_angles)
+    fine_angles = np.arange(angle - coarse_step_deg, angle + coarse_step_deg + fine_step_deg * 0.5, fine_step_deg)
+    return float(find_best_angle(gradients, fine_angles))
+
+
+def find_profile_extent(profile, edge_threshold):
+    # Walks in from either end to where the profile first reaches edge_threshold of its peak, interpolating between
+    # bins: returns the positions of those two crossings, or None if there's no subject in the profile at all
+    peak = profile.max()
+    if peak <= 0.0:
+        return None
+    level = peak * edge_threshold
+    above = np.nonzero(profile >= level)[0]
+    first, last = above[0], above[-1]
+
+    def crossing(i_out, i_in):
+        v_out, v_in = profile[i_out], profile[i_in]
+        return i_out + (i_in - i_out) * (level - v_out) / (v_in - v_out)
+
+    lo = crossing(first - 1, first) if first > 0 else 0.0
+    hi = crossing(last + 1, last) if last < len(profile) - 1 else float(len(profile) - 1)
+    return float(lo), float(hi)
+
+
+def find_coarse_extents(subject, scale, m, edge_threshold):
+    # ((u0, u1), (v0, v1)): the print's extent along each axis of the rotated frame, in full-resolution pixels, read off
+    # profiles of the downscaled subject that are binned at its own resolution
+    ys, xs = np.nonzero(subject > 0.0)
+    if len(xs) == 0:
+        return None
+    weights = subject[ys, xs].astype(np.float64)
+    us, vs = transform_points(m, (xs + 0.5) / scale - 0.5, (ys + 0.5) / scale - 0.5)
+
+    extents = []
+    for coords in (us, vs):
+        origin = coords.min()
+        extent = find_profile_extent(np.bincount(np.floor((coords - origin) * scale).astype(np.intp), weights), edge_threshold)
+        if not extent:
+            return None
+        extents.append(tuple(origin + (p + 0.5) / scale for p in extent))
+    return extents
+
+
+def refine_edge(mask, m, m_inv, axis, position, along, half_width, inside_high, edge_threshold):
+    # The edge of the subject nearest position along the given axis of the rotated frame (0 for u, 1 for v), found from
+    # a profile across a narrow band of full-resolution pixels around it. Each bin of the profile is the fraction of its
+    # pixels that are subject, so that bins don't need to hold equal numbers of pixels. None if there's no edge in the
+    # band, e.g. because the coarse pass was thrown off.
+    height, width = mask.shape[0], mask.shape[1]
+    offsets = np.arange(-half_width, half_width + 1, dtype=np.float64)
+    across, along = np.meshgrid(position + offsets, along)
+    us, vs = (across, along) if axis == 0 else (along, across)
+    xs, ys = transform_points(m_inv, us, vs)
+    xs = np.clip(np.round(xs), 0, width - 1).astype(np.intp).ravel()
+    ys = np.clip(np.round(ys), 0, height - 1).astype(np.intp).ravel()
+
+    coords = transform_points(m, xs, ys)[axis]
+    bins = np.floor(coords - (position - half_width - 1)).astype(np.intp)
+    counts = np.bincount(bins)
+    filled = counts > 0
+    fractions = np.bincount(bins, mask[ys, xs] == 0)[filled] / counts[filled]
+    centers = np.bincount(bins, coords)[filled] / counts[filled]
+    if not inside_high:
+        fractions, centers = fractions[::-1], centers[::-1]
+
+    above = np.nonzero(fractions >= edge_threshold)[0]
+    if len(above) == 0 or above[0] == 0:
+        return None
+    i = above[0]
+    t = (edge_threshold - fractions[i - 1]) / (fractions[i] - fractions[i - 1])
+    return float(centers[i - 1] + t * (centers[i] - centers[i - 1]))
+
+
+def find_projection_corners(mask, max_inclination_deg, coarse_step_deg, fine_step_deg, search_long_side, edge_threshold, min_size_factor):
+    # An alternative to find_rectilinear_corners for prints that are close to axis-aligned: finds the skew angle by
+    # scoring projections of the mask over a range of angles, then reads all four edges off the profiles of the mask
+    # along that angle. Nothing is ever rotated at full resolution: the edges are located on the downscaled copy the
+    # search ran on, and only refined in narrow bands of full-resolution pixels. The result is always a rectangle.
+    height, width = mask.shape[0], mask.shape[1]
+    subject, scale = get_search_subject(mask, search_long_side)
+    angle_deg = find_skew_angle(mask, max_inclination_deg, coarse_step_deg, fine_step_deg, search_long_side, subject)
+    m = get_rotation(mask.shape, angle_deg)
+    m_inv = cv2.invertAffineTransform(m)
+
+    extents = find_coarse_extents(subject, scale, m, edge_threshold)
+    if not extents:
+        return None
+    (x0, x1), (y0, y1) = extents
+    if x1 - x0 < width * min_size_factor or y1 - y0 < height * min_size_factor:
+        return None
+
+    half_width = int(np.ceil(__band_search_pixels__ / scale)) + 2
+    along_x = np.arange(x0 + (x1 - x0) * __band_end_margin__, x1 - (x1 - x0) * __band_end_margin__)
+    along_y = np.arange(y0 + (y1 - y0) * __band_end_margin__, y1 - (y1 - y0) * __band_end_margin__)
+    refined = [
+        refine_edge(mask, m, m_inv, 0, x0, along_y, half_width, True, edge_threshold),
+        refine_edge(mask, m, m_inv, 0, x1, along_y, half_width, False, edge_threshold),
+        refine_edge(mask, m, m_inv, 1, y0, along_x, half_width, True, edge_threshold),
+        refine_edge(mask, m, m_inv, 1, y1, along_x, half_width, False, edge_threshold),
+    ]
+    x0, x1, y0, y1 = [coarse if fine is None else fine for coarse, fine in zip((x0, x1, y0, y1), refined)]
+
+    unrotate = lambda p: tuple(float(v) for v in transform_points(m_inv, p[0], p[1]))
+    return {
+        Corner.top_left: unrotate((x0, y0)),
+        Corner.top_right: unrotate((x1, y0)),
+        Corner.bottom_left: unrotate((x0, y1)),
+        Corner.bottom_right: unrotate((x1, y1)),
+    }
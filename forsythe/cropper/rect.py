@@ -1,5 +1,4 @@
 import math
-from collections import defaultdict
 
 import cv2
 import numpy as np
@@ -18,7 +17,8 @@ def get_lines(lines_result):
     if lines_result is not None:
         for result in lines_result:
             assert len(result) == 1
-            x0, y0, x1, y1 = result[0]
+            # As Python ints, since intersecting lines multiplies coordinates together, which overflows int32
+            x0, y0, x1, y1 = [int(v) for v in result[0]]
             lines.append(((x0, y0), (x1, y1)))
     return lines
 
@@ -60,26 +60,16 @@ def find_vertical_and_horizontal(lines, max_inclination_deg, vertical_exclusion_
     return vertical, horizontal
 
 
-def find_clusters(lines, coord, num_clusters, merge_threshold):
-
-    class Cluster(object):
-        def __init__(self):
-            self.centers = []
-            self.labels = set()
-            self.count = 0
-
-        @property
-        def mean_center(self):
-            return np.mean(self.centers)
-
-        def add(self, center, label, count):
-            self.centers.append(center)
-            self.labels.add(label)
-            self.count += count
+def get_length(p0, p1):
+    (x0, y0), (x1, y1) = p0, p1
+    return math.hypot(x1 - x0, y1 - y0)
 
-        def should_merge(self, other_center, distance_threshold):
-            return abs(other_center - self.mean_center) <= distance_threshold
 
+def find_clusters(lines, coord, num_clusters, merge_threshold):
+    # Clusters are found deterministically, so that the same mask always crops the same way: the sorted coordinates are
+    # split at their num_clusters - 1 widest gaps, then neighbouring groups whose centers are within merge_threshold of
+    # one another are merged back together. Each line counts in proportion to its length, so a long edge outweighs any
+    # number of short fragments picked up from inside the image.
     if not lines:
         return [], []
 
@@ -87,42 +77,40 @@ def find_clusters(lines, coord, num_clusters, merge_threshold):
     data = np.float32(midpoints[:,coord])
     if len(data) < num_clusters:
         return [], []
+    weights = np.array([get_length(p0, p1) for p0, p1 in lines], dtype=np.float64)
 
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
-    flags = cv2.KMEANS_RANDOM_CENTERS
-    _, labels, centers = cv2.kmeans(data, num_clusters, None, criteria, 10, flags)
-
-    counts = defaultdict(int)
-    for label in labels:
-        counts[label[0]] += 1
+    order = np.argsort(data, kind='stable')
+    gaps = np.diff(data[order])
+    splits = np.sort(np.argsort(-gaps, kind='stable')[:max(0, num_clusters - 1)]) + 1
 
     clusters = []
-    for label, count in sorted(counts.items(), key=lambda v: -v[1]):
-        center = centers[label][0]
-        cluster = next((c for c in clusters if c.should_merge(center, merge_threshold)), None)
-        if not cluster:
-            cluster = Cluster()
-            clusters.append(cluster)
-        cluster.add(center, label, count)
+    for indices in np.split(order, splits):
+        weight = weights[indices].sum()
+        center = np.average(data[indices], weights=weights[indices]) if weight > 0.0 else np.mean(data[indices])
+        if clusters and abs(center - clusters[-1]['center']) <= merge_threshold:
+            cluster = clusters[-1]
+            total = cluster['weight'] + weight
+            if total > 0.0:
+                cluster['center'] = (cluster['center'] * cluster['weight'] + center * weight) / total
+            cluster['weight'] = total
+            cluster['indices'] = np.concatenate([cluster['indices'], indices])
+        else:
+            clusters.append({'center': center, 'weight': weight, 'indices': indices})
 
     if len(clusters) < 2:
         return [], []
 
-    clusters.sort(key=lambda c: -c.count)
-    if clusters[0].mean_center < clusters[1].mean_center:
+    # Stable, so that clusters of equal weight are taken in order of position
+    clusters = sorted(clusters, key=lambda c: -c['weight'])
+    if clusters[0]['center'] < clusters[1]['center']:
         min_cluster, max_cluster = clusters[:2]
     else:
         max_cluster, min_cluster = clusters[:2]
 
-    min_lines = []
-    max_lines = []
-    for i, label in enumerate(labels):
-        label = label[0]
-        if label in min_cluster.labels:
-            min_lines.append(lines[i])
-        elif label in max_cluster.labels:
-            max_lines.append(lines[i])
-
+    min_indices = set(min_cluster['indices'].tolist())
+    max_indices = set(max_cluster['indices'].tolist())
+    min_lines = [line for i, line in enumerate(lines) if i in min_indices]
+    max_lines = [line for i, line in enumerate(lines) if i in max_indices]
     return min_lines, max_lines
 
 
@@ -142,14 +130,85 @@ def get_extremes(lines, coord):
     return min_line, max_line
 
 
-def find_edge_lines(mask, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor):
+def detect_lines(mask, min_length_size_factor, max_gap_size_factor):
     height, width = mask.shape[0], mask.shape[1]
     long_side = max(height, width)
 
     min_line_length = max(1, long_side * min_length_size_factor)
     max_line_gap = max(1, long_side * max_gap_size_factor)
     edges = cv2.Canny(mask, 50, 150)
-    lines = get_lines(cv2.HoughLinesP(edges, 1, np.pi / 180.0, 15, np.array([]), min_line_length, max_line_gap))
+    return get_lines(cv2.HoughLinesP(edges, 1, np.pi / 180.0, 15, np.array([]), min_line_length, max_line_gap))
+
+
+def get_border_rois(width, height, line_exclusion_size_factor, prior_corners=None, prior_margin_size_factor=0.0):
+    # Returns {edge: (x0, y0, x1, y1)}: the region searched for each edge's lines, i.e. that edge's side of the central
+    # exclusion band, narrowed (given the corners found in the previous frame) to a margin around where it was last time
+    long_side = max(height, width)
+    exclusion_extent = long_side * line_exclusion_size_factor * 0.5
+    rois = {
+        Edge.left: [0, 0, width // 2 - exclusion_extent, height],
+        Edge.right: [width // 2 + exclusion_extent, 0, width, height],
+        Edge.top: [0, 0, width, height // 2 - exclusion_extent],
+        Edge.bottom: [0, height // 2 + exclusion_extent, width, height],
+    }
+    if prior_corners:
+        margin = long_side * prior_margin_size_factor
+        for edge, (corner_a, corner_b) in [
+            (Edge.left, (Corner.top_left, Corner.bottom_left)),
+            (Edge.right, (Corner.top_right, Corner.bottom_right)),
+            (Edge.top, (Corner.top_left, Corner.top_right)),
+            (Edge.bottom, (Corner.bottom_left, Corner.bottom_right)),
+        ]:
+            (xa, ya), (xb, yb) = prior_corners[corner_a], prior_corners[corner_b]
+            roi = rois[edge]
+            rois[edge] = [max(roi[0], min(xa, xb) - margin), max(roi[1], min(ya, yb) - margin), min(roi[2], max(xa, xb) + margin), min(roi[3], max(ya, yb) + margin)]
+
+    results = {}
+    for edge, (x0, y0, x1, y1) in rois.items():
+        x0, y0 = max(0, int(math.floor(x0))), max(0, int(math.floor(y0)))
+        x1, y1 = min(width, int(math.ceil(x1))), min(height, int(math.ceil(y1)))
+        if x1 - x0 >= 2 and y1 - y0 >= 2:
+            results[edge] = (x0, y0, x1, y1)
+    return results
+
+
+def get_transition_edges(mask, vertical):
+    # Edge pixels for edges running in one direction only: for near-vertical edges, the pixels whose neighbour to the
+    # right differs from them. An edge running the other way only shows up as the odd isolated step, so Hough is only
+    # ever given the edges it's looking for.
+    edges = np.zeros(mask.shape, dtype=np.uint8)
+    if vertical:
+        edges[:, :-1] = np.not_equal(mask[:, :-1], mask[:, 1:])
+    else:
+        edges[:-1] = np.not_equal(mask[:-1], mask[1:])
+    return edges * np.uint8(255)
+
+
+def detect_border_lines(mask, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, prior_corners=None, prior_margin_size_factor=0.0):
+    # As detect_lines, but only looking for each edge in its own region (see get_border_rois), and only keeping lines
+    # within max_inclination_deg of that edge's direction: most of the mask, including everything inside the print,
+    # is never searched at all
+    height, width = mask.shape[0], mask.shape[1]
+    long_side = max(height, width)
+
+    min_line_length = max(1, long_side * min_length_size_factor)
+    max_line_gap = max(1, long_side * max_gap_size_factor)
+    lines = []
+    for edge, (x0, y0, x1, y1) in get_border_rois(width, height, line_exclusion_size_factor, prior_corners, prior_margin_size_factor).items():
+        vertical = edge in (Edge.left, Edge.right)
+        edges = get_transition_edges(mask[y0:y1, x0:x1], vertical)
+        for (lx0, ly0), (lx1, ly1) in get_lines(cv2.HoughLinesP(edges, 1, np.pi / 180.0, 15, np.array([]), min_line_length, max_line_gap)):
+            inclination_deg = abs(np.degrees(math.atan2(ly1 - ly0, lx1 - lx0)))
+            if vertical and abs(inclination_deg - 90.0) > max_inclination_deg:
+                continue
+            if not vertical and min(inclination_deg, 180.0 - inclination_deg) > max_inclination_deg:
+                continue
+            lines.append(((lx0 + x0, ly0 + y0), (lx1 + x0, ly1 + y0)))
+    return lines
+
+
+def sort_edge_lines(lines, width, height, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor):
+    long_side = max(height, width)
 
     exclusion_extent = long_side * line_exclusion_size_factor * 0.5
     vertical_exclusion_x_range = (width // 2 - exclusion_extent, width // 2 + exclusion_extent)
@@ -170,6 +229,11 @@ def find_edge_lines(mask, min_length_size_factor, max_gap_size_factor, max_incli
     }
 
 
+def find_edge_lines(mask, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor):
+    lines = detect_lines(mask, min_length_size_factor, max_gap_size_factor)
+    return sort_edge_lines(lines, mask.shape[1], mask.shape[0], max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor)
+
+
 def line_intersection(line_a, line_b):
     p0, p1 = line_a
     p2, p3 = line_b
@@ -185,6 +249,10 @@ def line_intersection(line_a, line_b):
 
 def find_corners(mask, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor):
     edge_lines = find_edge_lines(mask, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor)
+    return find_corners_from_edge_lines(edge_lines)
+
+
+def find_corners_from_edge_lines(edge_lines):
     if not edge_lines:
         return None
 
@@ -249,7 +317,10 @@ def find_rectilinear_corners(mask, min_length_size_factor, max_gap_size_factor,
     corners = find_corners(mask, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor)
     if not corners:
         return None
+    return make_rectilinear(corners)
+
 
+def make_rectilinear(corners):
     edges = {
         Edge.left: (corners[Corner.top_left], corners[Corner.bottom_left]),
         Edge.right: (corners[Corner.top_right], corners[Corner.bottom_right]),
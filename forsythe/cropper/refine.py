@@ -0,0 +1,144 @@
+import math
+
+import cv2
+import numpy as np
+
+from forsythe.cropper.types import Corner, Edge
+from forsythe.cropper.mask import get_key_color_from_corners, get_color_mask, denoise
+from forsythe.cropper.rect import find_corners, make_rectilinear
+
+
+def downscale(img, level):
+    for _ in range(level):
+        img = cv2.resize(img, (max(1, img.shape[1] // 2), max(1, img.shape[0] // 2)), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def scale_corners(corners, factor):
+    return {corner: (p[0] * factor, p[1] * factor) for corner, p in corners.items()}
+
+
+def get_edge_points(corners):
+    return {
+        Edge.left: (corners[Corner.top_left], corners[Corner.bottom_left]),
+        Edge.right: (corners[Corner.top_right], corners[Corner.bottom_right]),
+        Edge.top: (corners[Corner.top_left], corners[Corner.top_right]),
+        Edge.bottom: (corners[Corner.bottom_left], corners[Corner.bottom_right]),
+    }
+
+
+def get_band_rect(p0, p1, half_width, width, height):
+    xs = [p0[0], p1[0]]
+    ys = [p0[1], p1[1]]
+    x0 = max(0, int(math.floor(min(xs) - half_width)))
+    y0 = max(0, int(math.floor(min(ys) - half_width)))
+    x1 = min(width, int(math.ceil(max(xs) + half_width)) + 1)
+    y1 = min(height, int(math.ceil(max(ys) + half_width)) + 1)
+    return x0, y0, x1, y1
+
+
+def get_banded_mask(img, edge_points, half_width, key_color_hsv, key_range_hsv, erosion_size, dilation_size):
+    # A full-size mask, but with the background key only evaluated in a band around each edge: everything else is left
+    # at 0, i.e. treated as part of the subject
+    height, width = img.shape[0], img.shape[1]
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for p0, p1 in edge_points.values():
+        x0, y0, x1, y1 = get_band_rect(p0, p1, half_width, width, height)
+        if x1 > x0 and y1 > y0:
+            band = denoise(get_color_mask(img[y0:y1, x0:x1], key_color_hsv, key_range_hsv), erosion_size, dilation_size)
+            mask[y0:y1, x0:x1] = np.maximum(mask[y0:y1, x0:x1], band)
+    return mask
+
+
+def find_subpixel_edge_points(mask, p0, p1, half_width, num_samples):
+    # Samples the mask along short profiles perpendicular to the edge, and finds where each one crosses from background
+    # to subject by linearly interpolating across the 50% level
+    length = math.hypot(p1[0] - p0[0], p1[1] - p0[1])
+    if length == 0.0:
+        return np.zeros((0, 2), dtype=np.float32)
+    dx, dy = (p1[0] - p0[0]) / length, (p1[1] - p0[1]) / length
+    nx, ny = -dy, dx
+
+    # Stay clear of the corners, where the profiles would cross the adjoining edge
+    ts = np.linspace(0.1, 0.9, num_samples) * length
+    ss = np.arange(-half_width, half_width + 1, dtype=np.float32)
+    map_x = (p0[0] + ts[:, None] * dx + ss[None, :] * nx).astype(np.float32)
+    map_y = (p0[1] + ts[:, None] * dy + ss[None, :] * ny).astype(np.float32)
+    profiles = cv2.remap(mask, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE).astype(np.float32) / 255.0 - 0.5
+
+    points = []
+    for i in range(num_samples):
+        profile = profiles[i]
+        crossings = np.nonzero(np.signbit(profile[:-1]) != np.signbit(profile[1:]))[0]
+        if len(crossings) == 0:
+            continue
+        # Of all the crossings, the one nearest the coarse estimate is the edge; the rest are noise in the mask
+        j = crossings[np.argmin(np.abs(ss[crossings] + 0.5))]
+        s = ss[j] + profile[j] / (profile[j] - profile[j + 1])
+        points.append((map_x[i, 0] + (s - ss[0]) * nx, map_y[i, 0] + (s - ss[0]) * ny))
+    return np.array(points, dtype=np.float32)
+
+
+def fit_edge_line(points):
+    vx, vy, x0, y0 = cv2.fitLine(points, cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+    return (float(x0), float(y0)), (float(x0 + vx), float(y0 + vy))
+
+
+def intersect_lines(line_a, line_b):
+    # Like rect.line_intersection, but without rounding to whole pixels
+    (x0, y0), (x1, y1) = line_a
+    (x2, y2), (x3, y3) = line_b
+    denom = (x0 - x1) * (y2 - y3) - (y0 - y1) * (x2 - x3)
+    if denom == 0.0:
+        return None
+    a = x0 * y1 - y0 * x1
+    b = x2 * y3 - y2 * x3
+    return ((a * (x2 - x3) - (x0 - x1) * b) / denom, (a * (y2 - y3) - (y0 - y1) * b) / denom)
+
+
+def refine_corners(mask, corners, half_width, num_samples, min_sample_fraction):
+    edge_lines = {}
+    for edge, (p0, p1) in get_edge_points(corners).items():
+        points = find_subpixel_edge_points(mask, p0, p1, half_width, num_samples)
+        # Not enough of the edge was found in the band (e.g. it's hidden under a fold): keep the coarse estimate
+        if len(points) < max(2, int(num_samples * min_sample_fraction)):
+            edge_lines[edge] = (p0, p1)
+        else:
+            edge_lines[edge] = fit_edge_line(points)
+
+    refined = {}
+    for corner, (edge_a, edge_b) in [
+      (Corner.top_left, (Edge.top, Edge.left)),
+      (Corner.top_right, (Edge.top, Edge.right)),
+      (Corner.bottom_left, (Edge.bottom, Edge.left)),
+      (Corner.bottom_right, (Edge.bottom, Edge.right)),
+    ]:
+        refined[corner] = intersect_lines(edge_lines[edge_a], edge_lines[edge_b])
+        if refined[corner] is None:
+            return None
+    return refined
+
+
+def find_coarse_to_fine_corners(img, coarse_level, corner_size_factor, key_range_hsv, erosion_size, dilation_size, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor, band_coarse_pixels, mask_band_size_factor, num_samples, min_sample_fraction, key_color_hsv=None):
+    # Returns (corners, mask): corners found on a downscaled copy of the image, then refined to sub-pixel accuracy
+    # against a full-resolution mask that's only ever computed in narrow bands around each edge
+    factor = 2 ** coarse_level
+    key_color_hsv = key_color_hsv or get_key_color_from_corners(img, corner_size_factor)
+
+    coarse = downscale(img, coarse_level)
+    coarse_mask = denoise(get_color_mask(coarse, key_color_hsv, key_range_hsv), int(round(erosion_size / float(factor))), int(round(dilation_size / float(factor))))
+    coarse_corners = find_corners(coarse_mask, min_length_size_factor, max_gap_size_factor, max_inclination_deg, line_exclusion_size_factor, num_clusters, cluster_merge_threshold_size_factor)
+    if not coarse_corners:
+        return None, None
+
+    # The mask band is wider than the band searched for edges, so that shrinking inside the mask afterwards still sees
+    # any background (e.g. a dog-eared corner) a little way in from the edge
+    corners = scale_corners(coarse_corners, factor)
+    half_width = int(math.ceil(band_coarse_pixels * factor))
+    mask_half_width = max(half_width, int(max(img.shape[0], img.shape[1]) * mask_band_size_factor))
+    mask = get_banded_mask(img, get_edge_points(corners), mask_half_width, key_color_hsv, key_range_hsv, erosion_size, dilation_size)
+
+    refined = refine_corners(mask, corners, half_width, num_samples, min_sample_fraction)
+    if not refined:
+        return None, None
+    return make_rectilinear(refined), mask
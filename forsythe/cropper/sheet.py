@@ -0,0 +1,184 @@
+import os
+import math
+import time
+import multiprocessing
+from queue import Queue, Empty
+from collections import deque
+
+import cv2
+import numpy as np
+
+from forsythe.images.manifest import read_manifest
+from forsythe.images.preview import get_preview_dir, load_preview_image, record_preview_reads
+from forsythe.cropper.types import Corner
+from forsythe.cropper.shrink import shrink_inside_mask
+from forsythe.cropper.detectors import run_detectors
+
+# Each worker hands back a thumbnail no larger than this, rather than the whole preview it worked from
+__tile_long_side__ = 320
+
+__ok_color__ = (255, 192, 192)
+__failed_color__ = (0, 0, 255)
+
+
+def preview_crop(raw_filepath, settings, scale, manifest_entry):
+    # Runs in a worker process: returns (raw_filepath, thumbnail, corners, detector_name, confidence, error), with
+    # corners scaled to the thumbnail. A frame that fails comes back with its error, rather than taking the sheet down.
+    # The worker only reads the preview: its usage is recorded by the sheet, for every frame at once.
+    try:
+        manifest = {os.path.basename(raw_filepath): manifest_entry} if manifest_entry else {}
+        img, _ = load_preview_image(raw_filepath, scale, manifest)
+        rect_corners, mask, detector, confidence = run_detectors(img, settings)
+        corners = None
+        if rect_corners:
+            corners = shrink_inside_mask(mask, rect_corners, settings['inset_interval'], settings['inset_white_threshold'], settings['extra_inset'])
+
+        thumb_scale = min(1.0, float(__tile_long_side__) / max(img.shape[0], img.shape[1]))
+        thumb = cv2.resize(img, (max(1, int(round(img.shape[1] * thumb_scale))), max(1, int(round(img.shape[0] * thumb_scale)))), interpolation=cv2.INTER_AREA)
+        if corners:
+            corners = {corner.name: (float(p[0]) * thumb_scale, float(p[1]) * thumb_scale) for corner, p in corners.items()}
+        return raw_filepath, thumb, corners, detector, confidence, None
+    except Exception as exc:
+        return raw_filepath, None, None, None, 0.0, '%s: %s' % (type(exc).__name__, exc)
+
+
+def get_grid_size(num_tiles, width, height, aspect):
+    # The number of columns and rows that makes the largest tiles of the given aspect ratio (width / height) fit
+    best = (1, num_tiles, 0.0)
+    for cols in range(1, num_tiles + 1):
+        rows = int(math.ceil(num_tiles / float(cols)))
+        tile_width = min(width / float(cols), height / float(rows) * aspect)
+        if tile_width > best[2]:
+            best = (cols, rows, tile_width)
+    return best[0], best[1]
+
+
+class CropSheet(object):
+    # Crop detection for every frame of a sequence at once, run on low-res previews in a pool of worker processes, for
+    # judging how a set of params does across the whole sequence rather than just the frame they were tuned on.
+    # Results are collected as each worker finishes, so the sheet fills in incrementally. As with CropGraphWorker, new
+    # settings aren't started on until no newer ones have arrived for debounce seconds, so that e.g. a held-down key
+    # only runs the last of them.
+
+    def __init__(self, raw_filepaths, scale, num_workers=None, debounce=0.05):
+        self.raw_filepaths = raw_filepaths
+        self.scale = scale
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.debounce = debounce
+        self.pool = None
+        self.finished = Queue()
+        self.generation = 0
+        self.settings = None
+        self.requested = None
+        self.requested_at = 0.0
+        self.results = {}
+        self.num_pending = 0
+        # Frames are handed to the pool a few at a time, so that when the settings change, only those few are left
+        # running for the old settings (their results are dropped) rather than the whole sequence
+        self.waiting = deque()
+        self.num_in_flight = 0
+        self.preview_dir = get_preview_dir(os.path.dirname(raw_filepaths[0])) if raw_filepaths else None
+        self.manifest = None
+
+    @property
+    def busy(self):
+        return self.num_pending > 0 or self.requested != self.settings
+
+    def start(self, settings):
+        if settings != self.requested:
+            self.requested = settings
+            self.requested_at = time.time()
+
+    def begin(self, settings):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.num_workers)
+
+        # The manifest is only read again while some previews are missing from it, so that the entries that workers
+        # have since filled in get picked up
+        if self.manifest is None or not all(os.path.basename(raw_filepath) in self.manifest for raw_filepath in self.raw_filepaths):
+            first = self.manifest is None
+            self.manifest = read_manifest(self.preview_dir)
+            if first:
+                record_preview_reads(self.preview_dir, [os.path.basename(raw_filepath) for raw_filepath in self.raw_filepaths], self.manifest)
+
+        self.generation += 1
+        self.settings = settings
+        self.results = {}
+        self.num_pending = len(self.raw_filepaths)
+        self.waiting = deque(self.raw_filepaths)
+
+    def submit(self):
+        while self.waiting and self.num_in_flight < self.num_workers * 2:
+            raw_filepath = self.waiting.popleft()
+            entry = self.manifest.get(os.path.basename(raw_filepath))
+            self.pool.apply_async(preview_crop, (raw_filepath, self.settings, self.scale, entry),
+                                  callback=lambda result, g=self.generation: self.finished.put((g, result)),
+                                  error_callback=lambda exc, g=self.generation, f=raw_filepath: self.finished.put((g, (f, None, None, None, 0.0, str(exc)))))
+            self.num_in_flight += 1
+
+    def poll(self):
+        # Collects whatever has finished since the last call, and starts on the latest settings once they've settled,
+        # returning whether there was anything new
+        updated = False
+        while True:
+            try:
+                generation, result = self.finished.get_nowait()
+            except Empty:
+                break
+            self.num_in_flight -= 1
+            if generation == self.generation:
+                self.results[result[0]] = result
+                self.num_pending -= 1
+                updated = True
+
+        if self.requested != self.settings and time.time() - self.requested_at >= self.debounce:
+            self.begin(self.requested)
+            updated = True
+        if self.settings is not None:
+            self.submit()
+        return updated
+
+    def is_failure(self, result):
+        _, _, corners, _, confidence, error = result
+        return bool(error) or not corners or confidence < self.settings['min_confidence']
+
+    @property
+    def num_failed(self):
+        return len([result for result in self.results.values() if self.is_failure(result)])
+
+    def render(self, width, height, aspect, labels):
+        # Tiles the frames in order, each with its crop drawn on it and labeled: frames still pending are left blank,
+        # and frames whose detection failed (or fell short of min_confidence) are outlined in red
+        canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        cols, rows = get_grid_size(len(self.raw_filepaths), width, height, aspect)
+        cell_width, cell_height = width // cols, height // rows
+        for i, raw_filepath in enumerate(self.raw_filepaths):
+            x, y = (i % cols) * cell_width, (i // cols) * cell_height
+            result = self.results.get(raw_filepath)
+            if result is None:
+                cv2.rectangle(canvas, (x + 1, y + 1), (x + cell_width - 2, y + cell_height - 2), (64, 64, 64), 1)
+                continue
+
+            _, thumb, corners, detector, confidence, error = result
+            failed = self.is_failure(result)
+            if thumb is not None:
+                fit = min((cell_width - 4) / float(thumb.shape[1]), (cell_height - 4) / float(thumb.shape[0]))
+                tile = cv2.resize(thumb, (max(1, int(thumb.shape[1] * fit)), max(1, int(thumb.shape[0] * fit))), interpolation=cv2.INTER_AREA)
+                if corners:
+                    quad = np.array([corners[c.name] for c in (Corner.top_left, Corner.top_right, Corner.bottom_right, Corner.bottom_left)]) * fit
+                    cv2.polylines(tile, [np.round(quad).astype(np.int32)], True, __failed_color__ if failed else __ok_color__, 1, cv2.LINE_AA)
+                canvas[y + 2:y + 2 + tile.shape[0], x + 2:x + 2 + tile.shape[1]] = tile
+            if failed:
+                cv2.rectangle(canvas, (x + 1, y + 1), (x + cell_width - 2, y + cell_height - 2), __failed_color__, 2)
+
+            status = 'ERROR' if error else ('%s %0.2f' % (detector, confidence) if corners else 'NONE')
+            label = '%s %s' % (labels[i], status)
+            cv2.putText(canvas, label, (x + 5, y + cell_height - 7), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 0), 1, cv2.LINE_AA)
+            cv2.putText(canvas, label, (x + 4, y + cell_height - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (255, 255, 255), 1, cv2.LINE_AA)
+        return canvas
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -3,62 +3,74 @@ import numpy as np
 from forsythe.cropper.types import Edge, Corner
 
 
-def line_white_percentage(mask, p0, p1):
-    # Adapted from: https://stackoverflow.com/questions/32328179/opencv-3-0-python-lineiterator
+__inset_batch_size__ = 64
+
+
+def line_white_percentages(mask, p0s, p1s):
+    # Vectorized over many lines at once: reproduces, for each line, the samples that a form of Bresenham's algorithm
+    # would visit between the (truncated) endpoints, excluding the first point and including the last. Adapted from:
+    # https://stackoverflow.com/questions/32328179/opencv-3-0-python-lineiterator
     height, width = mask.shape[0], mask.shape[1]
-    x0, y0 = int(p0[0]), int(p0[1])
-    x1, y1 = int(p1[0]), int(p1[1])
+    x0, y0 = np.trunc(p0s[:,0]).astype(np.int64), np.trunc(p0s[:,1]).astype(np.int64)
+    x1, y1 = np.trunc(p1s[:,0]).astype(np.int64), np.trunc(p1s[:,1]).astype(np.int64)
 
-    # Get the delta and absolute delta between the start and end points, so we can compute slope and relative location
     dx, dy = x1 - x0, y1 - y0
     dxa, dya = np.abs(dx), np.abs(dy)
+    num_samples = np.maximum(dxa, dya)
 
-    # Preallocate a buffer for our results, sized based on the distance between our sample points
-    itbuffer = np.empty(shape=(np.maximum(dya, dxa), 2), dtype=np.int)
-    itbuffer.fill(np.nan)
-
-    # Use a form of Bresenham's algorithm to get sample coordinates along the line
-    y_neg = y0 > y1
-    x_neg = x0 > x1
     vertical = x0 == x1
-    horizontal = not vertical and y0 == y1
-    if vertical:
-        itbuffer[:,0] = x0
-        if y_neg:
-            itbuffer[:,1] = np.arange(y0 - 1, y0 - dya - 1, -1)
-        else:
-            itbuffer[:,1] = np.arange(y0 + 1, y0 + dya + 1)
-    elif horizontal:
-        itbuffer[:,1] = y0
-        if x_neg:
-            itbuffer[:,0] = np.arange(x0 - 1, x0 - dxa - 1, -1)
-        else:
-            itbuffer[:,0] = np.arange(x0 + 1, x0 + dxa + 1)
-    else:
-        steep_slope = dya > dxa
-        if steep_slope:
-            slope = np.float32(dx) / np.float32(dy)
-            if y_neg:
-                itbuffer[:,1] = np.arange(y0 - 1, y0 - dya - 1, -1)
-            else:
-                itbuffer[:,1] = np.arange(y0 + 1, y0 + dya + 1)
-            itbuffer[:,0] = (slope * (itbuffer[:,1] - y0)).astype(np.int) + x0
-        else:
-            slope = np.float32(dy) / np.float32(dx)
-            if x_neg:
-                itbuffer[:,0] = np.arange(x0 - 1, x0 - dxa - 1, -1)
-            else:
-                itbuffer[:,0] = np.arange(x0 + 1, x0 + dxa + 1)
-            itbuffer[:,1] = (slope * (itbuffer[:,0] - x0)).astype(np.int) + y0
-
-    # Remove coordinates that lie outside the bounds of the image
-    x_col = itbuffer[:,0]
-    y_col = itbuffer[:,1]
-    itbuffer = itbuffer[(x_col >= 0) & (y_col >= 0) & (x_col < width) & (y_col < height)]
-
-    # Sample the color values at each location in the input image
-    value_sum = sum(mask[itbuffer[:,1].astype(np.uint), itbuffer[:,0].astype(np.uint)])
-    return value_sum / (int(np.sqrt(dx * dx + dy * dy) * 255))
+    horizontal = ~vertical & (y0 == y1)
+    steep_slope = ~vertical & ~horizontal & (dya > dxa)
+    shallow_slope = ~vertical & ~horizontal & ~steep_slope
+
+    # One row per line, with a column for each sample along the longest of them
+    steps = np.arange(1, max(1, int(num_samples.max())) + 1, dtype=np.int64)[None,:]
+    valid = steps <= num_samples[:,None]
+    y_steps = np.where((y0 > y1)[:,None], -steps, steps)
+    x_steps = np.where((x0 > x1)[:,None], -steps, steps)
+
+    # Slopes are computed in float32 and applied in float64, exactly as the scalar version did
+    with np.errstate(divide='ignore', invalid='ignore'):
+        steep = (dx.astype(np.float32) / dy.astype(np.float32)).astype(np.float64)
+        shallow = (dy.astype(np.float32) / dx.astype(np.float32)).astype(np.float64)
+    xs = np.where(vertical[:,None], x0[:,None], x0[:,None] + x_steps)
+    ys = np.where(horizontal[:,None], y0[:,None], y0[:,None] + y_steps)
+    xs = np.where(steep_slope[:,None], np.trunc(np.where(steep_slope, steep, 0.0)[:,None] * y_steps).astype(np.int64) + x0[:,None], xs)
+    ys = np.where(shallow_slope[:,None], np.trunc(np.where(shallow_slope, shallow, 0.0)[:,None] * x_steps).astype(np.int64) + y0[:,None], ys)
+
+    # Samples outside the bounds of the image are dropped
+    inside = valid & (xs >= 0) & (ys >= 0) & (xs < width) & (ys < height)
+    values = np.where(inside, mask[np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)], 0)
+    value_sums = values.sum(axis=1, dtype=np.int64)
+
+    denominators = (np.sqrt(dx * dx + dy * dy) * 255).astype(np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return value_sums / denominators
+
+
+def accumulate_steps(p, step, count):
+    # Adds step one at a time rather than multiplying it, so that every position rounds exactly as repeated nudges would
+    xs = np.cumsum(np.concatenate([[p[0]], np.full(count, step[0])]))
+    ys = np.cumsum(np.concatenate([[p[1]], np.full(count, step[1])]))
+    return np.stack([xs, ys], axis=1)
+
+
+def find_inset(mask, p0, p1, step, inset_white_threshold):
+    # Returns p0 and p1, moved along step as many times as it takes for the line between them to be no more than
+    # inset_white_threshold white. Candidate offsets are tested a batch at a time, with each batch in a single pass.
+    batch_size = __inset_batch_size__
+    while True:
+        p0s = accumulate_steps(p0, step, batch_size)
+        p1s = accumulate_steps(p1, step, batch_size)
+        percentages = line_white_percentages(mask, p0s, p1s)
+        done = np.nonzero(~(percentages > inset_white_threshold))[0]
+        if len(done):
+            i = done[0]
+            if np.isnan(percentages[i]):
+                raise ValueError('Edge collapsed to a point while shrinking inside mask')
+            return (p0s[i,0], p0s[i,1]), (p1s[i,0], p1s[i,1])
+        p0, p1 = p0s[-1], p1s[-1]
+        batch_size *= 2
 
 
 def get_direction(from_point, to_point):
@@ -79,16 +91,14 @@ def shrink_inside_mask(mask, corners, inset_interval, inset_white_threshold, ext
     move_down = lambda p, dist: v_add(p, v_mul(to_bottom, dist))
     move_up = lambda p, dist: v_add(p, v_mul(to_bottom, -dist))
 
-    for edge, nudge_func in [
-      (Edge.left, lambda p: move_right(p, inset_interval)),
-      (Edge.right, lambda p: move_left(p, inset_interval)),
-      (Edge.top, lambda p: move_down(p, inset_interval)),
-      (Edge.bottom, lambda p: move_up(p, inset_interval)),
+    for edge, step in [
+      (Edge.left, v_mul(to_right, inset_interval)),
+      (Edge.right, v_mul(to_right, -inset_interval)),
+      (Edge.top, v_mul(to_bottom, inset_interval)),
+      (Edge.bottom, v_mul(to_bottom, -inset_interval)),
     ]:
         a, b = edge.corners
-        while line_white_percentage(mask, corners[a], corners[b]) > inset_white_threshold:
-            corners[a] = nudge_func(corners[a])
-            corners[b] = nudge_func(corners[b])
+        corners[a], corners[b] = find_inset(mask, corners[a], corners[b], step, inset_white_threshold)
 
     return {
         Corner.top_left: move_down(move_right(corners[Corner.top_left], extra_inset), extra_inset),
@@ -1,4 +1,5 @@
 import os
+import re
 import threading
 from contextlib import contextmanager
 
@@ -9,6 +10,9 @@ from forsythe.images.files import list_image_filenames
 
 __xmp_ext__ = '.xmp'
 
+# <basename>_NN<ext>.xmp, as darktable names the sidecars of an image's duplicates
+__duplicate_xmp_regex__ = re.compile(r'^(.+)_(\d+)(\.[^.]+)\.xmp$', re.IGNORECASE)
+
 
 def list_xmp_filenames(images_dir):
     filenames = []
@@ -19,6 +23,24 @@ def list_xmp_filenames(images_dir):
     return filenames
 
 
+def split_duplicate_xmp_filepaths(xmp_filepaths):
+    # Returns (sidecars, duplicates): the images' own sidecars, and a dict mapping each image's filepath to
+    # {version: xmp_filepath} for the sidecars of its duplicates. A name like IMG_0001.CR2.xmp fits the pattern too, so a
+    # sidecar only counts as a duplicate if its own image doesn't exist and the one its name points back to does.
+    sidecars = []
+    duplicates = {}
+    for xmp_filepath in xmp_filepaths:
+        dirname, filename = os.path.split(xmp_filepath)
+        match = __duplicate_xmp_regex__.match(filename)
+        if match and not os.path.isfile(xmp_filepath[:-len(__xmp_ext__)]):
+            image_filepath = os.path.join(dirname, match.group(1) + match.group(3))
+            if os.path.isfile(image_filepath):
+                duplicates.setdefault(image_filepath, {})[int(match.group(2))] = xmp_filepath
+                continue
+        sidecars.append(xmp_filepath)
+    return sidecars, duplicates
+
+
 def delete_xmp_files(images_dir):
     for xmp_filename in list_xmp_filenames(images_dir):
         xmp_filepath = os.path.join(images_dir, xmp_filename)
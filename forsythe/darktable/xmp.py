@@ -1,3 +1,6 @@
+import os
+import shutil
+
 import lxml.etree as etree
 
 __rdf__ = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
@@ -18,6 +21,25 @@ def configure_iop_li(li, iop):
         li.set(__dt__ + attr, str(getattr(iop, attr)))
 
 
+def get_duplicate_xmp_filepath(image_filepath, version):
+    # darktable keeps each duplicate of an image in a sidecar of its own, with its version number appended to the
+    # image's basename: version 0 is the image's own sidecar
+    if version == 0:
+        return image_filepath + '.xmp'
+    dirname, filename = os.path.split(image_filepath)
+    basename, ext = os.path.splitext(filename)
+    return os.path.join(dirname, '%s_%02d%s.xmp' % (basename, version, ext))
+
+
+def create_duplicate_xmp(image_filepath, version):
+    # A duplicate starts out as a copy of the image's own sidecar (before any edits), which already refers back to the
+    # image it's derived from
+    xmp_filepath = get_duplicate_xmp_filepath(image_filepath, version)
+    if version != 0:
+        shutil.copyfile(get_duplicate_xmp_filepath(image_filepath, 0), xmp_filepath)
+    return xmp_filepath
+
+
 def edit_xmp(xmp_filepath, iops):
     if not iops:
         return
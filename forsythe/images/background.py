@@ -0,0 +1,216 @@
+import os
+import json
+import hashlib
+
+import cv2
+import numpy as np
+
+from forsythe.cropper.types import Corner
+from forsythe.cropper.mask import crop_corners, average_color, bgr_to_hsv
+from forsythe.images.files import list_raw_image_filenames
+from forsythe.images.locks import file_lock, get_temp_filepath
+from forsythe.images.manifest import read_manifest, update_manifest
+from forsythe.images.cache import get_cache_dir, get_entry_source, is_cached_image_current
+from forsythe.images.sharedmem import shared_decode_iterator
+from forsythe.images.stats import read_image_stats
+from forsythe.images.preview import get_preview_dir, get_preview_image_filepath, is_preview_image_current
+
+# Kept alongside the images, with one model per image source (a decode profile, or 'preview'), since each source has
+# its own colors
+__background_filename__ = '.background.json'
+__preview_source__ = 'preview'
+
+# A frame whose backdrop is further than this (as a distance in BGR) from its segment's is an outlier, e.g. a print that
+# overhangs a corner: it's given its segment's key color regardless. It takes this many outliers in a row that agree
+# with each other to count as the backdrop having changed, which starts a new segment.
+__drift_threshold__ = 16.0
+__drift_frames__ = 3
+
+__corner_order__ = [Corner.top_left, Corner.top_right, Corner.bottom_left, Corner.bottom_right]
+
+
+def get_background_filepath(images_dir):
+    return os.path.join(images_dir, __background_filename__)
+
+
+def get_frame_corner_colors(frames):
+    # frames maps each filename to its {corner_name: [b, g, r]}: returns an N x 4 x 3 array, in filename order
+    return np.array([[frames[filename][corner.name] for corner in __corner_order__] for filename in frames], dtype=np.float64)
+
+
+def find_backdrop_segments(backdrop_colors, threshold, num_frames):
+    # Returns a list of (start, end, members) for each run of frames with the same backdrop, where members are the
+    # indices of the frames in [start, end) that aren't outliers
+    segments = []
+    start, members, pending = 0, [0], []
+    for i in range(1, len(backdrop_colors)):
+        reference = np.median(backdrop_colors[members], axis=0)
+        if np.linalg.norm(backdrop_colors[i] - reference) <= threshold:
+            members.append(i)
+            pending = []
+            continue
+
+        pending.append(i)
+        if len(pending) >= num_frames:
+            candidates = backdrop_colors[pending]
+            if np.all(np.linalg.norm(candidates - np.median(candidates, axis=0), axis=1) <= threshold):
+                segments.append((start, pending[0], members))
+                start, members, pending = pending[0], list(pending), []
+            else:
+                pending = pending[1:]
+    segments.append((start, len(backdrop_colors), members))
+    return segments
+
+
+def get_background_fingerprint(frames, corner_size_factor):
+    data = json.dumps([corner_size_factor, frames], sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def build_background_model(frames, corner_size_factor):
+    # Each frame's own backdrop estimate is the median of its four corners, so that one corner covered by the print
+    # doesn't throw it off; each segment's key color is then the median of every corner of every frame in it
+    filenames = list(frames.keys())
+    corner_colors = get_frame_corner_colors(frames)
+    backdrop_colors = np.median(corner_colors, axis=1)
+
+    segments = []
+    frame_segments = {}
+    for start, end, members in find_backdrop_segments(backdrop_colors, __drift_threshold__, __drift_frames__):
+        key_color_bgr = np.median(corner_colors[members].reshape(-1, 3), axis=0)
+        segments.append({
+            'first': filenames[start],
+            'last': filenames[end - 1],
+            'key_color_hsv': [int(x) for x in bgr_to_hsv(key_color_bgr)],
+            'num_frames': end - start,
+            'num_outliers': end - start - len(members),
+        })
+        for i in range(start, end):
+            frame_segments[filenames[i]] = len(segments) - 1
+
+    return {
+        'fingerprint': get_background_fingerprint(frames, corner_size_factor),
+        'corner_size_factor': corner_size_factor,
+        'segments': segments,
+        'frames': frame_segments,
+    }
+
+
+def read_background_models(images_dir):
+    filepath = get_background_filepath(images_dir)
+    if os.path.isfile(filepath):
+        try:
+            with open(filepath) as fp:
+                return json.load(fp) or {}
+        except ValueError:
+            return {}
+    return {}
+
+
+def write_background_model(images_dir, source, model):
+    filepath = get_background_filepath(images_dir)
+    with file_lock(filepath):
+        models = read_background_models(images_dir)
+        models[source] = model
+        tmp_filepath = get_temp_filepath(filepath)
+        with open(tmp_filepath, 'w') as fp:
+            json.dump(models, fp)
+        os.replace(tmp_filepath, filepath)
+
+
+def update_background_model(images_dir, source, frames, corner_size_factor):
+    # The stored model is only rebuilt if the corner colors it was built from have changed (i.e. frames have been added
+    # or removed, or reshot against a different backdrop)
+    if not frames:
+        return None
+    # Segments are runs of consecutive frames, so the frames go in shooting order whatever order they were listed in
+    frames = {filename: frames[filename] for filename in sorted(frames)}
+    model = read_background_models(images_dir).get(source)
+    if model and model.get('fingerprint') == get_background_fingerprint(frames, corner_size_factor):
+        return model
+    model = build_background_model(frames, corner_size_factor)
+    write_background_model(images_dir, source, model)
+    return model
+
+
+def get_background_key_color(model, filename, corner_size_factor):
+    if not model or model['corner_size_factor'] != corner_size_factor:
+        return None
+    index = model['frames'].get(filename)
+    return None if index is None else model['segments'][index]['key_color_hsv']
+
+
+def get_corner_colors(img, corner_size_factor):
+    return {corner.name: [float(x) for x in average_color(region)] for corner, region in crop_corners(img, corner_size_factor).items()}
+
+
+def collect_stats_corner_colors(images_dir, profile, corner_size_factor):
+    # From the stats recorded when each frame was cached: frames that aren't cached yet are left out
+    cache_dir = get_cache_dir(images_dir, profile)
+    manifest = read_manifest(cache_dir)
+    frames = {}
+    for filename in list_raw_image_filenames(images_dir):
+        raw_filepath = os.path.join(images_dir, filename)
+        if not is_cached_image_current(manifest, raw_filepath, profile):
+            continue
+        record = read_image_stats(raw_filepath, profile, get_entry_source(manifest[filename]))
+        if record and record.get('corner_size_factor') == corner_size_factor:
+            frames[filename] = record['corner_colors_bgr']
+    return frames
+
+
+def collect_preview_corner_colors(images_dir, corner_size_factor):
+    # Previews have no stats: their corner colors are recorded in the preview manifest instead, the first time they're
+    # needed, from a reduced-size read of each preview
+    preview_dir = get_preview_dir(images_dir)
+    manifest = read_manifest(preview_dir)
+    frames = {}
+    recorded = {}
+    for filename in list_raw_image_filenames(images_dir):
+        raw_filepath = os.path.join(images_dir, filename)
+        if not is_preview_image_current(manifest, raw_filepath):
+            continue
+        entry = manifest[filename]
+        if entry.get('corner_size_factor') != corner_size_factor or not entry.get('corner_colors_bgr'):
+            img = cv2.imread(get_preview_image_filepath(raw_filepath), cv2.IMREAD_REDUCED_COLOR_4)
+            if img is None:
+                continue
+            entry = recorded[filename] = dict(entry, corner_size_factor=corner_size_factor, corner_colors_bgr=get_corner_colors(img, corner_size_factor))
+        frames[filename] = entry['corner_colors_bgr']
+    if recorded:
+        update_manifest(preview_dir, recorded)
+    return frames
+
+
+def collect_decoded_corner_colors(images_dir, profile, corner_size_factor, pyramid=False, persist=True):
+    # As collect_stats_corner_colors, but frames with no stats yet are decoded first (filling the cache along the way,
+    # unless persist is off), so that the model covers every frame however much of the collection was already cached.
+    # Once they're cached, their colors are read back from the stats recorded in the process, so that the model is the
+    # same on the next run.
+    frames = collect_stats_corner_colors(images_dir, profile, corner_size_factor)
+    filenames = list_raw_image_filenames(images_dir)
+    missing = [filename for filename in filenames if filename not in frames]
+    if missing:
+        print('Decoding %d frame(s) for the backdrop model...' % len(missing))
+        for raw_filepath, img in shared_decode_iterator(images_dir, profile=profile, pyramid=pyramid, persist=persist, filenames=missing):
+            frames[os.path.basename(raw_filepath)] = get_corner_colors(img, corner_size_factor)
+        if persist:
+            frames.update(collect_stats_corner_colors(images_dir, profile, corner_size_factor))
+    return {filename: frames[filename] for filename in filenames if filename in frames}
+
+
+def update_stats_background_model(images_dir, profile, corner_size_factor, pyramid=False, persist=True):
+    return update_background_model(images_dir, profile, collect_decoded_corner_colors(images_dir, profile, corner_size_factor, pyramid, persist), corner_size_factor)
+
+
+def update_preview_background_model(images_dir, corner_size_factor):
+    return update_background_model(images_dir, __preview_source__, collect_preview_corner_colors(images_dir, corner_size_factor), corner_size_factor)
+
+
+def describe_background_model(model):
+    if not model:
+        return 'Backdrop: <no model>'
+    lines = ['Backdrop: %d frame(s) in %d segment(s)' % (len(model['frames']), len(model['segments']))]
+    for segment in model['segments']:
+        lines.append('    %s - %s: HSV %r (%d outlier(s))' % (segment['first'], segment['last'], segment['key_color_hsv'], segment['num_outliers']))
+    return '\n'.join(lines)
@@ -1,53 +1,261 @@
+import io
 import os
-import multiprocessing
 
+import cv2
 import rawpy
 import imageio
 
-from forsythe.images.files import list_image_filenames, is_raw, list_raw_image_filenames
+from forsythe.images.files import list_image_filenames, is_raw
+from forsythe.images.locks import file_lock, get_temp_filepath
+from forsythe.images.manifest import hash_bytes, get_settings_key, read_manifest, update_manifest, touch_manifest_entries, make_manifest_entry, is_entry_current, record_usage
+from forsythe.images.prefetch import __prefetch_lookahead__, __prefetch_workers__, prefetch
+from forsythe.images.sharedcache import get_shared_cache_root, fetch_shared_image, publish_shared_image, read_shared_stats, publish_shared_stats
+from forsythe.images.stats import compute_image_stats, read_image_stats, write_image_stats
+from forsythe.images.pyramid import get_pyramid_dirpath, read_pyramid_meta, write_pyramid, delete_pyramid, is_pyramid_current, read_pyramid_region
 
 __cache_dirname__ = '.imagecache'
 
+# Keyword arguments for rawpy's postprocess(), by profile name. Enum-valued settings are given by name so that each
+# profile serializes into its cache key.
+__decode_profiles__ = {
+    'detect': {'half_size': True, 'demosaic_algorithm': 'LINEAR', 'no_auto_bright': True},
+    'proof': {},
+}
+__default_profile__ = 'proof'
 
-def get_cached_image_filepath(raw_filepath):
+
+def get_decode_settings(profile):
+    settings = __decode_profiles__.get(profile)
+    if settings is None:
+        raise ValueError("Unknown decode profile '%s' (valid: %s)" % (profile, ', '.join(sorted(__decode_profiles__))))
+    return settings
+
+
+def get_postprocess_args(profile):
+    kwargs = dict(get_decode_settings(profile))
+    if 'demosaic_algorithm' in kwargs:
+        kwargs['demosaic_algorithm'] = rawpy.DemosaicAlgorithm[kwargs['demosaic_algorithm']]
+    return kwargs
+
+
+def get_profile_scale(profile):
+    return 0.5 if get_decode_settings(profile).get('half_size') else 1.0
+
+
+def get_decode_key(profile):
+    return get_settings_key(get_decode_settings(profile))
+
+
+def get_cache_dir(images_dir, profile=__default_profile__):
+    return os.path.join(images_dir, __cache_dirname__, profile)
+
+
+def get_cached_image_filepath(raw_filepath, profile=__default_profile__):
     dirpath, filename = os.path.split(raw_filepath)
     basename = os.path.splitext(filename)[0]
-    return os.path.join(dirpath, __cache_dirname__, basename + '.jpg')
+    return os.path.join(get_cache_dir(dirpath, profile), basename + '.jpg')
+
+
+def get_cached_pyramid_dirpath(raw_filepath, profile=__default_profile__):
+    return get_pyramid_dirpath(get_cached_image_filepath(raw_filepath, profile))
+
+
+def get_cached_crop_dirpath(raw_filepath, profile=__default_profile__):
+    # Persisted output of each stage of the crop pipeline, as run on this image
+    return os.path.splitext(get_cached_image_filepath(raw_filepath, profile))[0] + '.crop'
+
+
+def get_entry_source(entry):
+    return '%s-%s' % (entry['hash'], entry['key'])
+
+
+def read_raw_file(raw_filepath, profile=__default_profile__):
+    # Read the raw once, so that hashing it doesn't cost a second trip over the network
+    with open(raw_filepath, 'rb') as fp:
+        data = fp.read()
+    return data, make_manifest_entry(raw_filepath, get_decode_key(profile), hash_bytes(data))
+
+
+def decode_raw_data(data, profile=__default_profile__):
+    with rawpy.imread(io.BytesIO(data)) as raw:
+        return raw.postprocess(**get_postprocess_args(profile))
+
+
+def fetch_cached_image(raw_filepath, entry, profile=__default_profile__, pyramid=False):
+    shared_root = get_shared_cache_root()
+    if not shared_root:
+        return False
+    pyramid_source = get_entry_source(entry) if pyramid else None
+    if not fetch_shared_image(shared_root, entry, get_cached_image_filepath(raw_filepath, profile), profile, pyramid_source):
+        return False
 
+    # Stats from the original decode where available: recomputing them from the JPEG would give slightly different
+    # numbers depending on which workstation did the decode
+    if read_image_stats(raw_filepath, profile, get_entry_source(entry)) is None:
+        record = read_shared_stats(shared_root, entry, profile)
+        if record is None:
+            record = compute_image_stats(read_cached_image(raw_filepath, profile), get_entry_source(entry))
+        write_image_stats(raw_filepath, profile, record)
+    return True
 
-def regenerate_cached_image(raw_filepath):
-    cached_filepath = get_cached_image_filepath(raw_filepath)
+
+def publish_cached_image(raw_filepath, entry, profile=__default_profile__, pyramid=False):
+    shared_root = get_shared_cache_root()
+    if not shared_root:
+        return False
+    pyramid_source = get_entry_source(entry) if pyramid else None
+    if not publish_shared_image(shared_root, entry, get_cached_image_filepath(raw_filepath, profile), profile, pyramid_source):
+        return False
+    record = read_image_stats(raw_filepath, profile, get_entry_source(entry))
+    if record is not None:
+        publish_shared_stats(shared_root, entry, profile, record)
+    return True
+
+
+def store_cached_image(raw_filepath, rgb, entry, profile=__default_profile__, pyramid=False):
+    cached_filepath = get_cached_image_filepath(raw_filepath, profile)
     os.makedirs(os.path.dirname(cached_filepath), exist_ok=True)
-    with rawpy.imread(raw_filepath) as raw:
-        rgb = raw.postprocess()
-        imageio.imsave(cached_filepath, rgb)
 
+    # Readers never see a half-written JPEG: they get either the old file or the complete new one
+    tmp_filepath = get_temp_filepath(cached_filepath)
+    imageio.imsave(tmp_filepath, rgb)
+    os.replace(tmp_filepath, cached_filepath)
+
+    # Build the pyramid from the array we already have in memory; otherwise drop any pyramid left over from the
+    # previous decode, so that one never outlives the JPEG it was built alongside
+    bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    pyramid_dir = get_cached_pyramid_dirpath(raw_filepath, profile)
+    if pyramid:
+        write_pyramid(pyramid_dir, bgr, get_entry_source(entry))
+    else:
+        delete_pyramid(pyramid_dir)
+
+    # Stats come from the same pass too, so that commands which only need a few numbers never have to decode
+    write_image_stats(raw_filepath, profile, compute_image_stats(bgr, get_entry_source(entry)))
+
+
+def regenerate_cached_image(raw_filepath, profile=__default_profile__, pyramid=False, shared=True):
+    data, entry = read_raw_file(raw_filepath, profile)
+    os.makedirs(get_cache_dir(os.path.dirname(raw_filepath), profile), exist_ok=True)
+
+    # If another workstation has already decoded this raw with the same settings, copying its result is far cheaper
+    if shared and fetch_cached_image(raw_filepath, entry, profile, pyramid):
+        return entry
+
+    store_cached_image(raw_filepath, decode_raw_data(data, profile), entry, profile, pyramid)
+    if shared:
+        publish_cached_image(raw_filepath, entry, profile, pyramid)
+    return entry
+
+
+def is_cached_image_current(manifest, raw_filepath, profile=__default_profile__, pyramid=False):
+    if not is_entry_current(manifest, raw_filepath, get_cached_image_filepath(raw_filepath, profile), get_decode_key(profile)):
+        return False
+    if pyramid:
+        entry = manifest[os.path.basename(raw_filepath)]
+        return is_pyramid_current(get_cached_pyramid_dirpath(raw_filepath, profile), get_entry_source(entry))
+    return True
 
-def generate_cache(images_dir, force=False, multiprocess=True):
-    cache_dir = os.path.join(images_dir, __cache_dirname__)
+
+def fill_cached_image(raw_filepath, profile=__default_profile__, pyramid=False, force=False):
+    # Single-flight: whichever process takes the entry's lock does the decode, and any others wait for it and then
+    # find the entry already filled
+    cached_filepath = get_cached_image_filepath(raw_filepath, profile)
+    cache_dir = os.path.dirname(cached_filepath)
     os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(cached_filepath):
+        if not force and is_cached_image_current(read_manifest(cache_dir), raw_filepath, profile, pyramid):
+            return False
+        entry = regenerate_cached_image(raw_filepath, profile, pyramid, shared=not force)
+        update_manifest(cache_dir, {os.path.basename(raw_filepath): entry})
+    return True
+
+
+def ensure_cached_image(manifest, raw_filepath, profile=__default_profile__, pyramid=False):
+    # None if the entry was already current, otherwise whether this process did the fill (False if another one did)
+    if is_cached_image_current(manifest, raw_filepath, profile, pyramid):
+        return None
+    return fill_cached_image(raw_filepath, profile, pyramid)
+
+
+def update_cached_image(raw_filepath, profile=__default_profile__, force=False, pyramid=False):
+    filename = os.path.basename(raw_filepath)
+    cache_dir = os.path.dirname(get_cached_image_filepath(raw_filepath, profile))
+    manifest = read_manifest(cache_dir)
+    if not force and is_cached_image_current(manifest, raw_filepath, profile, pyramid):
+        touch_manifest_entries(cache_dir, {filename: manifest[filename]})
+        record_usage(cache_dir, hits=1)
+        return False
+
+    filled = fill_cached_image(raw_filepath, profile, pyramid, force)
+    record_usage(cache_dir, hits=0 if filled else 1, misses=1 if filled else 0)
+    return filled
 
-    raw_filepaths_to_regenerate = []
-    for raw_filename in list_raw_image_filenames(images_dir):
-        raw_filepath = os.path.join(images_dir, raw_filename)
-        if force or not os.path.isfile(get_cached_image_filepath(raw_filepath)):
-            raw_filepaths_to_regenerate.append(raw_filepath)
 
-    if multiprocess:
-        pool = multiprocessing.Pool()
-        pool.map(regenerate_cached_image, raw_filepaths_to_regenerate)
+def read_cached_image(image_filepath, profile=__default_profile__, level=0, region=None):
+    if is_raw(image_filepath):
+        pyramid_dir = get_cached_pyramid_dirpath(image_filepath, profile)
+        meta = read_pyramid_meta(pyramid_dir)
+        if meta is not None and level < len(meta['levels']):
+            return read_pyramid_region(pyramid_dir, level, region, meta)
+        img = cv2.imread(get_cached_image_filepath(image_filepath, profile))
     else:
-        for raw_filepath in raw_filepaths_to_regenerate:
-            regenerate_cached_image(raw_filepath)
+        img = cv2.imread(image_filepath)
 
+    for _ in range(level):
+        img = cv2.resize(img, (max(1, img.shape[1] // 2), max(1, img.shape[0] // 2)), interpolation=cv2.INTER_AREA)
+    if region:
+        x, y, width, height = [int(v) for v in region]
+        img = img[max(0, y):y + height, max(0, x):x + width]
+    return img
 
-def image_iterator(images_dir):
-    for filename in list_image_filenames(images_dir):
+
+def image_iterator(images_dir, profile=__default_profile__, pyramid=False):
+    cache_dir = get_cache_dir(images_dir, profile)
+    manifest = read_manifest(cache_dir)
+    touched = {}
+    hits, misses = 0, 0
+    try:
+        for filename in list_image_filenames(images_dir):
+            filepath = os.path.join(images_dir, filename)
+            if is_raw(filepath):
+                filled = ensure_cached_image(manifest, filepath, profile, pyramid)
+                if filled is None:
+                    touched[filename] = manifest[filename]
+                if filled:
+                    misses += 1
+                else:
+                    hits += 1
+                yield filepath, get_cached_image_filepath(filepath, profile)
+            else:
+                yield filepath, filepath
+    finally:
+        touch_manifest_entries(cache_dir, touched)
+        record_usage(cache_dir, hits, misses)
+
+
+def prefetch_image_iterator(images_dir, profile=__default_profile__, pyramid=False, level=0, lookahead=__prefetch_lookahead__, num_workers=__prefetch_workers__, filenames=None):
+    cache_dir = get_cache_dir(images_dir, profile)
+    manifest = read_manifest(cache_dir)
+
+    def load(filename):
         filepath = os.path.join(images_dir, filename)
-        if is_raw(filepath):
-            cached_filepath = get_cached_image_filepath(filepath)
-            if not os.path.isfile(cached_filepath):
-                regenerate_cached_image(filepath)
-            yield filepath, cached_filepath
-        else:
-            yield filepath, filepath
+        filled = ensure_cached_image(manifest, filepath, profile, pyramid) if is_raw(filepath) else None
+        return filepath, filled, read_cached_image(filepath, profile, level)
+
+    touched = {}
+    hits, misses = 0, 0
+    try:
+        filenames = list_image_filenames(images_dir) if filenames is None else filenames
+        for filename, (filepath, filled, img) in prefetch(filenames, load, lookahead, num_workers):
+            if is_raw(filepath):
+                if filled is None:
+                    touched[filename] = manifest[filename]
+                if filled:
+                    misses += 1
+                else:
+                    hits += 1
+            yield filepath, img
+    finally:
+        touch_manifest_entries(cache_dir, touched)
+        record_usage(cache_dir, hits, misses)
@@ -0,0 +1,248 @@
+import os
+import time
+import shutil
+from collections import defaultdict
+
+from forsythe.images.files import list_image_filenames
+from forsythe.images.cache import __cache_dirname__
+from forsythe.images.preview import __preview_dirname__
+from forsythe.images.params import __params_dirname__, __params_ext__, get_params_filepath
+from forsythe.images.stats import __stats_dirname__, __stats_ext__, get_stats_filepath
+from forsythe.images.locks import __stale_lock_age__, is_transient_filename
+from forsythe.images.manifest import __manifest_filename__, __usage_filename__, read_manifest, update_manifest, read_usage
+
+__bookkeeping_filenames__ = [__manifest_filename__, __usage_filename__]
+
+
+def get_path_size(path):
+    if os.path.isdir(path):
+        return sum(get_path_size(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def get_cache_dirs(images_dir):
+    cache_dirs = []
+    cache_root = os.path.join(images_dir, __cache_dirname__)
+    if os.path.isdir(cache_root):
+        for name in sorted(os.listdir(cache_root)):
+            if os.path.isdir(os.path.join(cache_root, name)):
+                cache_dirs.append(os.path.join(cache_root, name))
+    preview_dir = os.path.join(images_dir, __preview_dirname__)
+    if os.path.isdir(preview_dir):
+        cache_dirs.append(preview_dir)
+    return cache_dirs
+
+
+def find_images_dirs(rootdir):
+    images_dirs = []
+    for dirpath, dirnames, _ in os.walk(rootdir):
+        if any(name in dirnames for name in (__cache_dirname__, __preview_dirname__, __params_dirname__, __stats_dirname__)):
+            images_dirs.append(dirpath)
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+    return images_dirs
+
+
+def scan_cache_dir(images_dir, cache_dir):
+    manifest = read_manifest(cache_dir)
+    raw_filenames_by_basename = {os.path.splitext(filename)[0]: filename for filename in manifest}
+
+    paths_by_basename = defaultdict(list)
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name in __bookkeeping_filenames__:
+            continue
+        if is_transient_filename(name):
+            # Temp files and locks belong to in-flight fills, unless they've been left behind by a crashed process
+            if time.time() - os.path.getmtime(path) > __stale_lock_age__:
+                paths_by_basename[name].append(path)
+            continue
+        paths_by_basename[os.path.splitext(name)[0]].append(path)
+
+    entries = []
+    orphans = []
+    for basename, paths in sorted(paths_by_basename.items()):
+        raw_filename = raw_filenames_by_basename.get(basename)
+        item = {
+            'cache_dir': cache_dir,
+            'raw_filename': raw_filename,
+            'paths': paths,
+            'size': sum(get_path_size(path) for path in paths),
+        }
+        if raw_filename and os.path.isfile(os.path.join(images_dir, raw_filename)):
+            item['last_used'] = manifest[raw_filename].get('last_used') or max(os.path.getmtime(path) for path in paths)
+            entries.append(item)
+        else:
+            orphans.append(item)
+    return entries, orphans
+
+
+def scan_legacy_files(images_dir):
+    # Before decode profiles, cached JPEGs and the manifest lived directly in .imagecache
+    orphans = []
+    cache_root = os.path.join(images_dir, __cache_dirname__)
+    if os.path.isdir(cache_root):
+        for name in sorted(os.listdir(cache_root)):
+            path = os.path.join(cache_root, name)
+            if os.path.isfile(path):
+                orphans.append({'cache_dir': cache_root, 'raw_filename': None, 'paths': [path], 'size': os.path.getsize(path)})
+    return orphans
+
+
+def scan_orphaned_sidecars(images_dir, dirname, ext):
+    # Per-image files kept alongside the images (params, stats) whose image no longer exists
+    orphans = []
+    sidecar_dir = os.path.join(images_dir, dirname)
+    if os.path.isdir(sidecar_dir):
+        image_basenames = set(os.path.splitext(filename)[0] for filename in list_image_filenames(images_dir))
+        for name in sorted(os.listdir(sidecar_dir)):
+            basename, name_ext = os.path.splitext(name)
+            if name_ext == ext and basename not in image_basenames:
+                path = os.path.join(sidecar_dir, name)
+                orphans.append({'cache_dir': sidecar_dir, 'raw_filename': None, 'paths': [path], 'size': os.path.getsize(path)})
+    return orphans
+
+
+def scan_orphaned_stats(images_dir):
+    return scan_orphaned_sidecars(images_dir, __stats_dirname__, __stats_ext__)
+
+
+def scan_orphaned_params(images_dir):
+    # Unlike everything else here, params are user data rather than cache: an image that's missing may only have been
+    # moved or renamed, so these are only ever removed when asked for explicitly
+    return scan_orphaned_sidecars(images_dir, __params_dirname__, __params_ext__)
+
+
+def scan_images_dir(images_dir):
+    entries = []
+    orphans = scan_legacy_files(images_dir) + scan_orphaned_stats(images_dir)
+    for cache_dir in get_cache_dirs(images_dir):
+        cache_entries, cache_orphans = scan_cache_dir(images_dir, cache_dir)
+        entries.extend(cache_entries)
+        orphans.extend(cache_orphans)
+    return entries, orphans
+
+
+def get_cache_stats(rootdir):
+    stats = []
+    for images_dir in find_images_dirs(rootdir):
+        orphans = scan_legacy_files(images_dir) + scan_orphaned_stats(images_dir)
+        if orphans:
+            stats.append({
+                'images_dir': images_dir,
+                'cache_dir': None,
+                'num_entries': 0,
+                'size': 0,
+                'num_orphans': len(orphans),
+                'orphan_size': sum(item['size'] for item in orphans),
+                'hits': 0,
+                'misses': 0,
+            })
+        for cache_dir in get_cache_dirs(images_dir):
+            entries, orphans = scan_cache_dir(images_dir, cache_dir)
+            usage = read_usage(cache_dir)
+            stats.append({
+                'images_dir': images_dir,
+                'cache_dir': cache_dir,
+                'num_entries': len(entries),
+                'size': sum(item['size'] for item in entries),
+                'num_orphans': len(orphans),
+                'orphan_size': sum(item['size'] for item in orphans),
+                'hits': usage.get('hits', 0),
+                'misses': usage.get('misses', 0),
+            })
+    return stats
+
+
+def remove_items(items, dry_run=False):
+    removed_by_cache_dir = defaultdict(set)
+    for item in items:
+        if not dry_run:
+            for path in item['paths']:
+                remove_path(path)
+        if item['raw_filename']:
+            removed_by_cache_dir[item['cache_dir']].add(item['raw_filename'])
+
+    if not dry_run:
+        for cache_dir, raw_filenames in removed_by_cache_dir.items():
+            update_manifest(cache_dir, removed=raw_filenames)
+    return sum(item['size'] for item in items)
+
+
+def prune_manifests(images_dir, dry_run=False):
+    num_pruned = 0
+    for cache_dir in get_cache_dirs(images_dir):
+        manifest = read_manifest(cache_dir)
+        stale = [filename for filename in manifest if not os.path.isfile(os.path.join(images_dir, filename))]
+        if stale and not dry_run:
+            update_manifest(cache_dir, removed=stale)
+        num_pruned += len(stale)
+    return num_pruned
+
+
+def collect_garbage(rootdir, budget=None, dry_run=False, params=False):
+    # Only cache data is collected, unless params is set: then the .params files of missing images go too
+    all_entries = []
+    all_orphans = []
+    orphaned_params = []
+    num_pruned = 0
+    for images_dir in find_images_dirs(rootdir):
+        entries, orphans = scan_images_dir(images_dir)
+        all_entries.extend(entries)
+        all_orphans.extend(orphans)
+        if params:
+            orphaned_params.extend(scan_orphaned_params(images_dir))
+        num_pruned += prune_manifests(images_dir, dry_run)
+
+    orphan_size = remove_items(all_orphans, dry_run)
+    params_size = remove_items(orphaned_params, dry_run)
+
+    # Evict least-recently-used entries across every collection until the total fits within the budget
+    evicted = []
+    total_size = sum(item['size'] for item in all_entries)
+    if budget is not None and total_size > budget:
+        for item in sorted(all_entries, key=lambda x: x['last_used']):
+            if total_size <= budget:
+                break
+            evicted.append(item)
+            total_size -= item['size']
+    evicted_size = remove_items(evicted, dry_run)
+
+    return {
+        'num_orphans': len(all_orphans),
+        'orphan_size': orphan_size,
+        'params_paths': [path for item in orphaned_params for path in item['paths']],
+        'params_size': params_size,
+        'num_pruned': num_pruned,
+        'num_evicted': len(evicted),
+        'evicted_size': evicted_size,
+        'remaining_size': total_size,
+    }
+
+
+def delete_image_caches(image_filepath):
+    images_dir, filename = os.path.split(image_filepath)
+    basename = os.path.splitext(filename)[0]
+
+    deleted = []
+    for cache_dir in get_cache_dirs(images_dir):
+        for name in os.listdir(cache_dir):
+            if name not in __bookkeeping_filenames__ and not is_transient_filename(name) and os.path.splitext(name)[0] == basename:
+                path = os.path.join(cache_dir, name)
+                remove_path(path)
+                deleted.append(path)
+
+        if filename in read_manifest(cache_dir):
+            update_manifest(cache_dir, removed=[filename])
+
+    for sidecar_filepath in (get_params_filepath(image_filepath), get_stats_filepath(image_filepath)):
+        if os.path.isfile(sidecar_filepath):
+            os.remove(sidecar_filepath)
+            deleted.append(sidecar_filepath)
+    return deleted
@@ -0,0 +1,135 @@
+import os
+import time
+import shutil
+import socket
+import uuid
+from contextlib import contextmanager
+
+import psutil
+
+__lock_ext__ = '.lock'
+__temp_prefix__ = '.tmp-'
+__stale_lock_age__ = 600.0
+
+
+def get_lock_filepath(path):
+    return path + __lock_ext__
+
+
+def get_temp_filepath(path):
+    # Keeps the original extension, so that writers which infer a format from the filename still work
+    dirpath, filename = os.path.split(path)
+    return os.path.join(dirpath, '%s%d-%s' % (__temp_prefix__, os.getpid(), filename))
+
+
+def is_transient_filename(name):
+    return name.startswith(__temp_prefix__) or name.endswith(__lock_ext__)
+
+
+def get_lock_owner():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def read_lock(lock_filepath):
+    # (owner, mtime), or None if there's no lock there (any more)
+    try:
+        with open(lock_filepath) as fp:
+            owner = fp.read().strip()
+        return owner, os.path.getmtime(lock_filepath)
+    except OSError:
+        return None
+
+
+def is_lock_stale(lock, stale_age):
+    if lock is None:
+        return False
+    owner, mtime = lock
+
+    # A lock held by a process on this machine is stale exactly when that process is dead, however long it's been held
+    # for. One held from another machine (or whose owner can't be read, e.g. if it's still being written) is only
+    # considered stale once it's old enough that no reasonable fill could still be running.
+    hostname, _, pid_str = owner.rpartition(':')
+    if hostname == socket.gethostname() and pid_str.isdigit():
+        return not psutil.pid_exists(int(pid_str))
+    return time.time() - mtime > stale_age
+
+
+def break_stale_lock(lock_filepath, lock):
+    # Several waiters may see the same stale lock at once. Each renames it aside to a name of its own, which only one of
+    # them can do; and since another waiter may already have broken it and taken a fresh lock in its place, whoever
+    # wins checks that what it moved is still the lock it found stale, and puts it back if not.
+    aside_filepath = get_temp_filepath('%s-%s' % (lock_filepath, uuid.uuid4().hex[:8]))
+    try:
+        os.rename(lock_filepath, aside_filepath)
+    except OSError:
+        return
+    if read_lock(aside_filepath) != lock:
+        try:
+            # Unlike a rename, a link never replaces a lock that's been taken in the meantime
+            os.link(aside_filepath, lock_filepath)
+        except FileExistsError:
+            pass
+        except OSError:
+            # No hard links on this filesystem: a rename it is
+            if not os.path.exists(lock_filepath):
+                os.rename(aside_filepath, lock_filepath)
+                return
+    try:
+        os.remove(aside_filepath)
+    except OSError:
+        pass
+
+
+@contextmanager
+def file_lock(path, timeout=None, interval=0.1, stale_age=__stale_lock_age__):
+    lock_filepath = get_lock_filepath(path)
+    os.makedirs(os.path.dirname(lock_filepath) or '.', exist_ok=True)
+
+    elapsed = 0.0
+    while True:
+        try:
+            fd = os.open(lock_filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            lock = read_lock(lock_filepath)
+            if is_lock_stale(lock, stale_age):
+                break_stale_lock(lock_filepath, lock)
+                continue
+            if timeout is not None and elapsed >= timeout:
+                raise RuntimeError('Timed out after %0.2f seconds waiting for lock: %s' % (timeout, lock_filepath))
+            time.sleep(interval)
+            elapsed += interval
+        else:
+            os.write(fd, get_lock_owner().encode('utf-8'))
+            os.close(fd)
+            break
+
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_filepath)
+        except OSError:
+            pass
+
+
+def replace_path(src, dst):
+    if os.path.isdir(src):
+        # Directories can't be atomically swapped over a non-empty destination, so the old one is moved aside first
+        if os.path.isdir(dst):
+            old = get_temp_filepath(dst + '.old')
+            os.rename(dst, old)
+            os.rename(src, dst)
+            # Another process may still have the old levels memory-mapped; cache-gc picks up anything left behind
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(src, dst)
+    else:
+        os.replace(src, dst)
+
+
+def copy_file(src, dst):
+    # Metadata is copied along with the contents, so that the copy keeps the original's mtime
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_filepath = get_temp_filepath(dst)
+    shutil.copy2(src, tmp_filepath)
+    os.replace(tmp_filepath, dst)
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import hashlib
+
+from forsythe.images.locks import file_lock, get_temp_filepath
+
+__manifest_filename__ = 'manifest.json'
+__usage_filename__ = 'usage.json'
+__hash_chunk_size__ = 1024 * 1024
+
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_file(filepath):
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(__hash_chunk_size__), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_settings_key(settings):
+    return hash_bytes(json.dumps(settings, sort_keys=True).encode('utf-8'))[:12]
+
+
+def get_file_signature(filepath):
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime
+
+
+def get_manifest_filepath(cache_dir):
+    return os.path.join(cache_dir, __manifest_filename__)
+
+
+def read_manifest(cache_dir):
+    filepath = get_manifest_filepath(cache_dir)
+    if os.path.isfile(filepath):
+        try:
+            with open(filepath) as fp:
+                return json.load(fp) or {}
+        except ValueError:
+            return {}
+    return {}
+
+
+def write_manifest(cache_dir, manifest):
+    os.makedirs(cache_dir, exist_ok=True)
+    filepath = get_manifest_filepath(cache_dir)
+    tmp_filepath = get_temp_filepath(filepath)
+    with open(tmp_filepath, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(tmp_filepath, filepath)
+
+
+def update_manifest(cache_dir, entries=None, removed=None):
+    # Several processes may fill the same cache directory at once: merge into whatever is on disk rather than
+    # overwriting it with a stale snapshot
+    with file_lock(get_manifest_filepath(cache_dir)):
+        manifest = read_manifest(cache_dir)
+        manifest.update(entries or {})
+        for filename in removed or []:
+            manifest.pop(filename, None)
+        write_manifest(cache_dir, manifest)
+    return manifest
+
+
+def touch_manifest_entries(cache_dir, entries):
+    if not entries:
+        return
+    now = time.time()
+    with file_lock(get_manifest_filepath(cache_dir)):
+        manifest = read_manifest(cache_dir)
+        for filename, entry in entries.items():
+            # Skip entries that another process has re-filled since our snapshot was taken
+            current = manifest.get(filename)
+            if current and current.get('hash') == entry.get('hash') and current.get('key') == entry.get('key'):
+                current['mtime'] = entry.get('mtime', current.get('mtime'))
+                current['last_used'] = now
+        write_manifest(cache_dir, manifest)
+
+
+def make_manifest_entry(raw_filepath, key, digest=None):
+    size, mtime = get_file_signature(raw_filepath)
+    return {
+        'size': size,
+        'mtime': mtime,
+        'hash': digest or hash_file(raw_filepath),
+        'key': key,
+        'last_used': time.time(),
+    }
+
+
+def is_entry_current(manifest, raw_filepath, cached_filepath, key):
+    entry = manifest.get(os.path.basename(raw_filepath))
+    if not entry or entry.get('key') != key or not os.path.isfile(cached_filepath):
+        return False
+
+    size, mtime = get_file_signature(raw_filepath)
+    if size != entry.get('size'):
+        return False
+    if mtime == entry.get('mtime'):
+        return True
+
+    # Same size but a different mtime (e.g. the raw was copied back from a backup): only the content hash can tell
+    if hash_file(raw_filepath) == entry.get('hash'):
+        entry['mtime'] = mtime
+        return True
+    return False
+
+
+def read_usage(cache_dir):
+    filepath = os.path.join(cache_dir, __usage_filename__)
+    if os.path.isfile(filepath):
+        try:
+            with open(filepath) as fp:
+                return json.load(fp) or {}
+        except ValueError:
+            return {}
+    return {}
+
+
+def record_usage(cache_dir, hits=0, misses=0):
+    if not hits and not misses:
+        return
+    filepath = os.path.join(cache_dir, __usage_filename__)
+    with file_lock(filepath):
+        usage = read_usage(cache_dir)
+        usage['hits'] = usage.get('hits', 0) + hits
+        usage['misses'] = usage.get('misses', 0) + misses
+        tmp_filepath = get_temp_filepath(filepath)
+        with open(tmp_filepath, 'w') as fp:
+            json.dump(usage, fp)
+        os.replace(tmp_filepath, filepath)
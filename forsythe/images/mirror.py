@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from forsythe.config import get_config_var
+from forsythe.images.params import __params_dirname__
+from forsythe.images.stats import __stats_dirname__
+from forsythe.images.locks import get_temp_filepath, is_transient_filename, copy_file
+from forsythe.images.manifest import get_file_signature
+
+__mirror_state_filename__ = '.mirror.json'
+__mirror_transfers__ = 4
+
+
+def get_mirror_root():
+    return get_config_var('local_mirror_dir') or None
+
+
+def get_mirror_dir(mirror_root, images_dir):
+    # Named for the directory it mirrors, but keyed by its full path so that e.g. two collections' 'images' subdirs
+    # never share a mirror
+    images_dir = os.path.normcase(os.path.abspath(images_dir))
+    digest = hashlib.sha1(images_dir.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(mirror_root, '%s-%s' % (os.path.basename(images_dir), digest))
+
+
+def list_mirrored_files(dirpath):
+    # Raws and sidecars at the top level, plus params and stats: caches are left out, since each machine keeps its own
+    relpaths = []
+    for subdir in ('', __params_dirname__, __stats_dirname__):
+        abspath = os.path.join(dirpath, subdir)
+        if os.path.isdir(abspath):
+            for name in os.listdir(abspath):
+                if name != __mirror_state_filename__ and not is_transient_filename(name) and os.path.isfile(os.path.join(abspath, name)):
+                    relpaths.append(os.path.join(subdir, name) if subdir else name)
+    return relpaths
+
+
+def get_signatures(dirpath, relpaths):
+    return {relpath: list(get_file_signature(os.path.join(dirpath, relpath))) for relpath in relpaths}
+
+
+def read_mirror_state(mirror_dir):
+    filepath = os.path.join(mirror_dir, __mirror_state_filename__)
+    if os.path.isfile(filepath):
+        try:
+            with open(filepath) as fp:
+                return json.load(fp) or {}
+        except ValueError:
+            return {}
+    return {}
+
+
+def write_mirror_state(mirror_dir, state):
+    filepath = os.path.join(mirror_dir, __mirror_state_filename__)
+    tmp_filepath = get_temp_filepath(filepath)
+    with open(tmp_filepath, 'w') as fp:
+        json.dump(state, fp, indent=1, sort_keys=True)
+    os.replace(tmp_filepath, filepath)
+
+
+def transfer_files(src_dir, dst_dir, relpaths, max_transfers=__mirror_transfers__):
+    # Copies run on a bounded number of threads: enough to keep a network link busy without flooding it
+    with ThreadPoolExecutor(max_workers=max_transfers) as executor:
+        futures = [executor.submit(copy_file, os.path.join(src_dir, relpath), os.path.join(dst_dir, relpath)) for relpath in relpaths]
+        for future in futures:
+            future.result()
+
+
+def pull_mirror(images_dir, mirror_dir, max_transfers=__mirror_transfers__):
+    # The state records each file's signature on both sides as of its last transfer, so that either side can be
+    # checked for changes without comparing one filesystem's timestamps against another's
+    os.makedirs(mirror_dir, exist_ok=True)
+    state = read_mirror_state(mirror_dir)
+    source_signatures = get_signatures(images_dir, list_mirrored_files(images_dir))
+    mirror_signatures = get_signatures(mirror_dir, list_mirrored_files(mirror_dir))
+
+    to_copy = []
+    for relpath, signature in source_signatures.items():
+        recorded = state.get(relpath)
+        if not recorded or recorded['source'] != signature or recorded['mirror'] != mirror_signatures.get(relpath):
+            to_copy.append(relpath)
+
+    to_remove = [relpath for relpath in mirror_signatures if relpath not in source_signatures]
+    for relpath in to_remove:
+        os.remove(os.path.join(mirror_dir, relpath))
+        state.pop(relpath, None)
+
+    transfer_files(images_dir, mirror_dir, to_copy, max_transfers)
+    for relpath in to_copy:
+        state[relpath] = {'source': source_signatures[relpath], 'mirror': list(get_file_signature(os.path.join(mirror_dir, relpath)))}
+    write_mirror_state(mirror_dir, state)
+    return len(to_copy), len(to_remove)
+
+
+def push_mirror(images_dir, mirror_dir, max_transfers=__mirror_transfers__):
+    state = read_mirror_state(mirror_dir)
+    mirror_signatures = get_signatures(mirror_dir, list_mirrored_files(mirror_dir))
+
+    def get_source_signature(relpath):
+        filepath = os.path.join(images_dir, relpath)
+        return list(get_file_signature(filepath)) if os.path.isfile(filepath) else None
+
+    to_copy = []
+    for relpath, signature in mirror_signatures.items():
+        recorded = state.get(relpath)
+        if recorded and recorded['mirror'] == signature:
+            continue
+        # Never clobber a file that someone else has changed on the share since we mirrored it
+        if recorded and recorded['source'] != get_source_signature(relpath):
+            print('WARNING: %s changed in both %s and %s; keeping the original' % (relpath, images_dir, mirror_dir))
+            continue
+        to_copy.append(relpath)
+
+    to_remove = []
+    for relpath, recorded in list(state.items()):
+        if relpath not in mirror_signatures:
+            if recorded['source'] == get_source_signature(relpath):
+                os.remove(os.path.join(images_dir, relpath))
+                to_remove.append(relpath)
+            state.pop(relpath)
+
+    transfer_files(mirror_dir, images_dir, to_copy, max_transfers)
+    for relpath in to_copy:
+        state[relpath] = {'source': get_source_signature(relpath), 'mirror': mirror_signatures[relpath]}
+    write_mirror_state(mirror_dir, state)
+    return len(to_copy), len(to_remove)
+
+
+@contextmanager
+def mirrored_images_dir(images_dir, max_transfers=None):
+    # Yields a local copy of images_dir to work in, if a 'local_mirror_dir' is configured, and syncs whatever was
+    # written there back to images_dir afterwards (even if the work failed partway through)
+    mirror_root = get_mirror_root()
+    if not mirror_root:
+        yield images_dir
+        return
+
+    max_transfers = max_transfers or get_config_var('mirror_transfers', __mirror_transfers__)
+    mirror_dir = get_mirror_dir(mirror_root, images_dir)
+    print('Mirroring to %s...' % mirror_dir)
+    num_copied, num_removed = pull_mirror(images_dir, mirror_dir, max_transfers)
+    print('Copied %d files, removed %d.' % (num_copied, num_removed))
+    print('')
+    try:
+        yield mirror_dir
+    finally:
+        print('')
+        print('Syncing changes back to %s...' % images_dir)
+        num_copied, num_removed = push_mirror(images_dir, mirror_dir, max_transfers)
+        print('Copied %d files, removed %d.' % (num_copied, num_removed))
@@ -0,0 +1,27 @@
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+__prefetch_lookahead__ = 4
+__prefetch_workers__ = 2
+
+
+def prefetch(items, func, lookahead=__prefetch_lookahead__, num_workers=__prefetch_workers__):
+    # Yields (item, func(item)) in order, keeping up to `lookahead` calls in flight on worker threads so that loading
+    # the next few items overlaps with whatever the consumer is doing with the current one
+    items = iter(items)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        for item in itertools.islice(items, max(1, lookahead)):
+            pending.append((item, executor.submit(func, item)))
+
+        while pending:
+            item, future = pending.popleft()
+            for next_item in itertools.islice(items, 1):
+                pending.append((next_item, executor.submit(func, next_item)))
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,209 @@
+import io
+import os
+
+import cv2
+import numpy as np
+import rawpy
+import imageio
+
+from forsythe.images.files import list_image_filenames, is_raw, list_raw_image_filenames
+from forsythe.images.cache import get_decode_settings, get_postprocess_args
+from forsythe.images.locks import file_lock, get_temp_filepath
+from forsythe.images.prefetch import __prefetch_lookahead__, __prefetch_workers__, prefetch
+from forsythe.images.manifest import hash_bytes, get_settings_key, read_manifest, update_manifest, touch_manifest_entries, make_manifest_entry, is_entry_current, record_usage
+
+__preview_dirname__ = '.previewcache'
+__preview_settings__ = {'source': 'embedded_thumb', 'fallback_profile': 'detect'}
+
+# LibRaw's sizes.flip values, mapped to the number of counter-clockwise quarter turns that postprocess() applies
+__flip_rotations__ = {0: 0, 3: 2, 5: 1, 6: 3}
+
+
+def get_preview_dir(images_dir):
+    return os.path.join(images_dir, __preview_dirname__)
+
+
+def get_preview_image_filepath(raw_filepath):
+    dirpath, filename = os.path.split(raw_filepath)
+    basename = os.path.splitext(filename)[0]
+    return os.path.join(dirpath, __preview_dirname__, basename + '.jpg')
+
+
+def get_preview_key():
+    fallback_settings = get_decode_settings(__preview_settings__['fallback_profile'])
+    return get_settings_key(dict(__preview_settings__, fallback_settings=fallback_settings))
+
+
+def extract_preview_rgb(raw):
+    # Returns (jpeg_data, rgb, oriented): the embedded thumbnail is stored as the sensor sees it, whereas the fallback
+    # decode has already been turned to match the camera's orientation flag
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return None, raw.postprocess(**get_postprocess_args(__preview_settings__['fallback_profile'])), True
+
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        return thumb.data, None, False
+    return None, thumb.data, False
+
+
+def regenerate_preview_image(raw_filepath):
+    preview_filepath = get_preview_image_filepath(raw_filepath)
+    os.makedirs(os.path.dirname(preview_filepath), exist_ok=True)
+
+    with open(raw_filepath, 'rb') as fp:
+        data = fp.read()
+    with rawpy.imread(io.BytesIO(data)) as raw:
+        jpeg_data, rgb, oriented = extract_preview_rgb(raw)
+        rotations = 0 if oriented else __flip_rotations__.get(raw.sizes.flip, 0)
+        full_long_side = max(raw.sizes.width, raw.sizes.height)
+
+    # An embedded thumbnail is turned to match the full decode, so that preview coordinates line up with the cached image
+    if jpeg_data is not None and rotations:
+        rgb = imageio.imread(io.BytesIO(jpeg_data))
+        jpeg_data = None
+    if rgb is not None and rotations:
+        rgb = np.rot90(rgb, rotations)
+
+    tmp_filepath = get_temp_filepath(preview_filepath)
+    if jpeg_data is not None:
+        with open(tmp_filepath, 'wb') as fp:
+            fp.write(jpeg_data)
+    else:
+        imageio.imsave(tmp_filepath, rgb)
+    os.replace(tmp_filepath, preview_filepath)
+
+    entry = make_manifest_entry(raw_filepath, get_preview_key(), hash_bytes(data))
+    entry['full_long_side'] = full_long_side
+    return entry
+
+
+def is_preview_image_current(manifest, raw_filepath):
+    return is_entry_current(manifest, raw_filepath, get_preview_image_filepath(raw_filepath), get_preview_key())
+
+
+def fill_preview_image(raw_filepath, force=False):
+    preview_filepath = get_preview_image_filepath(raw_filepath)
+    preview_dir = os.path.dirname(preview_filepath)
+    os.makedirs(preview_dir, exist_ok=True)
+    with file_lock(preview_filepath):
+        if not force and is_preview_image_current(read_manifest(preview_dir), raw_filepath):
+            return False
+        entry = regenerate_preview_image(raw_filepath)
+        update_manifest(preview_dir, {os.path.basename(raw_filepath): entry})
+    return True
+
+
+def generate_previews(images_dir, force=False):
+    preview_dir = get_preview_dir(images_dir)
+    manifest = read_manifest(preview_dir)
+
+    touched = {}
+    num_filled = 0
+    num_waited = 0
+    for raw_filename in list_raw_image_filenames(images_dir):
+        raw_filepath = os.path.join(images_dir, raw_filename)
+        if not force and is_preview_image_current(manifest, raw_filepath):
+            touched[raw_filename] = manifest[raw_filename]
+        elif fill_preview_image(raw_filepath, force):
+            num_filled += 1
+        else:
+            num_waited += 1
+
+    touch_manifest_entries(preview_dir, touched)
+    record_usage(preview_dir, hits=len(touched) + num_waited, misses=num_filled)
+    return num_filled
+
+
+def resize_image(img, scale):
+    if scale == 1.0:
+        return img
+    height, width = img.shape[0], img.shape[1]
+    return cv2.resize(img, (max(1, int(round(width * scale))), max(1, int(round(height * scale)))), interpolation=cv2.INTER_AREA)
+
+
+def load_preview_image(raw_filepath, scale, manifest):
+    filename = os.path.basename(raw_filepath)
+    preview_filepath = get_preview_image_filepath(raw_filepath)
+    if is_preview_image_current(manifest, raw_filepath):
+        filled = None
+    else:
+        filled = fill_preview_image(raw_filepath)
+        manifest.update(read_manifest(os.path.dirname(preview_filepath)))
+
+    # scale is relative to the full-resolution decode, so callers' pixel-based params mean the same thing regardless
+    # of how large the camera's embedded thumbnail happens to be
+    img = cv2.imread(preview_filepath)
+    full_long_side = manifest.get(filename, {}).get('full_long_side') or max(img.shape[:2])
+    return resize_image(img, scale * full_long_side / max(img.shape[:2])), filled
+
+
+def read_preview_image(raw_filepath, scale=1.0):
+    filename = os.path.basename(raw_filepath)
+    preview_dir = os.path.dirname(get_preview_image_filepath(raw_filepath))
+    manifest = read_manifest(preview_dir)
+    img, filled = load_preview_image(raw_filepath, scale, manifest)
+    if filled is None:
+        touch_manifest_entries(preview_dir, {filename: manifest[filename]})
+    record_usage(preview_dir, hits=0 if filled else 1, misses=1 if filled else 0)
+    return img
+
+
+def record_preview_reads(preview_dir, filenames, manifest):
+    # For callers that read a whole batch of previews (e.g. from worker processes, which each get only their own entry
+    # of the manifest): the batch's usage is recorded in one go, rather than with a manifest rewrite per read
+    touched = {filename: manifest[filename] for filename in filenames if filename in manifest}
+    touch_manifest_entries(preview_dir, touched)
+    record_usage(preview_dir, hits=len(touched), misses=len(filenames) - len(touched))
+
+
+def preview_iterator(images_dir, scale=1.0):
+    preview_dir = get_preview_dir(images_dir)
+    manifest = read_manifest(preview_dir)
+    touched = {}
+    hits, misses = 0, 0
+    try:
+        for filename in list_image_filenames(images_dir):
+            filepath = os.path.join(images_dir, filename)
+            if is_raw(filepath):
+                img, filled = load_preview_image(filepath, scale, manifest)
+                if filled is None:
+                    touched[filename] = manifest[filename]
+                if filled:
+                    misses += 1
+                else:
+                    hits += 1
+                yield filepath, img
+            else:
+                yield filepath, resize_image(cv2.imread(filepath), scale)
+    finally:
+        touch_manifest_entries(preview_dir, touched)
+        record_usage(preview_dir, hits, misses)
+
+
+def prefetch_preview_iterator(images_dir, scale=1.0, lookahead=__prefetch_lookahead__, num_workers=__prefetch_workers__):
+    preview_dir = get_preview_dir(images_dir)
+    manifest = read_manifest(preview_dir)
+
+    def load(filename):
+        filepath = os.path.join(images_dir, filename)
+        if is_raw(filepath):
+            return load_preview_image(filepath, scale, manifest)
+        return resize_image(cv2.imread(filepath), scale), None
+
+    touched = {}
+    hits, misses = 0, 0
+    try:
+        for filename, (img, filled) in prefetch(list_image_filenames(images_dir), load, lookahead, num_workers):
+            filepath = os.path.join(images_dir, filename)
+            if is_raw(filepath):
+                if filled is None:
+                    touched[filename] = manifest[filename]
+                if filled:
+                    misses += 1
+                else:
+                    hits += 1
+            yield filepath, img
+    finally:
+        touch_manifest_entries(preview_dir, touched)
+        record_usage(preview_dir, hits, misses)
@@ -0,0 +1,99 @@
+import os
+import json
+import shutil
+
+import cv2
+import numpy as np
+
+from forsythe.images.locks import get_temp_filepath, replace_path
+
+__pyramid_ext__ = '.pyramid'
+__pyramid_meta_filename__ = 'pyramid.json'
+__tile_size__ = 256
+__num_levels__ = 4
+
+
+def get_pyramid_dirpath(cached_filepath):
+    return os.path.splitext(cached_filepath)[0] + __pyramid_ext__
+
+
+def get_level_filepath(pyramid_dir, level):
+    return os.path.join(pyramid_dir, 'level%d.npy' % level)
+
+
+def tile_image(img, tile_size):
+    height, width = img.shape[0], img.shape[1]
+    tiles_y = -(-height // tile_size)
+    tiles_x = -(-width // tile_size)
+    padded = np.zeros((tiles_y * tile_size, tiles_x * tile_size) + img.shape[2:], dtype=img.dtype)
+    padded[:height, :width] = img
+
+    # (rows, cols, ...) -> (tile_row, tile_col, row_in_tile, col_in_tile, ...), so that each tile is contiguous on disk
+    tiles = padded.reshape((tiles_y, tile_size, tiles_x, tile_size) + img.shape[2:]).swapaxes(1, 2)
+    return np.ascontiguousarray(tiles)
+
+
+def read_pyramid_meta(pyramid_dir):
+    filepath = os.path.join(pyramid_dir, __pyramid_meta_filename__)
+    if os.path.isfile(filepath):
+        with open(filepath) as fp:
+            return json.load(fp)
+    return None
+
+
+def delete_pyramid(pyramid_dir):
+    if os.path.isdir(pyramid_dir):
+        shutil.rmtree(pyramid_dir)
+
+
+def write_pyramid(pyramid_dir, img, source, num_levels=__num_levels__, tile_size=__tile_size__):
+    tmp_dir = get_temp_filepath(pyramid_dir)
+    delete_pyramid(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    levels = []
+    level_img = img
+    for level in range(num_levels):
+        if level > 0:
+            height, width = level_img.shape[0], level_img.shape[1]
+            level_img = cv2.resize(level_img, (max(1, width // 2), max(1, height // 2)), interpolation=cv2.INTER_AREA)
+        np.save(get_level_filepath(tmp_dir, level), tile_image(level_img, tile_size))
+        levels.append({'width': level_img.shape[1], 'height': level_img.shape[0]})
+
+    # The meta file is written last: a pyramid without one is incomplete and is never read
+    meta = {'source': source, 'tile_size': tile_size, 'levels': levels}
+    with open(os.path.join(tmp_dir, __pyramid_meta_filename__), 'w') as fp:
+        json.dump(meta, fp)
+    replace_path(tmp_dir, pyramid_dir)
+    return meta
+
+
+def is_pyramid_current(pyramid_dir, source):
+    meta = read_pyramid_meta(pyramid_dir)
+    return meta is not None and meta.get('source') == source
+
+
+def read_pyramid_region(pyramid_dir, level, region=None, meta=None):
+    meta = meta or read_pyramid_meta(pyramid_dir)
+    if meta is None:
+        raise RuntimeError('No image pyramid at %s' % pyramid_dir)
+    if level < 0 or level >= len(meta['levels']):
+        raise ValueError('Pyramid level %d out of range (0-%d)' % (level, len(meta['levels']) - 1))
+
+    tile_size = meta['tile_size']
+    level_width, level_height = meta['levels'][level]['width'], meta['levels'][level]['height']
+    x, y, width, height = region or (0, 0, level_width, level_height)
+    x0, y0 = max(0, int(x)), max(0, int(y))
+    x1, y1 = min(level_width, int(x + width)), min(level_height, int(y + height))
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('Region %r lies outside of pyramid level %d (%dx%d)' % (region, level, level_width, level_height))
+
+    # Only the tiles overlapping the region are sliced out of the memory map, so only their pages are ever read
+    tiles = np.load(get_level_filepath(pyramid_dir, level), mmap_mode='r')
+    tx0, ty0 = x0 // tile_size, y0 // tile_size
+    tx1, ty1 = -(-x1 // tile_size), -(-y1 // tile_size)
+    block = np.asarray(tiles[ty0:ty1, tx0:tx1])
+    block = block.swapaxes(1, 2).reshape(((ty1 - ty0) * tile_size, (tx1 - tx0) * tile_size) + block.shape[4:])
+
+    ox, oy = x0 - tx0 * tile_size, y0 - ty0 * tile_size
+    return np.ascontiguousarray(block[oy:oy + (y1 - y0), ox:ox + (x1 - x0)])
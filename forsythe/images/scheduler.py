@@ -0,0 +1,95 @@
+import os
+import struct
+
+import psutil
+
+from forsythe.config import get_config_var, parse_size
+
+# Fraction of currently-available RAM that decodes may use when no 'decode_memory_budget' is configured
+__default_budget_fraction__ = 0.5
+
+# Only IFD0 is read, and it's always near the start of the file
+__header_size__ = 64 * 1024
+
+# Peak working set of one decode, per sensor pixel and per output pixel: LibRaw's unpacked 16-bit sensor data, its
+# 4x16-bit working image, and postprocess()'s 8-bit RGB output plus the BGR copy made for pyramids and analysis
+__raw_bytes_per_pixel__ = 2
+__image_bytes_per_pixel__ = 8
+__output_bytes_per_pixel__ = 3 * 2
+
+
+def read_raw_dimensions(raw_filepath):
+    # CR2 (like most raw formats) is a TIFF container, and its IFD0 describes the full-size image
+    with open(raw_filepath, 'rb') as fp:
+        header = fp.read(__header_size__)
+
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    if len(header) < 8 or struct.unpack(endian + 'H', header[2:4])[0] != 42:
+        return None
+
+    ifd_offset = struct.unpack(endian + 'I', header[4:8])[0]
+    if ifd_offset + 2 > len(header):
+        return None
+    num_entries = struct.unpack(endian + 'H', header[ifd_offset:ifd_offset + 2])[0]
+
+    dimensions = {}
+    for i in range(num_entries):
+        offset = ifd_offset + 2 + 12 * i
+        if offset + 12 > len(header):
+            break
+        tag, value_type = struct.unpack(endian + 'HH', header[offset:offset + 4])
+        if tag in (0x0100, 0x0101):
+            value_fmt = endian + ('H' if value_type == 3 else 'I')
+            dimensions[tag] = struct.unpack(value_fmt, header[offset + 8:offset + 8 + struct.calcsize(value_fmt)])[0]
+
+    if 0x0100 in dimensions and 0x0101 in dimensions:
+        return dimensions[0x0100], dimensions[0x0101]
+    return None
+
+
+def estimate_decode_memory(raw_filepath, scale=1.0):
+    file_size = os.path.getsize(raw_filepath)
+    dimensions = read_raw_dimensions(raw_filepath)
+    if dimensions:
+        num_pixels = dimensions[0] * dimensions[1]
+    else:
+        # Compressed raws run a little over a byte per pixel, so this errs on the side of overestimating
+        num_pixels = file_size
+
+    num_output_pixels = num_pixels * scale * scale
+    return file_size + num_pixels * __raw_bytes_per_pixel__ + num_output_pixels * (__image_bytes_per_pixel__ + __output_bytes_per_pixel__)
+
+
+def get_decode_memory_budget():
+    budget = get_config_var('decode_memory_budget')
+    if budget:
+        return parse_size(budget)
+    return int(psutil.virtual_memory().available * __default_budget_fraction__)
+
+
+class DecodeBudget(object):
+    # The estimated memory in use by the decodes in flight, against a budget: a decode only starts if it fits alongside
+    # those already running, except that a single decode always runs, however large it is
+
+    def __init__(self, budget=None):
+        self.budget = get_decode_memory_budget() if budget is None else budget
+        self.in_use = 0
+
+    def get_num_workers(self, estimates, num_workers):
+        # No point starting workers that could never all be decoding at once
+        largest_estimate = max(estimates) if estimates else 0
+        return min(num_workers, max(1, int(self.budget // largest_estimate)) if largest_estimate else 1)
+
+    def can_start(self, estimate):
+        return self.in_use == 0 or self.in_use + estimate <= self.budget
+
+    def start(self, estimate):
+        self.in_use += estimate
+
+    def finish(self, estimate):
+        self.in_use -= estimate
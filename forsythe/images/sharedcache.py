@@ -0,0 +1,90 @@
+import os
+import json
+import shutil
+
+from forsythe.config import get_config_var
+from forsythe.images.locks import get_temp_filepath, replace_path, copy_file
+from forsythe.images.pyramid import get_pyramid_dirpath, delete_pyramid, is_pyramid_current
+
+
+def get_shared_cache_root():
+    return get_config_var('shared_cache_dir') or None
+
+
+def get_shared_image_filepath(shared_root, profile, entry):
+    # Content-addressed, so any workstation decoding the same raw with the same settings lands on the same path no
+    # matter where its copy of the collection is mounted
+    digest = entry['hash']
+    return os.path.join(shared_root, profile, entry['key'], digest[:2], digest + '.jpg')
+
+
+def get_shared_stats_filepath(shared_root, profile, entry):
+    return os.path.splitext(get_shared_image_filepath(shared_root, profile, entry))[0] + '.json'
+
+
+def copy_dir(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_dirpath = get_temp_filepath(dst)
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    shutil.copytree(src, tmp_dirpath)
+    replace_path(tmp_dirpath, dst)
+
+
+def fetch_shared_image(shared_root, entry, cached_filepath, profile, pyramid_source=None):
+    shared_filepath = get_shared_image_filepath(shared_root, profile, entry)
+    shared_pyramid_dir = get_pyramid_dirpath(shared_filepath)
+    try:
+        if not os.path.isfile(shared_filepath):
+            return False
+        # A pyramid rebuilt from the shared JPEG wouldn't match one built from the decode, so decode locally instead
+        if pyramid_source and not is_pyramid_current(shared_pyramid_dir, pyramid_source):
+            return False
+
+        copy_file(shared_filepath, cached_filepath)
+        pyramid_dir = get_pyramid_dirpath(cached_filepath)
+        if pyramid_source:
+            copy_dir(shared_pyramid_dir, pyramid_dir)
+        else:
+            delete_pyramid(pyramid_dir)
+    except OSError as exc:
+        # The shared tier is only ever a shortcut: if the share is unreachable, we just decode locally
+        print('WARNING: Failed to fetch %s from shared cache: %s' % (os.path.basename(cached_filepath), exc))
+        return False
+    return True
+
+
+def publish_shared_image(shared_root, entry, cached_filepath, profile, pyramid_source=None):
+    shared_filepath = get_shared_image_filepath(shared_root, profile, entry)
+    shared_pyramid_dir = get_pyramid_dirpath(shared_filepath)
+    try:
+        if not os.path.isfile(shared_filepath):
+            copy_file(cached_filepath, shared_filepath)
+        if pyramid_source and not is_pyramid_current(shared_pyramid_dir, pyramid_source):
+            copy_dir(get_pyramid_dirpath(cached_filepath), shared_pyramid_dir)
+    except OSError as exc:
+        print('WARNING: Failed to publish %s to shared cache: %s' % (os.path.basename(cached_filepath), exc))
+        return False
+    return True
+
+
+def read_shared_stats(shared_root, entry, profile):
+    filepath = get_shared_stats_filepath(shared_root, profile, entry)
+    try:
+        with open(filepath) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def publish_shared_stats(shared_root, entry, profile, record):
+    filepath = get_shared_stats_filepath(shared_root, profile, entry)
+    try:
+        if not os.path.isfile(filepath):
+            tmp_filepath = get_temp_filepath(filepath)
+            with open(tmp_filepath, 'w') as fp:
+                json.dump(record, fp)
+            os.replace(tmp_filepath, filepath)
+    except OSError as exc:
+        print('WARNING: Failed to publish stats for %s to shared cache: %s' % (entry['hash'], exc))
+        return False
+    return True
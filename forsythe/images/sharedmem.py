@@ -0,0 +1,230 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8: decodes are handed off through the on-disk cache instead
+    shared_memory = None
+
+from forsythe.images.files import list_image_filenames, is_raw
+from forsythe.images.locks import file_lock
+from forsythe.images.manifest import read_manifest, update_manifest, touch_manifest_entries, record_usage, make_manifest_entry
+from forsythe.images.sharedcache import get_shared_cache_root
+from forsythe.images.prefetch import __prefetch_lookahead__, __prefetch_workers__
+from forsythe.images.scheduler import estimate_decode_memory, get_decode_memory_budget, DecodeBudget
+from forsythe.images.cache import __default_profile__, get_decode_key, get_cache_dir, get_cached_image_filepath, get_profile_scale, read_raw_file, decode_raw_data, store_cached_image, fetch_cached_image, publish_cached_image, is_cached_image_current, read_cached_image, prefetch_image_iterator
+
+# Large enough for a full-resolution decode from any of the bodies we shoot with (up to ~20 MP); anything bigger is
+# still handled, it just gets pickled back from the worker instead
+__slot_size__ = 5600 * 3750 * 3
+
+
+def is_shared_memory_supported():
+    return shared_memory is not None
+
+
+def get_slot_size(profile):
+    return int(__slot_size__ * get_profile_scale(profile) ** 2)
+
+
+class FrameSlots(object):
+
+    def __init__(self, count, size):
+        self.size = size
+        self.blocks = [shared_memory.SharedMemory(create=True, size=size) for _ in range(count)]
+        self.free = deque(self.blocks)
+        self.retired = deque()
+
+    def retire(self, block, future):
+        # A block can't be reused until whatever was scheduled against its frame (i.e. persisting it) has finished
+        if future is None:
+            self.free.append(block)
+        else:
+            self.retired.append((block, future))
+
+    def acquire(self):
+        while self.retired and self.retired[0][1].done():
+            self.free.append(self.retired.popleft()[0])
+        if not self.free:
+            block, future = self.retired.popleft()
+            future.result()
+            self.free.append(block)
+        return self.free.popleft()
+
+    def close(self):
+        for block in self.blocks:
+            try:
+                block.close()
+            except BufferError:
+                # The consumer is still holding a view of the last frame; the mapping goes away along with it
+                pass
+            block.unlink()
+
+
+def fetch_into_cache(raw_filepath, profile, pyramid):
+    # Returns (img, entry), with img None if the raw still needs decoding. Hashing streams the raw rather than reading
+    # it into memory, since it's only needed in full if the shared tier misses. The fetch is single-flight under the
+    # entry's lock, as in fill_cached_image: if another process filled the entry while we waited, we use its fill.
+    filename = os.path.basename(raw_filepath)
+    entry = make_manifest_entry(raw_filepath, get_decode_key(profile))
+    cached_filepath = get_cached_image_filepath(raw_filepath, profile)
+    cache_dir = os.path.dirname(cached_filepath)
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(cached_filepath):
+        manifest = read_manifest(cache_dir)
+        if is_cached_image_current(manifest, raw_filepath, profile, pyramid):
+            entry = manifest[filename]
+        elif fetch_cached_image(raw_filepath, entry, profile, pyramid):
+            # Another workstation has already decoded this raw, and the local cache has just been filled from its copy
+            update_manifest(cache_dir, {filename: entry})
+        else:
+            return None, entry
+        return read_cached_image(raw_filepath, profile), entry
+
+
+def decode_into_slot(raw_filepath, profile, pyramid, slot_name, slot_size, persist=True):
+    # Without persist, nothing may be written to the local cache, so the shared tier isn't consulted at all
+    img, entry = None, None
+    if persist and get_shared_cache_root():
+        img, entry = fetch_into_cache(raw_filepath, profile, pyramid)
+    fetched = img is not None
+    if not fetched:
+        data, entry = read_raw_file(raw_filepath, profile)
+        img = decode_raw_data(data, profile)[:, :, ::-1]
+
+    if img.nbytes > slot_size:
+        return entry, img.shape, np.ascontiguousarray(img), fetched
+
+    # The parent keeps its own handle open on every slot, so closing ours doesn't free the block (which it would on
+    # Windows if the worker was the last one holding it)
+    block = shared_memory.SharedMemory(name=slot_name)
+    try:
+        view = np.ndarray(img.shape, dtype=img.dtype, buffer=block.buf)
+        view[:] = img
+        del view
+    finally:
+        block.close()
+    return entry, img.shape, None, fetched
+
+
+def persist_frame(raw_filepath, img, entry, profile=__default_profile__, pyramid=False):
+    cached_filepath = get_cached_image_filepath(raw_filepath, profile)
+    cache_dir = os.path.dirname(cached_filepath)
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(cached_filepath):
+        store_cached_image(raw_filepath, np.ascontiguousarray(img[:, :, ::-1]), entry, profile, pyramid)
+        update_manifest(cache_dir, {os.path.basename(raw_filepath): entry})
+    publish_cached_image(raw_filepath, entry, profile, pyramid)
+
+
+def shared_decode_iterator(images_dir, profile=__default_profile__, pyramid=False, persist=True, lookahead=__prefetch_lookahead__, num_workers=None, filenames=None, with_entries=False):
+    # Yields (filepath, img) like prefetch_image_iterator, but raws that aren't already cached are decoded by worker
+    # processes straight into shared memory, and the consumer gets a BGR view of that memory rather than a JPEG that's
+    # been written out and read back in. Each view is only valid until the iterator is advanced: copy it to keep it.
+    # With with_entries, yields (filepath, img, entry) instead, where entry identifies the decode (None for non-raws).
+    cache_dir = get_cache_dir(images_dir, profile)
+    filenames = list_image_filenames(images_dir) if filenames is None else filenames
+    if not is_shared_memory_supported():
+        for filepath, img in prefetch_image_iterator(images_dir, profile, pyramid, lookahead=lookahead, filenames=filenames):
+            if with_entries:
+                entry = read_manifest(cache_dir).get(os.path.basename(filepath)) if is_raw(filepath) else None
+                yield filepath, img, entry
+            else:
+                yield filepath, img
+        return
+
+    manifest = read_manifest(cache_dir)
+    waiting = deque(filenames)
+    scale = get_profile_scale(profile)
+    estimates = {}
+    for filename in waiting:
+        filepath = os.path.join(images_dir, filename)
+        if is_raw(filepath) and not is_cached_image_current(manifest, filepath, profile, pyramid):
+            estimates[filename] = estimate_decode_memory(filepath, scale)
+
+    # Enough slots for every decode in flight, the frame the consumer is looking at, and one being persisted. The slots
+    # are allocated up front, so they come out of the memory budget before any decode does.
+    lookahead = max(1, lookahead)
+    slots = FrameSlots(lookahead + 2, get_slot_size(profile))
+    budget = DecodeBudget(max(0, get_decode_memory_budget() - slots.size * len(slots.blocks)))
+    num_workers = budget.get_num_workers(list(estimates.values()), num_workers or lookahead)
+    pool = multiprocessing.Pool(num_workers)
+    persister = ThreadPoolExecutor(max_workers=1) if persist else None
+    # Frames that are already cached are read ahead on threads, so that they overlap with the consumer as decodes do
+    reader = ThreadPoolExecutor(max_workers=__prefetch_workers__)
+    pending = deque()
+
+    def submit():
+        # Tops up the frames in flight, in order: a decode that doesn't fit in the budget waits until earlier ones have
+        # been collected
+        while waiting and len(pending) < lookahead:
+            filename = waiting[0]
+            filepath = os.path.join(images_dir, filename)
+            estimate = estimates.get(filename)
+            if estimate is None:
+                pending.append((filename, filepath, None, reader.submit(read_cached_image, filepath, profile), 0))
+            elif not budget.can_start(estimate):
+                return
+            else:
+                block = slots.acquire()
+                result = pool.apply_async(decode_into_slot, (filepath, profile, pyramid, block.name, slots.size, persist))
+                pending.append((filename, filepath, block, result, estimate))
+                budget.start(estimate)
+            waiting.popleft()
+
+    touched = {}
+    hits, misses = 0, 0
+    try:
+        submit()
+        while pending:
+            filename, filepath, block, result, estimate = pending.popleft()
+            # A frame that fails to load is skipped with a warning, rather than ending the whole iteration
+            if block is None:
+                try:
+                    img = result.result()
+                except Exception as exc:
+                    print('WARNING: Failed to read %s: %s' % (filename, exc))
+                    submit()
+                    continue
+                entry = None
+                if is_raw(filepath):
+                    entry = touched[filename] = manifest[filename]
+                    hits += 1
+                yield (filepath, img, entry) if with_entries else (filepath, img)
+            else:
+                budget.finish(estimate)
+                try:
+                    entry, shape, copy, fetched = result.get()
+                except Exception as exc:
+                    print('WARNING: Failed to decode %s: %s' % (filename, exc))
+                    slots.retire(block, None)
+                    submit()
+                    continue
+                img = copy if copy is not None else np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+                future = None
+                if persister and not fetched:
+                    future = persister.submit(persist_frame, filepath, img, entry, profile, pyramid)
+                misses += 1
+                yield (filepath, img, entry) if with_entries else (filepath, img)
+                del img
+                slots.retire(block, future)
+
+            submit()
+    finally:
+        pool.terminate()
+        pool.join()
+        for _, _, _, result, _ in pending:
+            if isinstance(result, Future):
+                result.cancel()
+        reader.shutdown(wait=True)
+        if persister:
+            persister.shutdown(wait=True)
+        slots.close()
+        if persist:
+            touch_manifest_entries(cache_dir, touched)
+            record_usage(cache_dir, hits, misses)
@@ -0,0 +1,62 @@
+import os
+import json
+
+from forsythe.cropper import CORNER_SIZE_FACTOR
+from forsythe.cropper.mask import crop_corners, average_color
+from forsythe.images.locks import file_lock, get_temp_filepath
+
+__stats_dirname__ = '.stats'
+__stats_ext__ = '.json'
+
+
+def get_stats_filepath(image_filepath, for_write=False):
+    dirname, filename = os.path.split(image_filepath)
+    basename = os.path.splitext(filename)[0]
+    dirpath = os.path.join(dirname, __stats_dirname__)
+    if for_write:
+        os.makedirs(dirpath, exist_ok=True)
+    return os.path.join(dirpath, basename + __stats_ext__)
+
+
+def compute_image_stats(img_bgr, source, corner_size_factor=CORNER_SIZE_FACTOR):
+    # Full-precision means, so that a key color derived from them matches get_key_color_from_corners exactly
+    corners = crop_corners(img_bgr, corner_size_factor)
+    corner_colors = {corner.name: [float(x) for x in average_color(region)] for corner, region in corners.items()}
+
+    return {
+        'source': source,
+        'width': img_bgr.shape[1],
+        'height': img_bgr.shape[0],
+        'corner_size_factor': corner_size_factor,
+        'corner_colors_bgr': corner_colors,
+    }
+
+
+def read_all_image_stats(image_filepath):
+    filepath = get_stats_filepath(image_filepath)
+    if os.path.isfile(filepath):
+        try:
+            with open(filepath) as fp:
+                return json.load(fp) or {}
+        except ValueError:
+            return {}
+    return {}
+
+
+def read_image_stats(image_filepath, profile, source=None):
+    # Stats are recorded per decode profile, since e.g. 'detect' skips auto-brightening and so has different colors
+    record = read_all_image_stats(image_filepath).get(profile)
+    if record is None or (source is not None and record.get('source') != source):
+        return None
+    return record
+
+
+def write_image_stats(image_filepath, profile, record):
+    filepath = get_stats_filepath(image_filepath, for_write=True)
+    with file_lock(filepath):
+        all_stats = read_all_image_stats(image_filepath)
+        all_stats[profile] = record
+        tmp_filepath = get_temp_filepath(filepath)
+        with open(tmp_filepath, 'w') as fp:
+            json.dump(all_stats, fp)
+        os.replace(tmp_filepath, filepath)
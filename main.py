@@ -8,7 +8,9 @@ from pynput import keyboard
 from forsythe.collections.common import media_path, get_selected_collection, set_selected_collection
 from forsythe.collections.filerange import get_file_range_and_count
 
-from forsythe.images.cache import generate_cache, image_iterator
+from forsythe.images.cache import image_iterator, get_profile_scale
+from forsythe.images.files import list_image_filenames, is_raw
+from forsythe.images.preview import generate_previews, read_preview_image
 from forsythe.images.params import write_param, read_param
 
 from forsythe.eos.device import wait_for_device
@@ -206,14 +208,14 @@ def run_shoot(args):
 
 
 def run_orient(args):
-    print('Generating image cache...')
-    generate_cache(args.directory)
+    print('Generating previews...')
+    generate_previews(args.directory)
 
-    items = list(image_iterator(args.directory))
+    items = [os.path.join(args.directory, filename) for filename in list_image_filenames(args.directory)]
     i = 0
     while i < len(items):
-        image_filepath, cached_filepath = items[i]
-        img = cv2.imread(cached_filepath)
+        image_filepath = items[i]
+        img = read_preview_image(image_filepath, 0.25) if is_raw(image_filepath) else cv2.imread(image_filepath)
         top_edge = temp_orient_gui(img)
         if top_edge:
             write_param(image_filepath, 'top_edge', top_edge)
@@ -221,19 +223,19 @@ def run_orient(args):
             i += 1
         else:
             i -= 1
-            print('Back to %s.' % items[i][0])
+            print('Back to %s.' % items[i])
 
 
 def run_crop(args):
     print('Regenerating .xmp sidecar files...')
     regenerate_xmps(args.directory)
 
-    for image_filepath, cached_filepath in image_iterator(args.directory):
+    for image_filepath, cached_filepath in image_iterator(args.directory, 'detect'):
         image_params = read_params(image_filepath)
         ev_delta = 0.4
 
         try:
-            crop_params = compute_crop_params(cached_filepath, image_params)
+            crop_params = compute_crop_params(cached_filepath, image_params, get_profile_scale('detect'))
             print ('%s -> %r' % (os.path.basename(image_filepath), crop_params))
 
             iop_clipping = dt_iop_clipping_params_t()
@@ -243,6 +245,7 @@ def run_crop(args):
             iop_clipping.cy = crop_params['cy']
             iop_clipping.cw = crop_params['cw']
             iop_clipping.ch = crop_params['ch']
+            write_param(image_filepath, 'crop_detection', {'detector': crop_params['detector'], 'confidence': crop_params['confidence']})
 
             iop_exposure = dt_iop_exposure_params_t()
             iop_exposure.exposure = ev_delta